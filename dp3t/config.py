@@ -32,5 +32,8 @@ NUM_EPOCHS_PER_DAY = 1440 // EPOCH_LENGTH
 #: Length of EphID in bytes
 LENGTH_EPHID = 16
 
+#: Length of seed in bytes
+LENGTH_SEED = 32
+
 #: Seconds in a UNIX Epoch day
 SECONDS_PER_DAY = 24 * 60 * 60
@@ -19,14 +19,20 @@ __copyright__ = """
 """
 __license__ = "Apache 2.0"
 
+from dp3t.protocols.schema_migration import add_missing_fields
+from dp3t.protocols.storage_profile import storage_pragmas
 from peewee import (
+    SQL,
     BigIntegerField,
     BlobField,
-    DoesNotExist,
+    BooleanField,
     IntegerField,
     Model,
     SqliteDatabase,
     CompositeKey,
+    EXCLUDED,
+    chunked,
+    fn,
 )
 from time import time
 
@@ -36,6 +42,12 @@ from time import time
 
 EPOCH_START = 0
 
+#: Number of distinct (day, ephid hash) entries buffered before a flush
+OBSERVATION_BUFFER_SIZE = 256
+
+#: Maximum number of seconds an observation stays buffered
+OBSERVATION_FLUSH_INTERVAL = 60
+
 
 db = SqliteDatabase(None)
 
@@ -74,6 +86,13 @@ class DailyObservations(BaseModel):
     # Sum of received signal strength indication values
     srssi = BigIntegerField()
 
+    # Filter generation against which the observation was last checked
+    # (0 if it has not been checked)
+    checked_generation = IntegerField(default=0)
+
+    # True if the observation was found in the filter when last checked
+    matched = BooleanField(default=False)
+
     # Composite indexes
     class Meta:
         primary_key = CompositeKey("day", "ephid_hash")
@@ -82,15 +101,29 @@ class DailyObservations(BaseModel):
 # Available tables
 MODELS = [State, EpochIds, DailyObservations]
 
+# Fields added after the initial release, which may be missing from
+# existing databases
+ADDED_FIELDS = [DailyObservations.checked_generation, DailyObservations.matched]
+
+# Number of values bound in a single IN clause
+IN_CHUNK_SIZE = 500
+
+# Number of rows inserted by a single multi-row INSERT statement, kept
+# within the default SQLite limit of 999 bound variables
+INSERT_CHUNK_SIZE = 100
+
 
 class ClientDatabase:
     """Simple reference implementation of the client database."""
 
-    def __init__(self, db_path=":memory:"):
-        """Setup the database access and schema."""
+    def __init__(self, db_path=":memory:", storage_profile=None):
+        """Setup the database access and schema.
+        The storage profile specifies the SQLite settings to use,
+        as described in storage_profile.storage_pragmas."""
 
-        db.init(db_path)
+        db.init(db_path, pragmas=storage_pragmas(storage_profile))
         db.create_tables(MODELS)
+        add_missing_fields(db, ADDED_FIELDS)
         self.state, created = State.get_or_create(
             singleton=0, last_ephid_change=EPOCH_START
         )
@@ -135,6 +168,14 @@ class ClientDatabase:
         else:
             return None
 
+    def get_epoch_ephids(self, start_epoch, end_epoch):
+        """Return a dictionary mapping each epoch of the specified (first
+        inclusive, last exclusive) range to its ephID."""
+        query = EpochIds.select(EpochIds.epoch, EpochIds.ephid).where(
+            EpochIds.epoch.between(start_epoch, end_epoch - 1)
+        )
+        return {epoch: ephid for (epoch, ephid) in query.tuples()}
+
     def delete_past_epoch_ids(self, last_retained_epoch):
         """Delete identifiers associated with past epochs."""
         query = EpochIds.delete().where(EpochIds.epoch < last_retained_epoch)
@@ -142,31 +183,161 @@ class ClientDatabase:
 
     def add_observation(self, day, ephid_hash, rssi):
         """Add an observed ephid hash and its RSSI for the specified day."""
-        try:
-            rec = DailyObservations.get(
-                DailyObservations.day == day, DailyObservations.ephid_hash == ephid_hash
-            )
-            rec.ocount += 1
-            rec.srssi += rssi
-            rec.save()
-        except DoesNotExist:
-            DailyObservations.create(
-                day=day, ephid_hash=ephid_hash, ocount=1, srssi=rssi
-            )
+        DailyObservations.insert(
+            day=day, ephid_hash=ephid_hash, ocount=1, srssi=rssi
+        ).on_conflict(
+            conflict_target=[DailyObservations.day, DailyObservations.ephid_hash],
+            update={
+                DailyObservations.ocount: DailyObservations.ocount + 1,
+                DailyObservations.srssi: DailyObservations.srssi + rssi,
+            },
+        ).execute()
+
+    def add_observations(self, observations):
+        """Add in a single transaction the specified aggregated observations.
+        These are a dictionary mapping (day, ephid hash) tuples to
+        the corresponding (count, RSSI sum) tuples."""
+        rows = (
+            {"day": day, "ephid_hash": ephid_hash, "ocount": ocount, "srssi": srssi}
+            for ((day, ephid_hash), (ocount, srssi)) in observations.items()
+        )
+        with db.atomic():
+            for batch in chunked(rows, INSERT_CHUNK_SIZE):
+                DailyObservations.insert_many(batch).on_conflict(
+                    conflict_target=[
+                        DailyObservations.day,
+                        DailyObservations.ephid_hash,
+                    ],
+                    update={
+                        DailyObservations.ocount: DailyObservations.ocount
+                        + EXCLUDED.ocount,
+                        DailyObservations.srssi: DailyObservations.srssi
+                        + EXCLUDED.srssi,
+                    },
+                ).execute()
 
     def get_observations(self):
         """Return as an iterable the ephid hashes of all past observations."""
         query = DailyObservations.select(DailyObservations.ephid_hash)
         return map(lambda rec: rec.ephid_hash, query)
 
+    def get_observations_by_day(self):
+        """Return the ephid hashes of all past observations as a dictionary
+        mapping each day to a list of the day's ephid hashes."""
+        query = DailyObservations.select(
+            DailyObservations.day, DailyObservations.ephid_hash
+        )
+        observations = {}
+        for (day, ephid_hash) in query.tuples().iterator():
+            observations.setdefault(day, []).append(ephid_hash)
+        return observations
+
     def get_observation_details(self, ephid_hash):
         """Return the observation count and average RSSI for the specified ephid hash."""
         rec = DailyObservations.get(DailyObservations.ephid_hash == ephid_hash)
         return rec.ocount, rec.srssi / rec.ocount
 
+    def get_observations_to_check(self, generation):
+        """Return the observations not checked against the specified filter
+        generation, as a dictionary mapping the generation against which
+        they were last checked to a list of their ephid hashes.
+        Also return a row identifier that bounds these observations,
+        for passing to set_observations_checked."""
+        last_row = DailyObservations.select(fn.MAX(SQL("rowid"))).scalar() or 0
+        query = DailyObservations.select(
+            DailyObservations.checked_generation, DailyObservations.ephid_hash
+        ).where(
+            (DailyObservations.checked_generation != generation)
+            & (SQL("rowid") <= last_row)
+        )
+        to_check = {}
+        for (checked_generation, ephid_hash) in query.tuples().iterator():
+            to_check.setdefault(checked_generation, []).append(ephid_hash)
+        return to_check, last_row
+
+    def set_observations_matched(self, ephid_hashes, matched):
+        """Set whether the specified observations were found in the filter."""
+        for i in range(0, len(ephid_hashes), IN_CHUNK_SIZE):
+            DailyObservations.update(matched=matched).where(
+                DailyObservations.ephid_hash.in_(ephid_hashes[i : i + IN_CHUNK_SIZE])
+            ).execute()
+
+    def set_observations_checked(self, generation, last_row):
+        """Mark the observations up to the specified row identifier as
+        checked against the specified filter generation."""
+        DailyObservations.update(checked_generation=generation).where(
+            (DailyObservations.checked_generation != generation)
+            & (SQL("rowid") <= last_row)
+        ).execute()
+
+    def count_matched_observations(self):
+        """Return the number of observations found in the filter when they
+        were last checked."""
+        return DailyObservations.select().where(DailyObservations.matched).count()
+
     def delete_past_observations(self, last_retained_day):
         """Delete observations of past days."""
         query = DailyObservations.delete().where(
             DailyObservations.day < last_retained_day
         )
         query.execute()
+
+
+class ObservationBuffer:
+    """Aggregate observations in memory and add them to the client database
+    in batches, thereby avoiding a separate transaction for each one."""
+
+    def __init__(
+        self,
+        database,
+        max_size=OBSERVATION_BUFFER_SIZE,
+        flush_interval=OBSERVATION_FLUSH_INTERVAL,
+    ):
+        """Create a buffer for the specified ClientDatabase
+
+        Args:
+            database: The database where buffered observations are added
+            max_size: Number of distinct (day, ephid hash) entries that
+                cause the buffer to be flushed
+            flush_interval: Number of seconds after which buffered
+                observations are flushed
+        """
+        self.database = database
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.observations = {}
+        self.first_time = None
+
+    def __len__(self):
+        return len(self.observations)
+
+    def add_observation(self, day, ephid_hash, rssi):
+        """Buffer an observed ephid hash and its RSSI for the specified day.
+        Flush the buffer if it has become full or too old."""
+        key = (day, ephid_hash)
+        (ocount, srssi) = self.observations.get(key, (0, 0))
+        self.observations[key] = (ocount + 1, srssi + rssi)
+        if self.first_time is None:
+            self.first_time = time()
+        if len(self.observations) >= self.max_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush the buffer if it holds observations older than the
+        flush interval."""
+        if (
+            self.first_time is not None
+            and time() - self.first_time >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Add the buffered observations to the database."""
+        if not self.observations:
+            return
+        self.database.add_observations(self.observations)
+        # Only discard the observations after they have been stored
+        self.observations = {}
+        self.first_time = None
@@ -20,8 +20,10 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 import datetime
+import functools
 import hashlib
 import hmac
+from multiprocessing import Pool
 import secrets
 import random
 
@@ -47,6 +49,12 @@ BROADCAST_KEY = "broadcast key".encode("ascii")
 #: Length of a batch (2 hours)
 SECONDS_PER_BATCH = 2 * 60 * 60
 
+#: Number of day keys whose reconstructed EphIDs are kept for matching
+RECONSTRUCTION_CACHE_SIZE = 1024
+
+#: Number of (start time, key) pairs handed to a matching process at once
+MATCH_CHUNK_SIZE = 1000
+
 
 #########################
 ### UTILITY FUNCTIONS ###
@@ -111,16 +119,14 @@ def next_day_key(current_day_key):
     return hashlib.sha256(current_day_key).digest()
 
 
-def generate_ephids_for_day(current_day_key, shuffle=True):
-    """Generates the list of EphIDs for the current day
+def generate_packed_ephids_for_day(current_day_key):
+    """Generates the EphIDs for the current day packed together in order
 
     Args:
         key (byte array): A 32-byte key
-        shuffle (bool, optional): Whether to shuffle the list of EphIDs. Default: True.
-            Should only be set to False when testing or when generating test vectors
 
     Returns:
-        list of byte arrays: The list of EphIDs for the day
+        bytes: The day's EphIDs, LENGTH_EPHID bytes each
     """
 
     # Compute key for stream cipher based on current_day_key
@@ -133,7 +139,21 @@ def generate_ephids_for_day(current_day_key, shuffle=True):
     # Create the number of desired ephIDs by drawing from AES in CTR mode
     # operating a s a stream cipher. To get the raw output, we ask the library
     # to "encrypt" an all-zero message of sufficient length.
-    prg_output_bytes = prg.encrypt(bytes(LENGTH_EPHID * NUM_EPOCHS_PER_DAY))
+    return prg.encrypt(bytes(LENGTH_EPHID * NUM_EPOCHS_PER_DAY))
+
+
+def generate_ephids_for_day(current_day_key, shuffle=True):
+    """Generates the list of EphIDs for the current day
+
+    Args:
+        key (byte array): A 32-byte key
+        shuffle (bool, optional): Whether to shuffle the list of EphIDs. Default: True.
+            Should only be set to False when testing or when generating test vectors
+
+    Returns:
+        list of byte arrays: The list of EphIDs for the day
+    """
+    prg_output_bytes = generate_packed_ephids_for_day(current_day_key)
 
     ephids = [
         prg_output_bytes[idx : idx + LENGTH_EPHID]
@@ -147,6 +167,27 @@ def generate_ephids_for_day(current_day_key, shuffle=True):
     return ephids
 
 
+@functools.lru_cache(maxsize=RECONSTRUCTION_CACHE_SIZE)
+def matching_ephids_for_day(current_day_key):
+    """Return the set of EphIDs of the day with the given key
+
+    The EphIDs are only used for matching, so they are not shuffled.
+    As the day's key determines the EphIDs of a (key, day) pair, the
+    results are cached across the batches that publish the same key.
+
+    Args:
+        key (byte array): A 32-byte key
+
+    Returns:
+        frozenset of bytes: The day's EphIDs
+    """
+    prg_output_bytes = generate_packed_ephids_for_day(current_day_key)
+    return frozenset(
+        prg_output_bytes[idx : idx + LENGTH_EPHID]
+        for idx in range(0, len(prg_output_bytes), LENGTH_EPHID)
+    )
+
+
 #############################################################
 ### TYING CRYPTO FUNCTIONS TOGETHER FOR TRACING/RECORDING ###
 #############################################################
@@ -215,13 +256,13 @@ class ContactTracer:
             end_time (int): In seconds since UNIX epoch (does not have to be day aligned)
 
         Returns:
-            dictionary: For each day, start_date <= day <= end_date, a list of EphIDs
+            dictionary: For each day, start_date <= day <= end_date, a set of EphIDs
         """
         day = start_time
 
         ephids_per_day = {}
         while day <= end_time:
-            ephids_per_day[day] = generate_ephids_for_day(key)
+            ephids_per_day[day] = matching_ephids_for_day(key)
 
             key = next_day_key(key)
             day += SECONDS_PER_DAY
@@ -237,7 +278,8 @@ class ContactTracer:
         """
         self.past_keys = []
 
-        # For each day, a list of observed EphIDs
+        # For each batch or day, the set of observed EphIDs.  Sets do not
+        # record the receive order, so they need not be shuffled.
         self.observations = {}
 
         if start_time is None:
@@ -292,7 +334,7 @@ class ContactTracer:
         return self.current_ephids[epoch]
 
     def add_observation(self, ephid, time):
-        """Add ephID to list of observations. Time must correspond to the current day
+        """Add ephID to set of observations. Time must correspond to the current day
 
         Initially observations are stored with a receive time that has batch
         granularity. This enables us to verify whether an observation occurred
@@ -317,11 +359,8 @@ class ContactTracer:
             raise ValueError("Observation must correspond to current day")
 
         if batch_start not in self.observations:
-            self.observations[batch_start] = []
-        self.observations[batch_start].append(ephid)
-
-        # Shuffle observations to hide receive order
-        secure_shuffle(self.observations[batch_start])
+            self.observations[batch_start] = set()
+        self.observations[batch_start].add(ephid)
 
     def get_tracing_information(
         self,
@@ -389,38 +428,24 @@ class ContactTracer:
             int: How many epochs we saw EphIDs of the infected person
         """
 
-        ephids_per_day = self._reconstruct_ephids(key, start_time, release_time)
-
-        nr_encounters = 0
+        return _count_matches(self.observations, key, start_time, release_time)
 
-        for time in self.observations:
-            # Ignore observations on or after publication time of the key
-            if time >= release_time:
-                continue
-
-            # Get start of the day corresponding to the time
-            day = (time // SECONDS_PER_DAY) * SECONDS_PER_DAY
-
-            # Skip if we don't have corresponding observations
-            if day not in ephids_per_day:
-                continue
-
-            for ephid in ephids_per_day[day]:
-                if ephid in self.observations[time]:
-                    nr_encounters += 1
-
-        return nr_encounters
-
-    def matches_with_batch(self, batch):
+    def matches_with_batch(self, batch, jobs=1):
         """Count #contacts with each infected person in batch
 
         Args:
             batch (`obj`:TracingDataBatch): A batch of tracing keys
+            jobs (int, optional): Number of processes to use for matching
+                the keys (default 1).  The result is the same as that of
+                matching them in a single process.
 
         Returns:
             int: How many EphIDs of infected persons we saw
         """
 
+        if jobs > 1:
+            return self._parallel_matches(batch, jobs)
+
         seen_infected_ephids = 0
         release_time = batch.release_time
 
@@ -429,6 +454,20 @@ class ContactTracer:
 
         return seen_infected_ephids
 
+    def _parallel_matches(self, batch, jobs):
+        """Count #contacts with each infected person in batch using the
+        specified number of processes.
+        Each process obtains a snapshot of the observations when it starts,
+        and matches with them chunks of the batch's keys."""
+        chunks = [
+            batch.time_key_pairs[i : i + MATCH_CHUNK_SIZE]
+            for i in range(0, len(batch.time_key_pairs), MATCH_CHUNK_SIZE)
+        ]
+        with Pool(
+            jobs, _init_match_worker, (self.observations, batch.release_time)
+        ) as pool:
+            return sum(pool.imap_unordered(_match_chunk, chunks))
+
     def housekeeping_after_batch(self, batch):
         """Update stored observations after processing batch.
 
@@ -457,9 +496,49 @@ class ContactTracer:
             day_time = (time // SECONDS_PER_DAY) * SECONDS_PER_DAY
 
             if day_time not in self.observations:
-                self.observations[day_time] = []
+                self.observations[day_time] = set()
+
+            self.observations[day_time].update(observations)
+
+
+def _count_matches(observations, key, start_time, release_time):
+    """Count the EphIDs of the infected person with the given day key
+    that appear in the specified observations.
+    See :func:`ContactTracer.matches_with_key`."""
+
+    ephids_per_day = ContactTracer._reconstruct_ephids(key, start_time, release_time)
+
+    nr_encounters = 0
+
+    for time in observations:
+        # Ignore observations on or after publication time of the key
+        if time >= release_time:
+            continue
+
+        # Get start of the day corresponding to the time
+        day = (time // SECONDS_PER_DAY) * SECONDS_PER_DAY
+
+        # Skip if we don't have corresponding observations
+        if day not in ephids_per_day:
+            continue
+
+        nr_encounters += len(ephids_per_day[day].intersection(observations[time]))
+
+    return nr_encounters
+
+
+def _init_match_worker(observations, release_time):
+    """Initialize a matching worker process with the observations to
+    match and the release time of the matched batch."""
+    global _worker_observations, _worker_release_time
+    _worker_observations = observations
+    _worker_release_time = release_time
 
-            self.observations[day_time].extend(observations)
 
-            # Reshuffle to make sure we do not store ordering data
-            secure_shuffle(self.observations[day_time])
+def _match_chunk(time_key_pairs):
+    """Return the number of contacts with the infected persons of the
+    specified (start time, key) pairs."""
+    return sum(
+        _count_matches(_worker_observations, key, start_time, _worker_release_time)
+        for (start_time, key) in time_key_pairs
+    )
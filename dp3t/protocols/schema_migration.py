@@ -0,0 +1,43 @@
+"""
+Schema migration of existing DP3T client and server databases
+"""
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from playhouse.migrate import SqliteMigrator, migrate
+
+
+def add_missing_fields(db, fields):
+    """Add to the tables of the specified existing SQLite database those of
+    the given fields, introduced after it was created, that it lacks."""
+    missing = [
+        field
+        for field in fields
+        if field.column_name
+        not in {c.name for c in db.get_columns(field.model._meta.table_name)}
+    ]
+    if missing:
+        migrator = SqliteMigrator(db)
+        migrate(
+            *[
+                migrator.add_column(
+                    field.model._meta.table_name, field.column_name, field
+                )
+                for field in missing
+            ]
+        )
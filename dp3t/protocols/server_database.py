@@ -19,14 +19,21 @@ __copyright__ = """
 """
 __license__ = "Apache 2.0"
 
-from dp3t.protocols.unlinkable import epoch_from_time
+from dp3t.config import NUM_EPOCHS_PER_DAY
+from dp3t.protocols.unlinkable import epoch_from_time, hashed_observation_from_seed
+
+from dp3t.protocols.schema_migration import add_missing_fields
+from dp3t.protocols.storage_profile import storage_pragmas
 
 from peewee import (
     BigIntegerField,
     BlobField,
+    IntegerField,
     Model,
     SqliteDatabase,
+    chunked,
 )
+from playhouse.sqlite_ext import AutoIncrementField
 
 #################################
 ### GLOBAL PROTOCOL CONSTANTS ###
@@ -43,25 +50,85 @@ class BaseModel(Model):
 class ContagiousIds(BaseModel):
     """Epochs and seeds associated with contabious users."""
 
+    # Identifiers are never reused, so that the records added after a
+    # given one can be found even when the newest ones have been deleted
+    id = AutoIncrementField()
     epoch = BigIntegerField(index=True)
     seed = BlobField()
+    # Hashed observation of the epoch and seed, computed when they are
+    # added, so that filters can be built without hashing; records added
+    # by earlier versions lack it
+    hashed_observation = BlobField(null=True)
+
+
+class IngestState(BaseModel):
+    """Position up to which the ingest spool has been committed."""
+
+    singleton = IntegerField(default=1, primary_key=True)
+    # Identifier of the spool file
+    spool_id = BlobField()
+    # Offset in the spool file of the first uncommitted upload
+    spool_offset = BigIntegerField()
 
 
 # Available tables
-MODELS = [ContagiousIds]
+MODELS = [ContagiousIds, IngestState]
+
+# Fields added after the initial release, which may be missing from
+# existing databases
+ADDED_FIELDS = [ContagiousIds.hashed_observation]
+
+# Number of rows inserted by a single multi-row INSERT statement, kept
+# within the default SQLite limit of 999 bound variables
+INSERT_CHUNK_SIZE = 300
+
+
+def _hashed_observation(epoch, seed):
+    """Return the hashed observation of the specified epoch and seed,
+    as the seed is stored in the database."""
+    return hashed_observation_from_seed(bytes(ContagiousIds.seed.db_value(seed)), epoch)
 
 
 class ServerDatabase:
     """Simple reference implementation of the server database."""
 
-    def __init__(self, db_path=":memory:"):
-        """Setup the database access and schema."""
+    def __init__(self, db_path=":memory:", storage_profile=None):
+        """Setup the database access and schema.
+        The storage profile specifies the SQLite settings to use,
+        as described in storage_profile.storage_pragmas."""
 
         # Deferred initialization
-        db.init(db_path)
+        db.init(db_path, pragmas=storage_pragmas(storage_profile))
 
         # Create schema if needed
         db.create_tables(MODELS)
+        add_missing_fields(db, ADDED_FIELDS)
+        self._make_ids_monotonic()
+
+    def _make_ids_monotonic(self):
+        """Recreate the contagious identifiers table of a database created
+        by an earlier version, so that SQLite never reuses the identifiers
+        of deleted records."""
+        table = ContagiousIds._meta.table_name
+        (sql,) = db.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table,),
+        ).fetchone()
+        if "AUTOINCREMENT" in sql.upper():
+            return
+        columns = ", ".join(f'"{c.name}"' for c in db.get_columns(table))
+        with db.atomic():
+            # The indexes keep their names when the table is renamed
+            for index in db.get_indexes(table):
+                if index.sql:
+                    db.execute_sql(f'DROP INDEX "{index.name}"')
+            db.execute_sql(f'ALTER TABLE "{table}" RENAME TO "{table}_old"')
+            db.create_tables([ContagiousIds])
+            db.execute_sql(
+                f'INSERT INTO "{table}" ({columns}) '
+                f'SELECT {columns} FROM "{table}_old"'
+            )
+            db.execute_sql(f'DROP TABLE "{table}_old"')
 
     def connect(self, reuse_if_open=False):
         """Connect to the underlying database. Return whether a new connection
@@ -93,9 +160,101 @@ class ServerDatabase:
 
     def get_epoch_seeds_tuple(self):
         """Return a tuple of epochs and seeds."""
+        return self._epoch_seeds_tuple(self.get_epoch_seeds())
+
+    def get_last_id(self):
+        """Return the identifier of the most recently added record,
+        or 0 if no records have been added.  As identifiers are not reused,
+        this does not decrease when records are deleted."""
+        row = db.execute_sql(
+            "SELECT seq FROM sqlite_sequence WHERE name = ?",
+            (ContagiousIds._meta.table_name,),
+        ).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _new_records(after_id, last_id):
+        """Return the condition selecting the records added after the
+        record after_id up to and including the record last_id."""
+        return (ContagiousIds.id > after_id) & (ContagiousIds.id <= last_id)
+
+    @staticmethod
+    def _expired_records(last_retained_day):
+        """Return the condition selecting the records that
+        delete_expired_data would delete."""
+        return ContagiousIds.epoch < epoch_from_time(last_retained_day)
+
+    @staticmethod
+    def _day_records(day):
+        """Return the condition selecting the records whose epochs belong
+        to the specified day (see unlinkable.day_from_epoch)."""
+        return ContagiousIds.epoch.between(
+            day * NUM_EPOCHS_PER_DAY, (day + 1) * NUM_EPOCHS_PER_DAY - 1
+        )
+
+    def get_new_days(self, after_id, last_id):
+        """Return the set of days (see unlinkable.day_from_epoch) of the
+        records added after the record after_id up to and including
+        the record last_id."""
+        query = (
+            ContagiousIds.select(ContagiousIds.epoch / NUM_EPOCHS_PER_DAY)
+            .where(self._new_records(after_id, last_id))
+            .distinct()
+        )
+        return {day for (day,) in query.tuples()}
+
+    def get_expired_days(self, last_retained_day):
+        """Return the set of days (see unlinkable.day_from_epoch) of the
+        records that delete_expired_data would delete."""
+        query = (
+            ContagiousIds.select(ContagiousIds.epoch / NUM_EPOCHS_PER_DAY)
+            .where(self._expired_records(last_retained_day))
+            .distinct()
+        )
+        return {day for (day,) in query.tuples()}
+
+    def get_new_hashed_observations(self, after_id, last_id, last_retained_day=None):
+        """Return a list of the hashed observations of the records added
+        after the record after_id up to and including the record last_id.
+        If last_retained_day is specified, leave out the records that
+        delete_expired_data would delete."""
+        condition = self._new_records(after_id, last_id)
+        if last_retained_day is not None:
+            condition &= ~self._expired_records(last_retained_day)
+        return self._hashed_observations(condition)
+
+    def get_expired_hashed_observations(self, last_retained_day, last_id):
+        """Return a list of the hashed observations of the records up to
+        and including the record last_id that delete_expired_data
+        would delete."""
+        return self._hashed_observations(
+            self._expired_records(last_retained_day) & (ContagiousIds.id <= last_id)
+        )
+
+    def get_day_hashed_observations(self, day):
+        """Return a list of the hashed observations of the records whose
+        epochs belong to the specified day (see unlinkable.day_from_epoch)."""
+        return self._hashed_observations(self._day_records(day))
+
+    @staticmethod
+    def _hashed_observations(condition):
+        """Return a list of the hashed observations of the records
+        satisfying the specified condition.  These are computed for
+        records that lack them."""
+        query = ContagiousIds.select(
+            ContagiousIds.epoch, ContagiousIds.seed, ContagiousIds.hashed_observation
+        ).where(condition)
+        return [
+            ho if ho is not None else hashed_observation_from_seed(seed, epoch)
+            for (epoch, seed, ho) in query.tuples().iterator()
+        ]
+
+    @staticmethod
+    def _epoch_seeds_tuple(records):
+        """Return a tuple of epochs and seeds from an (epoch, seed) iterable."""
         epochs = []
         seeds = []
-        for (epoch, seed) in self.get_epoch_seeds():
+        for (epoch, seed) in records:
             epochs.append(epoch)
             seeds.append(seed)
         return (epochs, seeds)
@@ -103,7 +262,42 @@ class ServerDatabase:
     def add_epoch_seed(self, epoch, seed):
         """Add contagious user's epoch and seed.
         """
-        ContagiousIds.create(epoch=epoch, seed=seed)
+        ContagiousIds.create(
+            epoch=epoch, seed=seed, hashed_observation=_hashed_observation(epoch, seed)
+        )
+
+    def add_epoch_seeds(self, epochs, seeds):
+        """Add contagious users' epochs and the corresponding seeds, together
+        with their hashed observations, in batches.
+        The caller should wrap this in a transaction."""
+        rows = (
+            (epoch, seed, _hashed_observation(epoch, seed))
+            for (epoch, seed) in zip(epochs, seeds)
+        )
+        fields = [
+            ContagiousIds.epoch,
+            ContagiousIds.seed,
+            ContagiousIds.hashed_observation,
+        ]
+        for batch in chunked(rows, INSERT_CHUNK_SIZE):
+            ContagiousIds.insert_many(batch, fields=fields).execute()
+
+    def get_spool_position(self):
+        """Return a tuple with the identifier of the ingest spool and
+        the offset up to which it has been committed, or (None, 0) if no
+        spool has been committed."""
+        state = IngestState.get_or_none(IngestState.singleton == 1)
+        if state is None:
+            return (None, 0)
+        return (bytes(state.spool_id), state.spool_offset)
+
+    def set_spool_position(self, spool_id, offset):
+        """Record the identifier of the ingest spool and the offset up to
+        which it has been committed.  Call this in the transaction that
+        adds the committed data."""
+        IngestState.replace(
+            singleton=1, spool_id=spool_id, spool_offset=offset
+        ).execute()
 
     def delete_expired_data(self, last_retained_day):
         """Delete contagious user data that has expired."""
@@ -0,0 +1,81 @@
+"""
+SQLite storage profiles for the DP3T client and server databases
+"""
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+#: Settings that a storage profile can specify
+PROFILE_SETTINGS = [
+    "journal_mode",
+    "synchronous",
+    "cache_size",
+    "mmap_size",
+    "busy_timeout",
+]
+
+#: Predefined storage profiles, mapping their names to SQLite pragma values.
+#: Negative cache sizes are in KiB, mmap sizes in bytes, timeouts in ms.
+STORAGE_PROFILES = {
+    # SQLite's defaults: rollback journal and full synchronization
+    "default": {},
+    # Device: concurrent daemons, slow writes, and little memory.
+    # With WAL normal synchronization can only lose the last transactions
+    # on power loss, but cannot corrupt the database.
+    "sdcard": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -2048,
+        "mmap_size": 16 * 1024 * 1024,
+        "busy_timeout": 5000,
+    },
+    # Back end: concurrent web server and filter builder, ample memory
+    "server": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 10000,
+    },
+}
+
+
+def storage_pragmas(spec):
+    """Return the list of (pragma, value) tuples corresponding to the
+    specified storage profile.  The profile is specified as the name of
+    a predefined one, optionally followed by comma-separated setting=value
+    overrides, e.g. "sdcard,synchronous=full,cache_size=-4096".
+    A spec of None corresponds to the default profile.
+    Raise ValueError if the specification is not valid."""
+    if spec is None:
+        return []
+    (name, *overrides) = spec.split(",")
+    if name not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile {name}")
+    settings = dict(STORAGE_PROFILES[name])
+    for override in overrides:
+        (setting, sep, value) = override.partition("=")
+        if setting not in PROFILE_SETTINGS or not sep or not value:
+            raise ValueError(f"Invalid storage profile setting {override}")
+        settings[setting] = int(value) if value.lstrip("-").isdigit() else value
+    return list(settings.items())
+
+
+def storage_profile(spec):
+    """Argument parser type function for storage profile specifications."""
+    storage_pragmas(spec)
+    return spec
@@ -21,11 +21,18 @@ __license__ = "Apache 2.0"
 
 import hashlib
 import secrets
+import struct
 import datetime
 
 from cuckoo.filter import CuckooFilter
 
-from dp3t.config import RETENTION_PERIOD, EPOCH_LENGTH, NUM_EPOCHS_PER_DAY, LENGTH_EPHID
+from dp3t.config import (
+    RETENTION_PERIOD,
+    EPOCH_LENGTH,
+    NUM_EPOCHS_PER_DAY,
+    LENGTH_EPHID,
+    LENGTH_SEED,
+)
 
 
 #################################
@@ -35,6 +42,12 @@ from dp3t.config import RETENTION_PERIOD, EPOCH_LENGTH, NUM_EPOCHS_PER_DAY, LENG
 #: FPR for CuckooFilter
 CUCKOO_FPR = 2 ** -42
 
+#: Length of a hashed observation in bytes
+LENGTH_HASHED_OBSERVATION = 32
+
+#: Encoding of the epoch number in a hashed observation
+EPOCH_ENCODING = struct.Struct(">I")
+
 
 #########################
 ### UTILITY FUNCTIONS ###
@@ -52,6 +65,38 @@ def epoch_from_time(time):
     return int(time.timestamp() // (EPOCH_LENGTH * 60))
 
 
+def seconds_to_next_epoch(time):
+    """Compute the number of seconds from the given time to the start of
+    the next epoch
+
+    Args:
+        time (:obj:`datetime`): A date-time instance
+    """
+    return (epoch_from_time(time) + 1) * EPOCH_LENGTH * 60 - time.timestamp()
+
+
+def day_from_epoch(epoch):
+    """Compute the number of the (UTC) day containing the given epoch
+
+    Days are counted from the start of the UNIX Epoch.  Filters sharded by
+    day hold in each shard the hashed observations of one such day.
+
+    Args:
+        epoch: An epoch number, as returned by epoch_from_time
+    """
+    return epoch // NUM_EPOCHS_PER_DAY
+
+
+def split_batch(batch, item_length):
+    """Return a list of the items packed one after the other in batch
+
+    Args:
+        batch (byte array): Items of the same length packed together
+        item_length: The length of each item in bytes
+    """
+    return [batch[i : i + item_length] for i in range(0, len(batch), item_length)]
+
+
 #########################################
 ### BASIC CRYPTOGRAPHIC FUNCTIONALITY ###
 #########################################
@@ -59,7 +104,12 @@ def epoch_from_time(time):
 
 def generate_new_seed():
     """Return a fresh random seed"""
-    return secrets.token_bytes(32)
+    return secrets.token_bytes(LENGTH_SEED)
+
+
+def generate_new_seeds(count):
+    """Return the specified number of fresh random seeds packed together"""
+    return secrets.token_bytes(count * LENGTH_SEED)
 
 
 def ephid_from_seed(seed):
@@ -103,6 +153,91 @@ def hashed_observation_from_seed(seed, epoch):
     return hashed_observation_from_ephid(ephid, epoch)
 
 
+def ephids_from_seeds(seeds):
+    """Compute the EphIDs of a batch of seeds
+
+    See :func:`ephid_from_seed`
+
+    Args:
+        seeds (byte array): 32-byte seeds packed together
+
+    Returns:
+        bytes: The corresponding EphIDs packed together
+
+    Raises:
+        ValueError: If the batch does not consist of whole seeds
+    """
+    if len(seeds) % LENGTH_SEED:
+        raise ValueError("Seed batch length is not a multiple of the seed length")
+    seeds = bytes(seeds)
+    sha256 = hashlib.sha256
+    return b"".join(
+        [
+            sha256(seeds[i : i + LENGTH_SEED]).digest()[:LENGTH_EPHID]
+            for i in range(0, len(seeds), LENGTH_SEED)
+        ]
+    )
+
+
+def hashed_observations_from_ephids(ephids, epochs):
+    """Compute the hashed observations of a batch of EphIDs
+
+    See :func:`hashed_observation_from_ephid`
+
+    Args:
+        ephids (byte array): The observed EphIDs packed together
+        epochs: The epoch of each EphID's observation
+
+    Returns:
+        bytes: The corresponding hashed observations packed together
+
+    Raises:
+        ValueError: If the number of EphIDs differs from that of the epochs
+    """
+    if len(ephids) != len(epochs) * LENGTH_EPHID:
+        raise ValueError("EphID batch does not match the number of epochs")
+    ephids = bytes(ephids)
+    sha256 = hashlib.sha256
+    pack_epoch = EPOCH_ENCODING.pack
+    return b"".join(
+        [
+            sha256(ephids[i : i + LENGTH_EPHID] + pack_epoch(epoch)).digest()
+            for (i, epoch) in zip(range(0, len(ephids), LENGTH_EPHID), epochs)
+        ]
+    )
+
+
+def hashed_observations_from_seeds(seeds, epochs):
+    """Compute the hashed observations of a batch of seeds and epochs
+
+    See :func:`hashed_observation_from_seed`
+
+    Args:
+        seeds (byte array): 32-byte seeds packed together
+        epochs: The epoch of each seed
+
+    Returns:
+        bytes: The corresponding hashed observations packed together
+
+    Raises:
+        ValueError: If the number of seeds differs from that of the epochs
+    """
+    if len(seeds) != len(epochs) * LENGTH_SEED:
+        raise ValueError("Seed batch does not match the number of epochs")
+    seeds = bytes(seeds)
+    sha256 = hashlib.sha256
+    pack_epoch = EPOCH_ENCODING.pack
+    return b"".join(
+        [
+            sha256(
+                sha256(seeds[i : i + LENGTH_SEED]).digest()[:LENGTH_EPHID]
+                + pack_epoch(epoch)
+            ).digest()
+            for (i, epoch) in zip(range(0, len(seeds), LENGTH_SEED), epochs)
+        ]
+    )
+
+
 #############################################################
 ### TYING CRYPTO FUNCTIONS TOGETHER FOR TRACING/RECORDING ###
 #############################################################
@@ -137,10 +272,13 @@ class TracingDataBatch:
 
         self.infected_observations = CuckooFilter(capacity, error_rate=CUCKOO_FPR)
         for (epochs, seeds) in tracing_seeds:
-            for (epoch, seed) in zip(epochs, seeds):
-                self.infected_observations.insert(
-                    hashed_observation_from_seed(seed, epoch)
-                )
+            hashed_observations = hashed_observations_from_seeds(
+                b"".join(seeds), epochs
+            )
+            for hashed_observation in split_batch(
+                hashed_observations, LENGTH_HASHED_OBSERVATION
+            ):
+                self.infected_observations.insert(hashed_observation)
 
         self.release_time = release_time
 
@@ -200,8 +338,9 @@ class ContactTracer:
         """Compute a new set of seeds and ephids for a new day"""
 
         # Generate fresh seeds and store them
-        seeds = [generate_new_seed() for _ in range(NUM_EPOCHS_PER_DAY)]
-        ephids = [ephid_from_seed(seed) for seed in seeds]
+        packed_seeds = generate_new_seeds(NUM_EPOCHS_PER_DAY)
+        seeds = split_batch(packed_seeds, LENGTH_SEED)
+        ephids = split_batch(ephids_from_seeds(packed_seeds), LENGTH_EPHID)
 
         # Convert to epoch numbers
         first_epoch = epoch_from_time(self.start_of_today)
@@ -20,24 +20,42 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 from datetime import datetime, timedelta
+import mmap
+from multiprocessing import Pool
+import zlib
 
 from bitarray import bitarray
 
-from cuckoo.filter import BCuckooFilter
+import mmh3
 
-from dp3t.config import RETENTION_PERIOD, NUM_EPOCHS_PER_DAY
+from cuckoo.filter import BCuckooFilter, CuckooTemplate
 
-from dp3t.protocols.client_database import ClientDatabase
+from dp3t.config import RETENTION_PERIOD, NUM_EPOCHS_PER_DAY, LENGTH_EPHID, LENGTH_SEED
+
+from dp3t.protocols.client_database import (
+    ClientDatabase,
+    OBSERVATION_FLUSH_INTERVAL,
+    ObservationBuffer,
+)
 
 from dp3t.protocols.unlinkable import (
     CUCKOO_FPR,
-    ephid_from_seed,
+    LENGTH_HASHED_OBSERVATION,
+    day_from_epoch,
+    ephids_from_seeds,
     epoch_from_time,
-    generate_new_seed,
+    generate_new_seeds,
     hashed_observation_from_ephid,
-    hashed_observation_from_seed,
+    hashed_observations_from_seeds,
+    split_batch,
 )
 
+#: Number of (epoch, seed) pairs handed to a filter building process at once
+BUILD_CHUNK_SIZE = 10000
+
+#: Number of compressed bytes read at once when loading a compressed filter
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
 #############################################################
 ### TYING CRYPTO FUNCTIONS TOGETHER FOR TRACING/RECORDING ###
 #############################################################
@@ -49,6 +67,129 @@ def day_timestamp(date):
     return int(datetime.combine(date, datetime.min.time()).timestamp())
 
 
+def observation_shard_days(day):
+    """Return the range of the days (see day_from_epoch) whose filter shards
+    may hold observations recorded for the day starting at the specified
+    Unix timestamp (see day_timestamp).  As the recorded days follow the
+    local time zone, an observation can belong to one of two UTC days."""
+    start = datetime.fromtimestamp(day)
+    end = datetime.fromtimestamp(day_timestamp(start.date() + timedelta(days=1)))
+    first_epoch = epoch_from_time(start)
+    last_epoch = epoch_from_time(end) - 1
+    return range(day_from_epoch(first_epoch), day_from_epoch(last_epoch) + 1)
+
+
+# Filter geometry used by the filter building worker processes
+_worker_template = None
+
+
+def _init_build_worker(capacity):
+    """Initialize a filter building worker process for a filter of the
+    specified capacity."""
+    global _worker_template
+    # The template provides the filter's hash functions without allocating
+    # its bucket array
+    _worker_template = CuckooTemplate(capacity, error_rate=CUCKOO_FPR)
+
+
+def _hash_build_chunk(pairs):
+    """Return for each of the specified (epoch, seed) pairs a tuple with the
+    hashed observation, its fingerprint, and its candidate bucket indices."""
+    result = []
+    hashed_observations = hashed_observations_from_seeds(
+        b"".join([seed for (_, seed) in pairs]), [epoch for (epoch, _) in pairs]
+    )
+    for ho in split_batch(hashed_observations, LENGTH_HASHED_OBSERVATION):
+        fingerprint = _worker_template.fingerprint(ho)
+        indices = list(_worker_template.indices(ho, fingerprint))
+        result.append((ho, fingerprint, indices))
+    return result
+
+
+def _tracing_hashed_observations(tracing_seeds):
+    """Return a generator of the hashed observations corresponding to
+    the specified [(reported_epochs, seeds)] list."""
+    for (epochs, seeds) in tracing_seeds:
+        yield from split_batch(
+            hashed_observations_from_seeds(b"".join(seeds), epochs),
+            LENGTH_HASHED_OBSERVATION,
+        )
+
+
+def _build_chunks(tracing_seeds):
+    """Return a generator of the (epoch, seed) pairs in tracing_seeds
+    split into lists of at most BUILD_CHUNK_SIZE elements."""
+    chunk = []
+    for (epochs, seeds) in tracing_seeds:
+        for pair in zip(epochs, seeds):
+            chunk.append(pair)
+            if len(chunk) == BUILD_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _unallocated_filter(capacity):
+    """Return a Cuckoo filter of the specified capacity whose parameters
+    are initialized without allocating its buckets."""
+    cuckoo_filter = BCuckooFilter.__new__(BCuckooFilter)
+    CuckooTemplate.__init__(cuckoo_filter, capacity, error_rate=CUCKOO_FPR)
+    return cuckoo_filter
+
+
+def buckets_size(capacity):
+    """Return the number of bytes in the bucket array of a filter of the
+    specified capacity."""
+    cuckoo_filter = _unallocated_filter(capacity)
+    nbits = capacity * cuckoo_filter.bucket_size * cuckoo_filter.fingerprint_size
+    return (nbits + 7) // 8
+
+
+def _mapped_filter(fh, capacity):
+    """Return a read-only Cuckoo filter of the specified capacity whose
+    buckets are the contents of the file object fh, from its current
+    position onward, mapped into memory."""
+    cuckoo_filter = _unallocated_filter(capacity)
+    start = fh.tell()
+    end = start + buckets_size(capacity)
+    mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapping) < end:
+        raise ValueError("Filter file is smaller than its capacity")
+    # The bit array keeps the mapping alive after the file is closed
+    cuckoo_filter.buckets = bitarray(buffer=memoryview(mapping)[start:end])
+    return cuckoo_filter
+
+
+def _decompressed_filter(fh, capacity):
+    """Return a Cuckoo filter of the specified capacity whose buckets are
+    the zlib-compressed contents of the file object fh, from its current
+    position onward.
+    The data are decompressed as they are read directly into the filter's
+    bucket array, without holding a complete copy of them."""
+    cuckoo_filter = BCuckooFilter(capacity, error_rate=CUCKOO_FPR)
+    buckets = memoryview(cuckoo_filter.buckets)
+    size = len(buckets)
+    decompressor = zlib.decompressobj()
+    position = 0
+    while not decompressor.eof:
+        data = decompressor.unconsumed_tail or fh.read(DECOMPRESS_CHUNK_SIZE)
+        if not data:
+            raise ValueError("Compressed filter is truncated")
+        try:
+            # Obtaining one byte more than needed detects oversized filters
+            out = decompressor.decompress(data, size - position + 1)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed filter: {e}")
+        if position + len(out) > size:
+            raise ValueError("Compressed filter is larger than its capacity")
+        buckets[position : position + len(out)] = out
+        position += len(out)
+    if position != size:
+        raise ValueError("Compressed filter is smaller than its capacity")
+    return cuckoo_filter
+
+
 class TracingDataBatch:
     """
     Simple representation of a batch of keys that is downloaded from
@@ -63,7 +204,17 @@ class TracingDataBatch:
     well-specified version of such a cuckoo filter.
     """
 
-    def __init__(self, tracing_seeds=None, release_time=None, fh=None, capacity=None):
+    def __init__(
+        self,
+        tracing_seeds=None,
+        release_time=None,
+        fh=None,
+        capacity=None,
+        jobs=1,
+        mapped=False,
+        compressed=False,
+        hashed_observations=None,
+    ):
         """Create a published batch of tracing keys
 
         Args:
@@ -72,15 +223,35 @@ class TracingDataBatch:
             release_time (optional): Release time of this batch
             fh (optional): A file object from which to read the filter
             capacity (optional): The filter's capacity when read from file
-
-            Either tracing seeds or a file object and its capacity must be
-            specified.
+            jobs (optional): Number of processes to use for hashing the
+                tracing seeds (default 1).  The resulting filter is the
+                same as the one built by a single process.
+            mapped (optional): When reading the filter from a file, map it
+                into memory rather than reading it (default False).
+                The resulting filter cannot be modified.
+            compressed (optional): The filter read from the file is
+                compressed with zlib (default False).  It is decompressed
+                as it is read, and cannot be mapped into memory.
+            hashed_observations (optional): A list of precomputed hashed
+                observations of infected users, which are inserted without
+                any further hashing
+
+            Either tracing seeds, hashed observations, or a file object and
+            its capacity must be specified.
         """
 
-        if tracing_seeds and fh:
-            raise ValueError("Must specify only one of tracing_seeds or file")
+        if sum(x is not None for x in (tracing_seeds, fh, hashed_observations)) > 1:
+            raise ValueError(
+                "Must specify only one of tracing_seeds, hashed_observations, or file"
+            )
 
-        if tracing_seeds:
+        if hashed_observations is not None:
+            self.capacity = (int(len(hashed_observations) * 1.2) // 8 + 1) * 8
+            self.infected_observations = BCuckooFilter(
+                self.capacity, error_rate=CUCKOO_FPR
+            )
+            self.insert_hashed_observations(hashed_observations)
+        elif tracing_seeds:
             # Compute size of filter and ensure we have enough capacity
             nr_items = sum([len(epochs) for (epochs, _) in tracing_seeds])
             # Make capacity a multiple of 8 to make loaded size equal to saved
@@ -89,25 +260,210 @@ class TracingDataBatch:
             self.infected_observations = BCuckooFilter(
                 self.capacity, error_rate=CUCKOO_FPR
             )
-            for (epochs, seeds) in tracing_seeds:
-                for (epoch, seed) in zip(epochs, seeds):
-                    ho = hashed_observation_from_seed(seed, epoch)
-                    self.infected_observations.insert(ho)
+            if jobs > 1:
+                self._parallel_insert(tracing_seeds, jobs)
+            else:
+                self.insert_seeds(tracing_seeds)
         elif fh:
             if not capacity:
                 raise ValueError("Must specify capacity associated with the file")
-            self.infected_observations = BCuckooFilter(capacity, error_rate=CUCKOO_FPR)
-            read_filter = bitarray(0)
-            read_filter.fromfile(fh)
-            # Replace existing buckets with the bit array read from disk
-            # This is based on the current implementation of CBucketFile
-            # TODO: Submit a pull request to make this part of its API
-            self.infected_observations.buckets = read_filter
+            self.capacity = capacity
+            if compressed:
+                if mapped:
+                    raise ValueError("A compressed filter cannot be mapped")
+                self.infected_observations = _decompressed_filter(fh, capacity)
+            elif mapped:
+                self.infected_observations = _mapped_filter(fh, capacity)
+            else:
+                self.infected_observations = BCuckooFilter(
+                    capacity, error_rate=CUCKOO_FPR
+                )
+                read_filter = bitarray(0)
+                read_filter.fromfile(fh)
+                # Replace existing buckets with the bit array read from disk
+                # This is based on the current implementation of CBucketFile
+                # TODO: Submit a pull request to make this part of its API
+                self.infected_observations.buckets = read_filter
         else:
-            raise ValueError("Must specify at least one of tracing_seeds or file")
+            raise ValueError(
+                "Must specify at least one of tracing_seeds, hashed_observations, "
+                "or file"
+            )
 
         self.release_time = release_time
 
+        # Generation of a published filter, if known, and the indices of
+        # the buckets that changed when creating each known generation
+        self.generation = None
+        self.changed_buckets = {}
+
+    def insert_seeds(self, tracing_seeds):
+        """Insert into the filter the hashed observations corresponding to
+        the specified [(reported_epochs, seeds)] list.
+
+        Raises:
+            CapacityException: If the filter has no space for an observation
+        """
+        self.insert_hashed_observations(_tracing_hashed_observations(tracing_seeds))
+
+    def insert_hashed_observations(self, hashed_observations):
+        """Insert into the filter the specified hashed observations.
+
+        Raises:
+            CapacityException: If the filter has no space for an observation
+        """
+        for ho in hashed_observations:
+            self.infected_observations.insert(ho)
+
+    def delete_hashed_observations(self, hashed_observations):
+        """Delete from the filter the specified hashed observations.
+        Return the number of observations that were not found in the filter.
+        """
+        not_found = 0
+        for ho in hashed_observations:
+            if not self.infected_observations.delete(ho):
+                not_found += 1
+        return not_found
+
+    def _parallel_insert(self, tracing_seeds, jobs):
+        """Insert the tracing seeds into the filter using the specified
+        number of processes.
+        The processes compute the hashed observations, their fingerprints,
+        and their bucket indices.  The fingerprints are then placed into
+        the buckets in the original order, so that the filter's contents are
+        the same as those of a serially built one."""
+        f = self.infected_observations
+        with Pool(jobs, _init_build_worker, (self.capacity,)) as pool:
+            for chunk in pool.imap(_hash_build_chunk, _build_chunks(tracing_seeds)):
+                for (ho, fingerprint, indices) in chunk:
+                    for index in indices:
+                        if f._insert(fingerprint, index):
+                            f.size += 1
+                            break
+                    else:
+                        # Both buckets are full; let the filter relocate
+                        # fingerprints as it would during a serial build
+                        f.insert(ho)
+
+    def _fingerprints_indices(self, hashed_observations):
+        """Return the fingerprints and the first bucket indices of the
+        specified hashed observations.
+        This follows CuckooTemplate.fingerprint and CuckooTemplate.index,
+        which both hash the item with the same function, but hashes each
+        item only once."""
+        f = self.infected_observations
+        fingerprint_size = f.fingerprint_size
+        hashes = [mmh3.hash_bytes(ho) for ho in hashed_observations]
+        fingerprints = []
+        for h in hashes:
+            fingerprint = bitarray()
+            fingerprint.frombytes(h[: (fingerprint_size + 7) // 8])
+            del fingerprint[fingerprint_size:]
+            fingerprints.append(fingerprint)
+        indices = [int.from_bytes(h, "big") % f.capacity for h in hashes]
+        return fingerprints, indices
+
+    def _alt_index(self, index, fingerprint):
+        """Return the alternative bucket index of an item given its first
+        index and its fingerprint, as CuckooTemplate.indices does."""
+        capacity = self.capacity
+        fingerprint_hash = mmh3.hash_bytes(fingerprint.tobytes())
+        return (index ^ (int.from_bytes(fingerprint_hash, "big") % capacity)) % capacity
+
+    def contains_many(self, hashed_observations):
+        """Check which of the specified hashed observations are in the filter
+
+        The fingerprints and bucket indices of all observations are computed
+        in bulk, and the buckets are then probed in index order.
+
+        Args:
+            hashed_observations: An iterable of hashed observations
+
+        Returns:
+            bitarray: A bit map whose elements are set for the corresponding
+                observations that are in the filter
+        """
+        f = self.infected_observations
+        fingerprint_size = f.fingerprint_size
+        bucket_bits = f.bucket_size * fingerprint_size
+        buckets = f.buckets
+
+        fingerprints, indices = self._fingerprints_indices(hashed_observations)
+
+        def bucket_contains(index, fingerprint):
+            """Return True if the bucket at index contains the fingerprint."""
+            start = index * bucket_bits
+            end = start + bucket_bits
+            pos = buckets.find(fingerprint, start, end)
+            while pos >= 0:
+                # Only matches aligned on fingerprint slots count
+                if (pos - start) % fingerprint_size == 0:
+                    return True
+                pos = buckets.find(fingerprint, pos + 1, end)
+            return False
+
+        hits = bitarray(len(indices))
+        hits.setall(False)
+
+        # Probe the first bucket of each item
+        misses = []
+        for n in sorted(range(len(indices)), key=indices.__getitem__):
+            if bucket_contains(indices[n], fingerprints[n]):
+                hits[n] = True
+            else:
+                misses.append(n)
+
+        # Probe the alternative bucket of the items not found
+        alt_indices = {n: self._alt_index(indices[n], fingerprints[n]) for n in misses}
+        for n in sorted(misses, key=alt_indices.__getitem__):
+            if bucket_contains(alt_indices[n], fingerprints[n]):
+                hits[n] = True
+
+        return hits
+
+    def add_changes(self, generation, byte_ranges):
+        """Record the parts of the bucket array that changed when the
+        filter's specified generation was created
+
+        Args:
+            generation (int): The generation created by the changes
+            byte_ranges ([(offset, length)]): The changed bytes of the
+                bucket array
+        """
+        f = self.infected_observations
+        bucket_bits = f.bucket_size * f.fingerprint_size
+        changed = set()
+        for (offset, length) in byte_ranges:
+            first = offset * 8 // bucket_bits
+            last = ((offset + length) * 8 - 1) // bucket_bits
+            changed.update(range(first, last + 1))
+        self.changed_buckets[generation] = changed
+
+    def buckets_changed_since(self, generation):
+        """Return the set of the indices of the buckets that changed after
+        the specified generation, or None if these are not known."""
+        if self.generation is None or generation > self.generation:
+            return None
+        changed = set()
+        for g in range(generation + 1, self.generation + 1):
+            if g not in self.changed_buckets:
+                return None
+            changed |= self.changed_buckets[g]
+        return changed
+
+    def in_buckets_many(self, hashed_observations, bucket_indices):
+        """Return a bit map whose elements are set for the corresponding
+        hashed observations that would be stored in one of the specified
+        buckets."""
+        fingerprints, indices = self._fingerprints_indices(hashed_observations)
+        result = bitarray(len(indices))
+        for (n, (index, fingerprint)) in enumerate(zip(indices, fingerprints)):
+            result[n] = (
+                index in bucket_indices
+                or self._alt_index(index, fingerprint) in bucket_indices
+            )
+        return result
+
     def tofile(self, f):
         """Save the filter to the specified file object. """
         # This is based on the current implementation of CBucketFile
@@ -139,7 +495,14 @@ class ContactTracer:
     """
 
     def __init__(
-        self, start_time=None, db_path=":memory:", receiver=True, transmitter=True
+        self,
+        start_time=None,
+        db_path=":memory:",
+        receiver=True,
+        transmitter=True,
+        observation_buffer_size=0,
+        observation_flush_interval=OBSERVATION_FLUSH_INTERVAL,
+        storage_profile=None,
     ):
         """Create an new App object and initialize
 
@@ -152,10 +515,25 @@ class ContactTracer:
                 receiver-end housekeeping
             transmitter: If true (the default) the tracing will handle handle the
                 transmitter-end housekeeping
+            observation_buffer_size: If non-zero, observations are aggregated
+                in memory and stored when this number of distinct ones
+                has been buffered (or by calling flush_observations)
+            observation_flush_interval: Maximum number of seconds buffered
+                observations are kept in memory
+            storage_profile: SQLite settings of the database, as described in
+                storage_profile.storage_pragmas (default: SQLite's defaults)
         """
 
         # Database where seeds EphIDs and other data are stored
-        self.db = ClientDatabase(db_path)
+        self.db = ClientDatabase(db_path, storage_profile)
+
+        # Destination of added observations
+        if observation_buffer_size:
+            self.observations = ObservationBuffer(
+                self.db, observation_buffer_size, observation_flush_interval
+            )
+        else:
+            self.observations = self.db
 
         if start_time is None:
             start_time = datetime.now()
@@ -181,8 +559,9 @@ class ContactTracer:
             return
 
         # Generate fresh seeds and store them
-        seeds = [generate_new_seed() for _ in range(NUM_EPOCHS_PER_DAY)]
-        ephids = [ephid_from_seed(seed) for seed in seeds]
+        packed_seeds = generate_new_seeds(NUM_EPOCHS_PER_DAY)
+        seeds = split_batch(packed_seeds, LENGTH_SEED)
+        ephids = split_batch(ephids_from_seeds(packed_seeds), LENGTH_EPHID)
 
         # Convert to epoch numbers
         first_epoch = epoch_from_time(self.start_of_today)
@@ -200,6 +579,16 @@ class ContactTracer:
                     ephids[relative_epoch],
                 )
 
+    def seconds_to_next_day(self, time):
+        """Return the number of seconds from the passed time until the
+        current day ends, or zero if it has already ended."""
+        end_of_today = datetime.combine(
+            self.today + timedelta(days=1),
+            datetime.min.time(),
+            tzinfo=self.start_of_today.tzinfo,
+        )
+        return max((end_of_today - time).total_seconds(), 0)
+
     def check_advance_day(self, time):
         """ Check and advance the current day based on the passed time, if needed."""
 
@@ -217,6 +606,7 @@ class ContactTracer:
 
         # Remove old observations
         if self.receiver:
+            self.flush_observations()
             last_retained_day = self.today - timedelta(days=RETENTION_PERIOD)
             self.db.delete_past_observations(day_timestamp(last_retained_day))
 
@@ -245,6 +635,12 @@ class ContactTracer:
 
         return ephid
 
+    def get_ephids_for_today(self):
+        """Return a dictionary mapping each epoch of the current day to
+        its EphID"""
+        first_epoch = epoch_from_time(self.start_of_today)
+        return self.db.get_epoch_ephids(first_epoch, first_epoch + NUM_EPOCHS_PER_DAY)
+
     def add_observation(self, ephid, time, rssi=0):
         """Add ephID to list of observations. Time must correspond to the current day
 
@@ -262,7 +658,20 @@ class ContactTracer:
 
         epoch = epoch_from_time(time)
         hashed_observation = hashed_observation_from_ephid(ephid, epoch)
-        self.db.add_observation(day_timestamp(self.today), hashed_observation, rssi)
+        self.observations.add_observation(
+            day_timestamp(self.today), hashed_observation, rssi
+        )
+
+    def flush_observations(self):
+        """Store any observations that are buffered in memory."""
+        if self.observations is not self.db:
+            self.observations.flush()
+
+    def flush_observations_if_due(self):
+        """Store the observations buffered in memory if they have been
+        kept for longer than the flush interval."""
+        if self.observations is not self.db:
+            self.observations.flush_if_due()
 
     def get_tracing_seeds_for_epochs(self, reported_epochs):
         """Return the seeds corresponding to the requested epochs
@@ -321,19 +730,65 @@ class ContactTracer:
     def matches_with_batch(self, batch):
         """Check for contact with infected person given a published filter
 
+        If the filter's generation is known, the database records the
+        generation against which each observation was checked and its result.
+        Subsequent checks then only examine new observations and those
+        whose filter buckets changed since they were checked.
+
         Args:
-            infected_observations: A (compact) representation of hashed
-                observations belonging to infected persons
+            batch: A (compact) representation of hashed observations
+                belonging to infected persons
 
         Returns:
             int: How many EphIDs of infected persons we saw
         """
 
-        seen_infected_ephids = 0
-
         # TODO: Take into account RSSI and count
-        for hashed_observation in self.db.get_observations():
-            if hashed_observation in batch.infected_observations:
-                seen_infected_ephids += 1
+        if batch.generation is None:
+            return batch.contains_many(self.db.get_observations()).count()
+
+        # Check only the observations that may have been affected by
+        # the filter's changes since they were last checked
+        to_check, last_row = self.db.get_observations_to_check(batch.generation)
+        for (checked_generation, ephid_hashes) in to_check.items():
+            changed = batch.buckets_changed_since(checked_generation)
+            if checked_generation and changed is not None:
+                affected = batch.in_buckets_many(ephid_hashes, changed)
+                ephid_hashes = [h for (h, a) in zip(ephid_hashes, affected) if a]
+            hits = batch.contains_many(ephid_hashes)
+            with self.db.atomic():
+                self.db.set_observations_matched(
+                    [h for (h, hit) in zip(ephid_hashes, hits) if hit], True
+                )
+                self.db.set_observations_matched(
+                    [h for (h, hit) in zip(ephid_hashes, hits) if not hit], False
+                )
+        self.db.set_observations_checked(batch.generation, last_row)
+        return self.db.count_matched_observations()
+
+    def matches_with_shards(self, shards):
+        """Check for contact with infected person given a published filter
+        sharded by day
+
+        Each observation is only checked against the shards of the days
+        in which it may have been made.
+
+        Args:
+            shards: A dictionary mapping day numbers (see day_from_epoch)
+                to the batch of hashed observations of infected persons
+                for the corresponding day
 
-        return seen_infected_ephids
+        Returns:
+            int: How many EphIDs of infected persons we saw
+        """
+        matches = 0
+        for (day, ephid_hashes) in self.db.get_observations_by_day().items():
+            found = None
+            for shard_day in observation_shard_days(day):
+                if shard_day not in shards:
+                    continue
+                hits = shards[shard_day].contains_many(ephid_hashes)
+                found = hits if found is None else found | hits
+            if found is not None:
+                matches += found.count()
+        return matches
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+""" Commit to the database the uploads accepted into the ingest spool """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import argparse
+from dp3t.protocols.server_database import ServerDatabase
+from dp3t.protocols.storage_profile import storage_profile
+from epidose.back_end.ingest_spool import IngestSpool
+from epidose.common.daemon import Daemon
+from epidose.common.interruptible_sleep import InterruptibleSleep
+import signal
+
+
+def commit_all(spool, db, batch_size):
+    """Commit all the spool's uploads in batches of about batch_size seeds.
+    Return the number of seeds committed."""
+    total = 0
+    while True:
+        committed = spool.commit(db, batch_size)
+        if not committed:
+            return total
+        total += committed
+        logger.debug(f"Committed a batch of {committed} seeds")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Commit to the database the uploads accepted into the spool"
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        help="Number of seeds committed in a single transaction",
+        type=int,
+        default=50000,
+    )
+    parser.add_argument(
+        "-d", "--debug", help="Run in debug mode logging to stderr", action="store_true"
+    )
+    parser.add_argument(
+        "-D",
+        "--database",
+        help="Specify the database location",
+        default="/var/lib/epidose/server-database.db",
+    )
+    parser.add_argument(
+        "-i",
+        "--interval",
+        help="Number of seconds between checks for new uploads",
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        "-o", "--once", help="Commit the spooled uploads and exit", action="store_true"
+    )
+    parser.add_argument(
+        "-P",
+        "--storage-profile",
+        help="Database storage profile, optionally followed by comma-separated "
+        "setting=value overrides (default: server)",
+        type=storage_profile,
+        default="server",
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="Set verbose logging", action="store_true"
+    )
+    parser.add_argument("spool", help="Ingest spool file")
+    args = parser.parse_args()
+
+    # Setup logging
+    daemon = Daemon("commit_ingest", args)
+    global logger
+    logger = daemon.get_logger()
+
+    db = ServerDatabase(args.database, args.storage_profile)
+    spool = IngestSpool(args.spool)
+
+    # Set aside an upload left incomplete by a crash, or corrupt uploads
+    moved = spool.recover(spool.committed_offset(db))
+    if moved:
+        logger.warning(
+            f"Moved {moved} unreadable spool bytes to {spool.unreadable_path()}"
+        )
+
+    sleeper = InterruptibleSleep([signal.SIGTERM, signal.SIGINT])
+    while True:
+        committed = commit_all(spool, db, args.batch_size)
+        if committed:
+            logger.info(f"Committed {committed} seeds")
+        # On termination exit after committing what has been accepted
+        if args.once or sleeper.signaled:
+            break
+        sleeper.sleep(args.interval)
+    spool.close()
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -20,10 +20,34 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 import argparse
+from cuckoo.exception import CapacityException
+from datetime import datetime, timedelta
+from dp3t.config import RETENTION_PERIOD
 from dp3t.protocols.server_database import ServerDatabase
+from dp3t.protocols.storage_profile import storage_profile
+from dp3t.protocols.unlinkable import day_from_epoch, epoch_from_time
 from dp3t.protocols.unlinkable_db import TracingDataBatch
 from epidose.common.daemon import Daemon
+from epidose.common.filter_delta import (
+    compute_delta,
+    delta_path,
+    prune_deltas,
+    state_path,
+    write_delta,
+)
+from epidose.common.filter_file import compressed_path, write_compressed_filter
+from epidose.common.filter_shards import (
+    read_manifest,
+    shard_days,
+    shard_entry,
+    shard_path,
+    shards_path,
+    write_manifest,
+)
+import json
 import os
+import struct
+import sys
 from tempfile import mkstemp
 
 # The daemon object associated with this program
@@ -44,6 +68,215 @@ def read_seeds(file_path):
     return [(epochs, seeds)]
 
 
+def read_filter(file_path):
+    """Return the filter stored in the specified file path."""
+    with open(file_path, "rb") as f:
+        (capacity,) = struct.unpack(">Q", f.read(8))
+        return TracingDataBatch(fh=f, capacity=capacity)
+
+
+def replace_file(name, file_path):
+    """Atomically and durably replace file_path with the file name,
+    which has been synchronized to disk."""
+    os.rename(name, file_path)
+    fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_filter(cuckoo_filter, file_path, compressed=False):
+    """Atomically replace the specified file with the given filter,
+    optionally compressed."""
+    handle, name = mkstemp(dir=os.path.dirname(file_path))
+
+    # Write filter to a temparary file
+    with os.fdopen(handle, "wb") as f:
+        if compressed:
+            write_compressed_filter(f, cuckoo_filter)
+        else:
+            f.write(cuckoo_filter.capacity.to_bytes(8, byteorder="big", signed=False))
+            cuckoo_filter.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Atomically replace any existing filter file with the new one
+    logger.debug(f"Rename {name} to {file_path}")
+    replace_file(name, file_path)
+
+
+def read_state(filter_path):
+    """Return the update state of the specified filter
+    as a dictionary, or None if no (valid) state is available."""
+    try:
+        with open(state_path(filter_path), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.info(f"No filter state available: {e}")
+        return None
+
+
+def write_state(filter_path, state):
+    """Atomically replace the update state of the specified
+    filter with the given dictionary."""
+    handle, name = mkstemp(dir=os.path.dirname(filter_path))
+    with os.fdopen(handle, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(name, state_path(filter_path))
+
+
+def build_filter(db, last_retained_day):
+    """Return a new filter for all the database's records retained after
+    last_retained_day, and its incremental update state."""
+    with db.atomic():
+        last_id = db.get_last_id()
+        hashed_observations = db.get_new_hashed_observations(
+            0, last_id, last_retained_day
+        )
+    cuckoo_filter = TracingDataBatch(hashed_observations=hashed_observations)
+    state = {
+        "capacity": cuckoo_filter.capacity,
+        "last_id": last_id,
+        "items": len(hashed_observations),
+    }
+    return cuckoo_filter, state
+
+
+def update_filter(db, filter_path, state, last_retained_day):
+    """Return the filter stored in filter_path updated with the database's
+    records added since it was created, and with the records expired
+    after last_retained_day removed.
+    The expired records are left in the database, for delete_expired_data
+    to remove them after the filter and its state have been saved.
+    Rebuild the filter from scratch if this is not possible.
+    Return the filter and its incremental update state."""
+    if not state or not os.path.exists(filter_path):
+        return build_filter(db, last_retained_day)
+
+    cuckoo_filter = read_filter(filter_path)
+    if cuckoo_filter.capacity != state["capacity"]:
+        logger.info("Filter capacity does not match its state; rebuilding it")
+        return build_filter(db, last_retained_day)
+
+    with db.atomic():
+        last_id = db.get_last_id()
+        if last_id < state["last_id"]:
+            # The database was recreated or migrated
+            logger.info("Filter state is ahead of the database; rebuilding it")
+            return build_filter(db, last_retained_day)
+        # Records that expired before being added to the filter are
+        # neither inserted into it nor deleted from it
+        new_observations = db.get_new_hashed_observations(
+            state["last_id"], last_id, last_retained_day
+        )
+        expired_observations = db.get_expired_hashed_observations(
+            last_retained_day, state["last_id"]
+        )
+
+    items = state["items"] + len(new_observations) - len(expired_observations)
+    # Rebuilt filters have 1.2 buckets (of four slots) per item;
+    # keep the load factor low enough for insertions to succeed
+    if items > cuckoo_filter.capacity:
+        logger.info(f"Filter would hold {items} items; rebuilding it")
+        return build_filter(db, last_retained_day)
+
+    logger.debug(
+        f"Insert {len(new_observations)} items, "
+        f"delete {len(expired_observations)} items"
+    )
+    not_found = cuckoo_filter.delete_hashed_observations(expired_observations)
+    if not_found:
+        # Expired records remain in the database if a crash prevented
+        # their deletion after the filter without them was saved
+        logger.warning(f"{not_found} expired items were not found in the filter")
+        items += not_found
+    try:
+        cuckoo_filter.insert_hashed_observations(new_observations)
+    except CapacityException:
+        logger.info("Filter became full; rebuilding it")
+        return build_filter(db, last_retained_day)
+
+    state = {"capacity": cuckoo_filter.capacity, "last_id": last_id, "items": items}
+    return cuckoo_filter, state
+
+
+def publish_delta(filter_path, cuckoo_filter, generation, keep_deltas):
+    """Store the changes between the filter stored in filter_path and
+    the specified filter, which will become the given generation.
+    Remove the changes that created generations older than keep_deltas."""
+    try:
+        previous_filter = read_filter(filter_path)
+    except OSError:
+        return
+    if previous_filter.capacity != cuckoo_filter.capacity:
+        logger.info("Filter capacity changed; no delta created")
+        return
+
+    records = compute_delta(
+        previous_filter.infected_observations.buckets,
+        cuckoo_filter.infected_observations.buckets,
+    )
+    path = delta_path(filter_path, generation)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, name = mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, "wb") as f:
+        write_delta(f, generation - 1, generation, cuckoo_filter.capacity, records)
+    os.rename(name, path)
+    logger.debug(f"Delta for generation {generation} has {len(records)} records")
+
+    prune_deltas(filter_path, generation, keep_deltas)
+
+
+def update_shards(db, shards_dir, compressed):
+    """Bring the filter shards stored in shards_dir up to date with the
+    database, rebuilding only the shards of the days whose records were
+    added or expired since they were built, and removing expired shards.
+    The expired records are also removed from the database."""
+    os.makedirs(shards_dir, exist_ok=True)
+    manifest = read_manifest(shards_dir)
+    state = read_state(shards_dir)
+    last_retained_day = datetime.now() - timedelta(days=RETENTION_PERIOD)
+    with db.atomic():
+        last_id = db.get_last_id()
+        if state and "last_id" in state and state["last_id"] <= last_id:
+            changed = db.get_new_days(state["last_id"], last_id)
+        else:
+            # Rebuild all shards; a state ahead of the database means
+            # that the database was recreated or migrated
+            changed = db.get_new_days(0, last_id) | set(manifest)
+        changed |= db.get_expired_days(last_retained_day)
+        db.delete_expired_data(last_retained_day)
+
+    # Shards of days preceding the retained ones are no longer needed
+    first_retained_day = day_from_epoch(epoch_from_time(last_retained_day))
+    changed |= {day for day in manifest if day < first_retained_day}
+
+    for day in sorted(changed):
+        hashed_observations = db.get_day_hashed_observations(day)
+        path = shard_path(shards_dir, day)
+        if hashed_observations:
+            cuckoo_filter = TracingDataBatch(hashed_observations=hashed_observations)
+            write_filter(cuckoo_filter, path, compressed)
+            manifest[day] = shard_entry(path)
+            logger.debug(f"Shard {day} holds {len(hashed_observations)} items")
+        else:
+            manifest.pop(day, None)
+            logger.debug(f"Shard {day} removed")
+    write_manifest(shards_dir, manifest)
+
+    # Remove the shard files no longer listed in the manifest
+    for day in shard_days(shards_dir) - set(manifest):
+        os.unlink(shard_path(shards_dir, day))
+
+    # Save the state after the shards, so that a crash between the two
+    # can cause shards to be rebuilt, but never to be missed
+    write_state(shards_dir, {"last_id": last_id})
+    logger.info(f"Updated {len(changed)} filter shards; {len(manifest)} are published")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Create Cuckoo filter with reported infections"
@@ -57,10 +290,51 @@ def main():
         help="Specify the database location",
         default="/var/lib/epidose/server-database.db",
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help="Update the existing filter with the database's changes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of processes used for hashing the seeds of a seeds file "
+        "(only with -s; the database holds precomputed hashes)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-k",
+        "--keep-deltas",
+        help="Number of filter generation deltas to keep",
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        "-P",
+        "--storage-profile",
+        help="Database storage profile, optionally followed by comma-separated "
+        "setting=value overrides (default: server)",
+        type=storage_profile,
+        default="server",
+    )
+    parser.add_argument(
+        "-S",
+        "--sharded",
+        help="Store the filter as per-day shards with a manifest (in filter.shards)",
+        action="store_true",
+    )
     parser.add_argument("-s", "--seeds-file", help="File containing epochs and seeds")
     parser.add_argument(
         "-v", "--verbose", help="Set verbose logging", action="store_true"
     )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        help="Also store a compressed version of the filter (filter.z)",
+        action="store_true",
+    )
     parser.add_argument("filter", help="File where filter will be stored")
     args = parser.parse_args()
 
@@ -69,25 +343,61 @@ def main():
     global logger
     logger = daemon.get_logger()
 
-    # Obtain seeds
+    if args.jobs != 1 and not args.seeds_file:
+        logger.error("Multiple jobs can only be used with a seeds file")
+        sys.exit(1)
+
+    if args.sharded:
+        if args.seeds_file:
+            logger.error("Sharded filters can only be created from the database")
+            sys.exit(1)
+        db = ServerDatabase(args.database, args.storage_profile)
+        update_shards(db, shards_path(args.filter), args.compress)
+        sys.exit(0)
+
+    # Create and save filter
+    state = None
+    last_retained_day = datetime.now() - timedelta(days=RETENTION_PERIOD)
     if args.seeds_file:
         tracing_seeds = read_seeds(args.seeds_file)
+        cuckoo_filter = TracingDataBatch(tracing_seeds, jobs=args.jobs)
     else:
-        db = ServerDatabase(args.database)
-        tracing_seeds = [db.get_epoch_seeds_tuple()]
+        db = ServerDatabase(args.database, args.storage_profile)
+        previous_state = read_state(args.filter)
+        if args.incremental:
+            cuckoo_filter, state = update_filter(
+                db, args.filter, previous_state, last_retained_day
+            )
+        else:
+            cuckoo_filter, state = build_filter(db, last_retained_day)
 
-    # Create and save filter
-    cuckoo_filter = TracingDataBatch(tracing_seeds)
-    handle, name = mkstemp(dir=os.path.dirname(args.filter))
+        # Publish the changes from the previous generation
+        if previous_state and "generation" in previous_state:
+            state["generation"] = previous_state["generation"] + 1
+            publish_delta(
+                args.filter, cuckoo_filter, state["generation"], args.keep_deltas
+            )
+        else:
+            state["generation"] = 1
+    write_filter(cuckoo_filter, args.filter)
 
-    # Write filter to a temparary file
-    with os.fdopen(handle, "wb") as f:
-        f.write(cuckoo_filter.capacity.to_bytes(8, byteorder="big", signed=False))
-        cuckoo_filter.tofile(f)
+    # Publish a compressed version, or remove a stale one
+    if args.compress:
+        write_filter(cuckoo_filter, compressed_path(args.filter), compressed=True)
+    else:
+        try:
+            os.unlink(compressed_path(args.filter))
+        except FileNotFoundError:
+            pass
 
-    # Atomically replace any existing filter file with the new one
-    logger.debug(f"Rename {name} to {args.filter}")
-    os.rename(name, args.filter)
+    # Save the state after the filter, so that a crash between the two
+    # can cause items to be inserted twice, but never to be missed
+    if state:
+        write_state(args.filter, state)
+
+        # Delete the expired records only once the filter without them
+        # has been saved, so that they cannot remain in it
+        db.delete_expired_data(last_retained_day)
 
 
 if __name__ == "__main__":
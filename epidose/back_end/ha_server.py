@@ -21,9 +21,26 @@ __license__ = "Apache 2.0"
 
 import argparse
 from dp3t.protocols.server_database import ServerDatabase
+from dp3t.protocols.storage_profile import storage_profile
+from epidose.back_end.ingest_spool import IngestSpool
 from epidose.common.daemon import Daemon
-from flask import Flask, abort, jsonify, request, send_from_directory
+from epidose.common.filter_delta import delta_path, filter_generation
+from epidose.common.filter_file import compressed_path
+from epidose.common.filter_shards import (
+    MANIFEST_NAME,
+    file_digest,
+    shard_path,
+    shards_path,
+)
+from epidose.common.seed_upload import (
+    AUTHORIZATION_HEADER,
+    SEEDS_MIMETYPE,
+    check_seeds,
+    unpack_seeds,
+)
+from flask import Flask, Response, abort, jsonify, request, send_from_directory
 import logging
+import os
 from os.path import basename, dirname
 
 API_VERSION = "1"
@@ -34,8 +51,18 @@ db = None
 
 FILTER_LOCATION = "/var/lib/epidose/filter.bin"
 DATABASE_LOCATION = "/var/lib/epidose/server-database.db"
+STORAGE_PROFILE = "server"
 UPDATE_LOCATION = "/var/lib/epidose/update.sh"
 
+# When set, uploads are appended to this spool and committed to the
+# database by commit_ingest.py
+SPOOL_LOCATION = os.environ.get("EPIDOSE_INGEST_SPOOL")
+spool = None
+
+# File identification and entity tag of the most recently served
+# version of each filter file
+filter_etags = {}
+
 
 def shutdown_server():
     func = request.environ.get("werkzeug.server.shutdown")
@@ -48,7 +75,7 @@ def shutdown_server():
 def before_request():
     global db
     if not db:
-        db = ServerDatabase(DATABASE_LOCATION)
+        db = ServerDatabase(DATABASE_LOCATION, STORAGE_PROFILE)
     db.connect(reuse_if_open=True)
 
 
@@ -60,13 +87,95 @@ def after_request(response):
     return response
 
 
-@app.route("/filter", methods=["GET"])
-def filter():
-    """Send the Cuckoo filter as a static file.
+def filter_etag(path):
+    """Return the entity tag of the specified filter file, which is a hash
+    of its contents.  The hash is recomputed only when the file changes."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    (cached_key, etag) = filter_etags.get(path, (None, None))
+    if cached_key != key:
+        etag = file_digest(path)
+        filter_etags[path] = (key, etag)
+    return etag
+
+
+def send_filter(path):
+    """Send the specified filter file, identifying the filter's generation.
     In a production deployment this should be handled by the front-end server,
     such as nginx.
     """
-    return send_from_directory(dirname(FILTER_LOCATION), basename(FILTER_LOCATION))
+    # Obtain the generation before the file: the filter is updated before
+    # its generation, and deltas can be reapplied to a newer filter
+    generation = filter_generation(FILTER_LOCATION)
+    # Conditional and range requests allow clients to skip unchanged
+    # filters and resume interrupted downloads
+    response = send_from_directory(
+        dirname(path), basename(path), etag=filter_etag(path), conditional=True
+    )
+    if generation is not None:
+        response.headers["X-Filter-Generation"] = str(generation)
+    return response
+
+
+@app.route("/filter", methods=["GET"])
+def filter():
+    """Send the Cuckoo filter as a static file."""
+    return send_filter(FILTER_LOCATION)
+
+
+@app.route("/filter/compressed", methods=["GET"])
+def compressed_filter():
+    """Send the compressed version of the Cuckoo filter as a static file.
+    Respond with 404 if it is not published, in which case the client must
+    obtain the plain filter.
+    """
+    return send_filter(compressed_path(FILTER_LOCATION))
+
+
+@app.route("/filter/shards", methods=["GET"])
+def filter_shards():
+    """Send the manifest of the Cuckoo filter's per-day shards.
+    Respond with 404 if the filter is not published in shards.
+    """
+    return send_from_directory(shards_path(FILTER_LOCATION), MANIFEST_NAME)
+
+
+@app.route("/filter/shards/<int:day>", methods=["GET"])
+def filter_shard(day):
+    """Send the Cuckoo filter shard of the specified day as a static file."""
+    path = shard_path(shards_path(FILTER_LOCATION), day)
+    return send_from_directory(
+        dirname(path), basename(path), etag=filter_etag(path), conditional=True
+    )
+
+
+@app.route("/filter/delta/<int:generation>", methods=["GET"])
+def filter_delta(generation):
+    """Send the changes needed to bring the Cuckoo filter of the specified
+    generation to the current one.  These are the concatenated deltas
+    of the intervening generations.  Respond with 404 if any of them is not
+    available, in which case the client must obtain the complete filter.
+    """
+    current = filter_generation(FILTER_LOCATION)
+    if current is None or generation > current:
+        abort(404)
+    headers = {"X-Filter-Generation": str(current)}
+    if generation == current:
+        return Response(status=204, headers=headers)
+
+    deltas = []
+    for g in range(generation + 1, current + 1):
+        try:
+            with open(delta_path(FILTER_LOCATION, g), "rb") as f:
+                deltas.append(f.read())
+        except FileNotFoundError:
+            abort(404)
+    return Response(
+        b"".join(deltas), mimetype="application/octet-stream", headers=headers
+    )
 
 
 @app.route("/update", methods=["GET"])
@@ -89,19 +198,77 @@ def version():
     return jsonify({"version": API_VERSION})
 
 
+def decode_json_seeds(content):
+    """Return a tuple of the authorization, epochs, and seeds in the
+    specified JSON upload.  Raise ValueError if the upload is not valid."""
+    try:
+        authorization = content["authorization"]
+        epochs = []
+        seeds = []
+        for rec in content["data"]:
+            epoch = rec["epoch"]
+            # JSON true and false are decoded as bool, a subclass of int
+            if type(epoch) is not int:
+                raise ValueError(f"Invalid epoch {epoch}")
+            epochs.append(epoch)
+            seeds.append(bytes.fromhex(rec["seed"]))
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed upload: {e}")
+    # Accept only what binary uploads can carry
+    check_seeds(epochs, seeds)
+    return (authorization, epochs, seeds)
+
+
 @app.route("/add_contagious", methods=["POST"])
 def add_contagious():
-    content = request.json
+    """Add the epochs and seeds of a contagious user.
+    These are uploaded either as JSON or in the binary format of the
+    seed_upload module, with the authorization in a header.
+    The complete upload is decoded and validated before storing it."""
+    try:
+        if request.mimetype == SEEDS_MIMETYPE:
+            authorization = request.headers.get(AUTHORIZATION_HEADER)
+            (epochs, seeds) = unpack_seeds(request.get_data())
+        else:
+            content = request.get_json(force=True, silent=True)
+            (authorization, epochs, seeds) = decode_json_seeds(content)
+        if not authorization:
+            raise ValueError("Missing authorization")
+    except ValueError as e:
+        logger.warning(f"Rejected contagious data: {e}")
+        abort(400)
+    logger.debug(f"Add {len(seeds)} seeds with authorization {authorization}")
+    # TODO: Check authorization
+    if SPOOL_LOCATION:
+        get_spool().append(epochs, seeds)
+        # TODO: Delete authorization
+        return "OK", 202
     with db.atomic():
-        logger.debug(f"Add new data with authorization {content['authorization']}")
-        # TODO: Check authorization
-        for rec in content["data"]:
-            epoch = rec["epoch"]
-            seed = bytes.fromhex(rec["seed"])
-            db.add_epoch_seed(epoch, seed)
-            logger.debug(f"Add {epoch} {seed.hex()}")
-            # TODO: Delete authorization
-        return "OK"
+        db.add_epoch_seeds(epochs, seeds)
+        # TODO: Delete authorization
+    return "OK"
+
+
+def get_spool():
+    """Return the ingest spool, opening it if needed."""
+    global spool
+    if not spool:
+        spool = IngestSpool(SPOOL_LOCATION)
+        moved = spool.recover()
+        if moved:
+            logger.warning(
+                f"Moved {moved} unreadable spool bytes to {spool.unreadable_path()}"
+            )
+    return spool
+
+
+@app.route("/ingest/status", methods=["GET"])
+def ingest_status():
+    """Report the uploads waiting in the ingest spool to be committed."""
+    if not SPOOL_LOCATION:
+        abort(404)
+    (uploads, seeds, size) = get_spool().depth(db)
+    return jsonify({"uploads": uploads, "seeds": seeds, "bytes": size})
 
 
 def initialize(args):
@@ -115,7 +282,7 @@ def initialize(args):
 
     # Connect to the database
     global db
-    db = ServerDatabase(args.database)
+    db = ServerDatabase(args.database, STORAGE_PROFILE)
 
 
 def main():
@@ -141,6 +308,25 @@ def main():
         help="Specify the location of the Cuckoo filter",
         default=FILTER_LOCATION,
     )
+
+    global STORAGE_PROFILE
+    parser.add_argument(
+        "-P",
+        "--storage-profile",
+        help="Database storage profile, optionally followed by comma-separated "
+        f"setting=value overrides (default: {STORAGE_PROFILE})",
+        type=storage_profile,
+        default=STORAGE_PROFILE,
+    )
+
+    global SPOOL_LOCATION
+    parser.add_argument(
+        "-S",
+        "--spool",
+        help="Append uploads to the specified spool for committing them "
+        "with commit_ingest.py",
+        default=SPOOL_LOCATION,
+    )
     parser.add_argument(
         "-s",
         "--server-name",
@@ -153,10 +339,12 @@ def main():
     )
     args = parser.parse_args()
 
+    STORAGE_PROFILE = args.storage_profile
     initialize(args)
 
     FILTER_LOCATION = args.filter
     DATABASE_LOCATION = args.database
+    SPOOL_LOCATION = args.spool
 
     # Daemonize with gunicorn or other means, because the daemonize
     # module has trouble dealing with the lock files when the app
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+""" Durable append-only spool of contagious users' uploads """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from epidose.common.seed_upload import SEED_RECORD, pack_seeds, unpack_seeds
+import fcntl
+import os
+import struct
+import zlib
+
+# A spool starts with a magic number and a random identifier, which
+# changes every time the spool is emptied.
+SPOOL_HEADER = struct.Struct(">8s8s")
+SPOOL_MAGIC = b"EPDSPOOL"
+
+# Each upload in the spool starts with the number of its seed records,
+# which follow in the binary upload format, and their CRC-32.
+UPLOAD_HEADER = struct.Struct(">II")
+
+# Data that cannot be read as uploads are moved from the end of a spool
+# to a file with this suffix, from which their uploads can be salvaged.
+UNREADABLE_SUFFIX = ".unreadable"
+
+# Number of bytes copied at once to the file of unreadable data
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class IngestSpool:
+    """An append-only file holding uploads that have been accepted but not
+    yet committed to the server database.
+
+    Any number of processes can append to the spool, while a single
+    committer moves its contents to the database.  The database records
+    the spool offset up to which uploads have been committed in the same
+    transaction that adds them, so that each upload is committed exactly
+    once, even after a crash.
+    """
+
+    def __init__(self, path):
+        """Open (creating if needed) the spool stored in the specified file."""
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.recovered = False
+
+    def close(self):
+        """Close the spool's file."""
+        os.close(self.fd)
+
+    def _lock(self):
+        """Obtain exclusive access to the spool for modifying it."""
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        """Release the exclusive access to the spool."""
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _size(self):
+        """Return the spool's current size."""
+        return os.fstat(self.fd).st_size
+
+    def _reset(self):
+        """Empty the spool giving it a new identifier.
+        Must be called with the spool locked."""
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, SPOOL_HEADER.pack(SPOOL_MAGIC, os.urandom(8)))
+        os.fsync(self.fd)
+
+    def spool_id(self):
+        """Return the spool's identifier, or None if it has none."""
+        header = os.pread(self.fd, SPOOL_HEADER.size, 0)
+        if len(header) != SPOOL_HEADER.size:
+            return None
+        (magic, spool_id) = SPOOL_HEADER.unpack(header)
+        if magic != SPOOL_MAGIC:
+            raise ValueError(f"{self.path} is not an ingest spool")
+        return spool_id
+
+    def read_uploads(self, offset, max_seeds=None):
+        """Return a generator over the complete uploads stored in the spool
+        from the specified offset onward.  Each element is a tuple of the
+        upload's epochs, seeds, and the offset following it.
+        Stop before exceeding max_seeds seeds (but return at least one
+        upload), or at an incomplete or corrupt upload."""
+        seeds_read = 0
+        while True:
+            header = os.pread(self.fd, UPLOAD_HEADER.size, offset)
+            if len(header) != UPLOAD_HEADER.size:
+                return
+            (count, crc) = UPLOAD_HEADER.unpack(header)
+            if max_seeds is not None and seeds_read and seeds_read + count > max_seeds:
+                return
+            size = count * SEED_RECORD.size
+            data = os.pread(self.fd, size, offset + UPLOAD_HEADER.size)
+            if len(data) != size or zlib.crc32(data) != crc:
+                return
+            offset += UPLOAD_HEADER.size + size
+            seeds_read += count
+            yield unpack_seeds(data) + (offset,)
+
+    def _end_of_uploads(self, offset):
+        """Return the offset following the last complete upload."""
+        for (_, _, offset) in self.read_uploads(offset):
+            pass
+        return offset
+
+    def recover(self, committed_offset=SPOOL_HEADER.size):
+        """Move from the end of the spool to its file of unreadable data
+        anything following the last complete upload, such as a partially
+        written upload left by a crash, or a corrupt upload and those
+        after it.  Give a new spool its header.
+        Uploads before committed_offset are not examined.
+        Return the number of bytes moved."""
+        moved = 0
+        self._lock()
+        try:
+            if self.spool_id() is None:
+                self._reset()
+            else:
+                end = self._end_of_uploads(max(committed_offset, SPOOL_HEADER.size))
+                moved = max(self._size() - end, 0)
+                if moved:
+                    self._move_tail(end)
+            self.recovered = True
+        finally:
+            self._unlock()
+        return moved
+
+    def unreadable_path(self):
+        """Return the path of the file holding the spool's unreadable data."""
+        return self.path + UNREADABLE_SUFFIX
+
+    def _move_tail(self, offset):
+        """Durably append the spool's data from the specified offset onward
+        to its file of unreadable data, and remove them from the spool.
+        Must be called with the spool locked."""
+        size = self._size()
+        with open(self.unreadable_path(), "ab") as f:
+            for position in range(offset, size, COPY_CHUNK_SIZE):
+                f.write(
+                    os.pread(self.fd, min(COPY_CHUNK_SIZE, size - position), position)
+                )
+            f.flush()
+            os.fsync(f.fileno())
+        os.ftruncate(self.fd, offset)
+        os.fsync(self.fd)
+
+    def append(self, epochs, seeds):
+        """Durably append to the spool the specified epochs and seeds."""
+        if not seeds:
+            return
+        data = pack_seeds(epochs, seeds)
+        record = UPLOAD_HEADER.pack(len(seeds), zlib.crc32(data)) + data
+        if not self.recovered:
+            self.recover()
+        self._lock()
+        try:
+            if self.spool_id() is None:
+                self._reset()
+            os.write(self.fd, record)
+            os.fsync(self.fd)
+        finally:
+            self._unlock()
+
+    def committed_offset(self, db):
+        """Return the spool offset up to which the database holds
+        the uploads."""
+        (committed_id, offset) = db.get_spool_position()
+        if committed_id != self.spool_id():
+            # The spool was emptied after being committed
+            return SPOOL_HEADER.size
+        return offset
+
+    def commit(self, db, max_seeds):
+        """Add to the ServerDatabase db in a single transaction the uploads
+        that have not yet been committed, up to about max_seeds seeds.
+        Return the number of seeds committed."""
+        spool_id = self.spool_id()
+        if spool_id is None:
+            return 0
+        offset = self.committed_offset(db)
+        epochs = []
+        seeds = []
+        for (upload_epochs, upload_seeds, end) in self.read_uploads(offset, max_seeds):
+            epochs.extend(upload_epochs)
+            seeds.extend(upload_seeds)
+            offset = end
+        if not seeds:
+            self._empty_if_committed(db, offset)
+            return 0
+        with db.atomic():
+            db.add_epoch_seeds(epochs, seeds)
+            db.set_spool_position(spool_id, offset)
+        return len(seeds)
+
+    def _empty_if_committed(self, db, offset):
+        """Empty the spool if all its uploads up to its end at the
+        specified offset have been committed."""
+        if offset == SPOOL_HEADER.size or offset != self._size():
+            return
+        self._lock()
+        try:
+            # Uploads may have been added in the meantime
+            if offset == self._size():
+                self._reset()
+        finally:
+            self._unlock()
+
+    def depth(self, db):
+        """Return a tuple with the number of uploads, seeds, and bytes
+        in the spool that have not yet been committed."""
+        if self.spool_id() is None:
+            return (0, 0, 0)
+        offset = self.committed_offset(db)
+        uploads = 0
+        seeds = 0
+        for (_, upload_seeds, _) in self.read_uploads(offset):
+            uploads += 1
+            seeds += len(upload_seeds)
+        return (uploads, seeds, max(self._size() - offset, 0))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+""" Changes between successive Cuckoo filter generations """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import json
+import os
+import re
+import struct
+
+# A filter file starts with its capacity as an 8-byte big-endian number,
+# followed by the filter's buckets.
+FILTER_HEADER_SIZE = 8
+
+# A delta starts with the generation it applies to, the generation
+# it creates, the capacity of the corresponding filter, and the number
+# of records that follow.
+DELTA_HEADER = struct.Struct(">QQQI")
+
+# Each delta record consists of a filter file offset and the length of
+# the new data that follows it.
+DELTA_RECORD = struct.Struct(">QI")
+
+# Runs of unchanged bytes up to this length are included in a record,
+# rather than starting a new one.
+MAX_UNCHANGED_RUN = DELTA_RECORD.size
+
+# Changed bytes in the exclusive-or of two bucket arrays
+CHANGED_BYTES = re.compile(b"[^\x00]+")
+
+
+def state_path(filter_path):
+    """Return the path of the file holding the state of the specified filter
+    across its updates."""
+    return filter_path + ".state"
+
+
+def delta_path(filter_path, generation):
+    """Return the path of the file holding the changes that created the
+    specified generation of the given filter."""
+    return os.path.join(filter_path + ".deltas", str(generation))
+
+
+def generation_path(filter_path):
+    """Return the path of the file holding the generation of a filter
+    obtained from the server."""
+    return filter_path + ".gen"
+
+
+def read_generation(file_path):
+    """Return the filter generation stored in the specified file."""
+    with open(file_path, "r") as f:
+        return int(f.read())
+
+
+def write_generation(file_path, generation):
+    """Atomically replace the filter generation stored in the specified file."""
+    with open(file_path + ".new", "w") as f:
+        f.write(f"{generation}\n")
+    os.rename(file_path + ".new", file_path)
+
+
+def filter_generation(filter_path):
+    """Return the generation of the specified filter, or None if it
+    is not known."""
+    try:
+        with open(state_path(filter_path), "r") as f:
+            return json.load(f)["generation"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def compute_delta(old_buckets, new_buckets):
+    """Return a list of (filter file offset, data) records that transform
+    the old into the new bucket bit array.  The two arrays must have the
+    same length."""
+    if len(old_buckets) != len(new_buckets):
+        raise ValueError("Bucket arrays differ in size")
+    changed = (old_buckets ^ new_buckets).tobytes()
+    new_bytes = memoryview(new_buckets)
+
+    records = []
+    start = end = None
+    for m in CHANGED_BYTES.finditer(changed):
+        if start is not None and m.start() - end <= MAX_UNCHANGED_RUN:
+            end = m.end()
+            continue
+        if start is not None:
+            records.append((FILTER_HEADER_SIZE + start, bytes(new_bytes[start:end])))
+        start, end = m.span()
+    if start is not None:
+        records.append((FILTER_HEADER_SIZE + start, bytes(new_bytes[start:end])))
+    return records
+
+
+def write_delta(f, from_generation, to_generation, capacity, records):
+    """Write to the file object f the specified delta records."""
+    f.write(DELTA_HEADER.pack(from_generation, to_generation, capacity, len(records)))
+    for (offset, data) in records:
+        f.write(DELTA_RECORD.pack(offset, len(data)))
+        f.write(data)
+
+
+def _read_exactly(f, size):
+    """Return size bytes read from the file object f.
+    Raise ValueError if they are not available."""
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated filter delta")
+    return data
+
+
+def read_deltas(f):
+    """Return a generator over the deltas stored in the file object f.
+    Each delta is a tuple of the generation it applies to, the generation
+    it creates, the filter's capacity, and a list of (offset, data) records.
+    Raise ValueError if the deltas are truncated."""
+    while True:
+        header = f.read(DELTA_HEADER.size)
+        if not header:
+            return
+        if len(header) != DELTA_HEADER.size:
+            raise ValueError("Truncated filter delta")
+        (from_generation, to_generation, capacity, count) = DELTA_HEADER.unpack(
+            header
+        )
+        records = []
+        for _ in range(count):
+            (offset, length) = DELTA_RECORD.unpack(
+                _read_exactly(f, DELTA_RECORD.size)
+            )
+            records.append((offset, _read_exactly(f, length)))
+        yield (from_generation, to_generation, capacity, records)
+
+
+def apply_deltas(filter_file, delta_file, generation):
+    """Patch in place the filter stored in the (read-write binary) file
+    object filter_file with the deltas read from delta_file.
+    The filter must be of the specified generation.
+    Return the filter's new generation.
+    Raise ValueError if the deltas do not form a chain starting from
+    the specified generation or do not match the filter.
+    The complete chain is validated before the filter is patched, so that
+    a broken chain leaves the filter unmodified.
+
+    As the delta records contain the new data, repeating the application
+    of a (partially) applied chain yields the same result."""
+    filter_file.seek(0)
+    (capacity,) = struct.unpack(">Q", _read_exactly(filter_file, FILTER_HEADER_SIZE))
+    filter_size = filter_file.seek(0, os.SEEK_END)
+    deltas = list(read_deltas(delta_file))
+    for (from_generation, to_generation, delta_capacity, records) in deltas:
+        if from_generation != generation:
+            raise ValueError(
+                f"Delta for generation {from_generation} cannot be applied "
+                f"to generation {generation}"
+            )
+        if delta_capacity != capacity:
+            raise ValueError("Delta does not match the filter's capacity")
+        for (offset, data) in records:
+            if offset < FILTER_HEADER_SIZE or offset + len(data) > filter_size:
+                raise ValueError("Delta record is outside the filter")
+        generation = to_generation
+
+    for (_, _, _, records) in deltas:
+        for (offset, data) in records:
+            filter_file.seek(offset)
+            filter_file.write(data)
+    return generation
+
+
+def prune_deltas(filter_path, generation, keep):
+    """Remove the stored changes of the specified filter that created
+    generations older than the last keep ones up to the given generation."""
+    for old_generation in range(generation - keep, 0, -1):
+        try:
+            os.unlink(delta_path(filter_path, old_generation))
+        except FileNotFoundError:
+            break
+
+
+def stored_changes(filter_path):
+    """Return a generator over the changes stored for the specified filter.
+    Each element is a tuple of the generation the changes created and
+    a list of the (offset, length) byte ranges of the filter's bucket
+    array that they changed.
+    Changes that cannot be read are skipped."""
+    try:
+        names = os.listdir(filter_path + ".deltas")
+    except OSError:
+        return
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(delta_path(filter_path, int(name)), "rb") as f:
+                deltas = list(read_deltas(f))
+        except (OSError, ValueError):
+            continue
+        for (from_generation, to_generation, capacity, records) in deltas:
+            yield (
+                to_generation,
+                [
+                    (offset - FILTER_HEADER_SIZE, len(data))
+                    for (offset, data) in records
+                ],
+            )
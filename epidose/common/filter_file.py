@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+""" Plain and compressed Cuckoo filter files """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from dp3t.protocols.unlinkable_db import TracingDataBatch, buckets_size
+from epidose.common.filter_delta import FILTER_HEADER_SIZE
+import struct
+import zlib
+
+# A compressed filter file starts with this magic number, followed by
+# the filter's capacity as an 8-byte big-endian number, and a zlib stream
+# of the filter's buckets.  As filter capacities are far smaller than
+# 2^56, a plain filter file never starts with a non-zero byte.
+COMPRESSED_FILTER_MAGIC = b"EPDFLTZ1"
+
+# Number of bytes compressed or decompressed at once
+CHUNK_SIZE = 64 * 1024
+
+
+def compressed_path(filter_path):
+    """Return the path of the compressed version of the specified filter."""
+    return filter_path + ".z"
+
+
+def read_filter_header(f):
+    """Read the header of the (plain or compressed) filter stored in
+    the file object f.  Return a tuple with the filter's capacity and
+    whether it is compressed.
+    Raise ValueError if the header is truncated."""
+    header = f.read(FILTER_HEADER_SIZE)
+    compressed = header == COMPRESSED_FILTER_MAGIC
+    if compressed:
+        header = f.read(FILTER_HEADER_SIZE)
+    if len(header) != FILTER_HEADER_SIZE:
+        raise ValueError("Truncated filter header")
+    (capacity,) = struct.unpack(">Q", header)
+    return (capacity, compressed)
+
+
+def read_filter(f, mapped=False):
+    """Return the (plain or compressed) filter stored in the file object f.
+    Plain filters are mapped into memory if mapped is True."""
+    (capacity, compressed) = read_filter_header(f)
+    return TracingDataBatch(
+        fh=f,
+        capacity=capacity,
+        mapped=mapped and not compressed,
+        compressed=compressed,
+    )
+
+
+def write_compressed_filter(f, cuckoo_filter, level=zlib.Z_BEST_COMPRESSION):
+    """Write to the file object f the specified filter compressed at the
+    given zlib level."""
+    f.write(COMPRESSED_FILTER_MAGIC)
+    f.write(struct.pack(">Q", cuckoo_filter.capacity))
+    buckets = memoryview(cuckoo_filter.infected_observations.buckets)
+    compressor = zlib.compressobj(level)
+    for i in range(0, len(buckets), CHUNK_SIZE):
+        f.write(compressor.compress(buckets[i : i + CHUNK_SIZE]))
+    f.write(compressor.flush())
+
+
+def decompress_filter(src, dst):
+    """Write to the file object dst the plain version of the compressed
+    filter read from the file object src.
+    Raise ValueError if src does not contain a complete compressed filter
+    of the capacity specified in its header."""
+    (capacity, compressed) = read_filter_header(src)
+    if not compressed:
+        raise ValueError("Filter is not compressed")
+    dst.write(struct.pack(">Q", capacity))
+    size = buckets_size(capacity)
+    decompressor = zlib.decompressobj()
+    position = 0
+    while not decompressor.eof:
+        data = decompressor.unconsumed_tail or src.read(CHUNK_SIZE)
+        if not data:
+            raise ValueError("Compressed filter is truncated")
+        try:
+            # Obtaining one byte more than needed detects oversized filters
+            out = decompressor.decompress(data, size - position + 1)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed filter: {e}")
+        if position + len(out) > size:
+            raise ValueError("Compressed filter is larger than its capacity")
+        dst.write(out)
+        position += len(out)
+    if position != size:
+        raise ValueError("Compressed filter is smaller than its capacity")
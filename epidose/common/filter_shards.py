@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+""" Cuckoo filters sharded by day and their manifest """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import hashlib
+import json
+import os
+import re
+
+# A sharded filter is stored in a directory holding a (plain or compressed)
+# filter file for each day with reported infections, named after the day's
+# number (see unlinkable.day_from_epoch), and a manifest.  The manifest is
+# a JSON object whose "shards" member maps each day number to an object
+# with the SHA-256 digest and the size of the day's shard file.
+MANIFEST_NAME = "manifest.json"
+
+# Names of shard files
+SHARD_NAME = re.compile(r"^(\d+)\.bin$")
+
+
+def shards_path(filter_path):
+    """Return the path of the directory holding the shards of the
+    specified filter."""
+    return filter_path + ".shards"
+
+
+def shard_path(shards_dir, day):
+    """Return the path of the specified day's shard in the given directory."""
+    return os.path.join(shards_dir, f"{day}.bin")
+
+
+def manifest_path(shards_dir):
+    """Return the path of the manifest of the shards in the given directory."""
+    return os.path.join(shards_dir, MANIFEST_NAME)
+
+
+def shard_days(shards_dir):
+    """Return the set of days whose shard files exist in the given
+    directory."""
+    try:
+        names = os.listdir(shards_dir)
+    except FileNotFoundError:
+        return set()
+    return {int(m.group(1)) for m in map(SHARD_NAME.match, names) if m}
+
+
+def file_digest(file_path):
+    """Return the SHA-256 hex digest of the specified file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def shard_entry(file_path):
+    """Return the manifest entry of the specified shard file."""
+    return {"sha256": file_digest(file_path), "size": os.path.getsize(file_path)}
+
+
+def parse_manifest(data):
+    """Return a dictionary mapping day numbers to shard entries from the
+    specified JSON manifest string.
+    Raise ValueError if the manifest is invalid."""
+    try:
+        return {
+            int(day): {"sha256": str(entry["sha256"]), "size": int(entry["size"])}
+            for (day, entry) in json.loads(data)["shards"].items()
+        }
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid shard manifest: {e}")
+
+
+def read_manifest(shards_dir):
+    """Return a dictionary mapping day numbers to shard entries from the
+    manifest of the shards in the given directory, or an empty one if
+    no manifest exists.
+    Raise ValueError if the manifest is invalid."""
+    try:
+        with open(manifest_path(shards_dir), "r") as f:
+            return parse_manifest(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(shards_dir, manifest):
+    """Atomically replace the manifest of the shards in the given directory
+    with the specified dictionary mapping day numbers to shard entries."""
+    path = manifest_path(shards_dir)
+    with open(path + ".new", "w") as f:
+        json.dump(
+            {"shards": {str(day): entry for (day, entry) in sorted(manifest.items())}},
+            f,
+        )
+    os.rename(path + ".new", path)
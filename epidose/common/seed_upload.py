@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+""" Binary format of the seeds uploaded by contagious users """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from dp3t.config import LENGTH_SEED
+import struct
+
+# Content type of binary seed uploads; JSON uploads are application/json
+SEEDS_MIMETYPE = "application/octet-stream"
+
+# HTTP header carrying the authorization code of binary seed uploads
+AUTHORIZATION_HEADER = "X-Authorization"
+
+# Each record of a binary upload consists of an epoch as a 4-byte
+# big-endian number followed by the corresponding 32-byte seed.
+SEED_RECORD = struct.Struct(">I32s")
+
+# Epochs must be less than this to fit in a record
+EPOCH_LIMIT = 2 ** 32
+
+
+def check_seeds(epochs, seeds):
+    """Raise ValueError if the specified epochs and the corresponding seeds
+    cannot be represented in the binary upload format."""
+    for (epoch, seed) in zip(epochs, seeds):
+        if not 0 <= epoch < EPOCH_LIMIT:
+            raise ValueError(f"Invalid epoch {epoch}")
+        if len(seed) != LENGTH_SEED:
+            raise ValueError(f"Invalid seed length {len(seed)}")
+
+
+def pack_seeds(epochs, seeds):
+    """Return the binary upload representation of the specified epochs
+    and the corresponding seeds.
+    Raise ValueError if they cannot be represented in it."""
+    check_seeds(epochs, seeds)
+    return b"".join(
+        SEED_RECORD.pack(epoch, seed) for (epoch, seed) in zip(epochs, seeds)
+    )
+
+
+def unpack_seeds(data):
+    """Return a tuple of the epochs and seeds in the specified binary upload.
+    Raise ValueError if the data is not a sequence of complete records."""
+    if len(data) % SEED_RECORD.size:
+        raise ValueError("Truncated seed upload")
+    epochs = []
+    seeds = []
+    for (epoch, seed) in SEED_RECORD.iter_unpack(data):
+        epochs.append(epoch)
+        seeds.append(seed)
+    return (epochs, seeds)
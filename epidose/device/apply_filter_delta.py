@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+""" Patch the Cuckoo filter in place with changes obtained from the server """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import argparse
+from epidose.common.daemon import Daemon
+from epidose.common.filter_delta import (
+    apply_deltas,
+    delta_path,
+    generation_path,
+    prune_deltas,
+    read_deltas,
+    read_generation,
+    write_delta,
+    write_generation,
+)
+from epidose.common.filter_file import decompress_filter, read_filter_header
+import os
+import sys
+
+
+def store_deltas(filter_path, delta_file):
+    """Store each delta read from delta_file as the changes that created
+    its generation of the specified filter.  These allow contact matching
+    to examine only the observations affected by the filter's changes."""
+    delta_file.seek(0)
+    for (from_generation, to_generation, capacity, records) in read_deltas(
+        delta_file
+    ):
+        path = delta_path(filter_path, to_generation)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".new", "wb") as f:
+            write_delta(f, from_generation, to_generation, capacity, records)
+        os.rename(path + ".new", path)
+
+
+def decompress_in_place(filter_path):
+    """Replace the specified filter with its plain version, if it is
+    compressed, so that it can be patched in place.
+    Return True if the filter was decompressed."""
+    with open(filter_path, "rb") as src:
+        (_, compressed) = read_filter_header(src)
+        if not compressed:
+            return False
+        src.seek(0)
+        with open(filter_path + ".new", "wb") as dst:
+            decompress_filter(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+    os.rename(filter_path + ".new", filter_path)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Patch the Cuckoo filter with changes obtained from the server"
+    )
+    parser.add_argument(
+        "-d", "--debug", help="Run in debug mode logging to stderr", action="store_true"
+    )
+    parser.add_argument(
+        "-g",
+        "--generation",
+        help="File holding the filter's generation (default: filter.gen)",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep-deltas",
+        help="Number of filter generation deltas to keep for contact matching",
+        type=int,
+        default=30,
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="Set verbose logging", action="store_true"
+    )
+    parser.add_argument("filter", help="Cuckoo filter file")
+    parser.add_argument("delta", help="File containing the filter's changes")
+    args = parser.parse_args()
+
+    # Setup logging
+    daemon = Daemon("apply_filter_delta", args)
+    global logger
+    logger = daemon.get_logger()
+
+    generation_file = args.generation or generation_path(args.filter)
+    try:
+        generation = read_generation(generation_file)
+        if decompress_in_place(args.filter):
+            logger.debug("Decompressed the filter")
+        with open(args.filter, "r+b") as filter_file, open(
+            args.delta, "rb"
+        ) as delta_file:
+            new_generation = apply_deltas(filter_file, delta_file, generation)
+            filter_file.flush()
+            os.fsync(filter_file.fileno())
+            store_deltas(args.filter, delta_file)
+    except (OSError, ValueError) as e:
+        logger.error(f"Unable to apply filter delta: {e}")
+        sys.exit(1)
+
+    # Update the generation only after the patched filter is safely stored
+    write_generation(generation_file, new_generation)
+    prune_deltas(args.filter, new_generation, args.keep_deltas)
+    logger.info(f"Filter updated from generation {generation} to {new_generation}")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
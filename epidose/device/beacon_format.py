@@ -19,6 +19,8 @@ __copyright__ = """
 """
 __license__ = "Apache 2.0"
 
+import struct
+
 # Start of a BLE transmission command or received packet
 # This is defined in the Bluetoth Core Specification V4.0
 # page 1062 and in the Apple/Google Contact Tracing Bluetooth
@@ -39,3 +41,40 @@ BLE_PACKET = bytes(
         0xFD,  # Service Data: Contact Detection Service (0xFD6F)
     ]
 )
+
+# Layout of a received HCI LE advertising report event carrying
+# a contact tracing packet
+PARAMETER_LENGTH_OFFSET = 2  # Length of the event's parameters
+CONTACT_PARAMETER_LENGTH = 40
+BDADDR_OFFSET = 7  # Sender's address, least significant byte first
+BDADDR_END = 13
+BLE_PACKET_OFFSET = 13
+BLE_PACKET_END = BLE_PACKET_OFFSET + len(BLE_PACKET)
+EPHID_OFFSET = BLE_PACKET_END
+EPHID_END = EPHID_OFFSET + 16
+CONTACT_PACKET_SIZE = 3 + CONTACT_PARAMETER_LENGTH
+
+# The received signal strength indication is the packet's last byte
+RSSI = struct.Struct("b")
+
+
+def parse_packet(packet):
+    """Return an (ephid, rssi) tuple from the specified received packet,
+    or None if it is not a contact tracing packet.
+    Other packets are rejected without copying any of their data."""
+    view = memoryview(packet)
+    if (
+        len(view) != CONTACT_PACKET_SIZE
+        or view[PARAMETER_LENGTH_OFFSET] != CONTACT_PARAMETER_LENGTH
+        or view[BLE_PACKET_OFFSET:BLE_PACKET_END] != BLE_PACKET
+    ):
+        return None
+    ephid = bytes(view[EPHID_OFFSET:EPHID_END])
+    (rssi,) = RSSI.unpack_from(view, CONTACT_PACKET_SIZE - 1)
+    return (ephid, rssi)
+
+
+def sender_bdaddr(packet):
+    """Return the address of the specified packet's sender, most
+    significant byte first."""
+    return bytes(packet[BDADDR_OFFSET:BDADDR_END])[::-1]
@@ -20,18 +20,32 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 import argparse
-import bluetooth._bluetooth as bluez
+import asyncio
 from datetime import datetime
+from dp3t.protocols.client_database import (
+    OBSERVATION_BUFFER_SIZE,
+    OBSERVATION_FLUSH_INTERVAL,
+)
+from dp3t.protocols.storage_profile import storage_profile
 from dp3t.protocols.unlinkable_db import ContactTracer
 from epidose.common.daemon import Daemon
-from epidose.device.beacon_format import BLE_PACKET
+from epidose.device.beacon_format import parse_packet, sender_bdaddr
+from epidose.device.hci import format_bdaddr
 from epidose.device.device_io import green_led_set, orange_led_set, setup_leds
+import errno
+from select import select
+import logging
+import signal
 import struct
 import sys
 
 # RSSI above this value is considered close and causes LED to flash
 CLOSE_CONTACT_RSSI = -50
 
+# Maximum number of packets read on each asyncio event loop wakeup, so that
+# dense advertising cannot delay the timer tasks
+MAX_PACKETS_PER_WAKEUP = 64
+
 OGF_LE_CTL = 0x08
 OCF_LE_SET_SCAN_ENABLE = 0x000C
 
@@ -41,6 +55,8 @@ daemon = None
 
 def set_receive(socket):
     """Setup to receive contact tracing packets."""
+    import bluetooth._bluetooth as bluez
+
     # Enable scanning
     enable_scanning = struct.pack("<BB", 0x01, 0x00)
     bluez.hci_send_cmd(socket, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, enable_scanning)
@@ -53,41 +69,17 @@ def set_receive(socket):
     socket.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, listen_filter)
 
 
-def unpack_byte(b):
-    """Return b unpacked from a byte value"""
-    return struct.unpack("b", bytes([b]))
-
-
-def process_packet(socket):
-    """Read and process a single broadcast packet."""
-    packet = socket.recv(255)
-
-    # TODO: This is both too frequent (it triggers for every packet) and
-    # can also be too infrequent (if no packets are received)
-    # SUGGESTION: Maybe we can implement a simple protocol
-    # that increases the sleep time of this function if no packets are received.
-    # However, once a packet is received, we can reset the sleep.
-    now = datetime.now()
-    receiver.check_advance_day(now)
-
+def process_packet(packet):
+    """Process a single received broadcast packet."""
     # Early exit for other packets
-    (packet_length,) = unpack_byte(packet[2])
-    if packet_length != 40:
-        return
-    # Ensure the packet is contact detection service
-    if packet[13:25] != BLE_PACKET:
+    contact = parse_packet(packet)
+    if contact is None:
         return
+    (ephid, rssi) = contact
 
     # Print sender's Bluetooth MAC address
-    bdaddr = packet[7:13]
-    bdaddr = bdaddr[::-1].hex().upper()
-    logger.debug(
-        f"Received packet from {':'.join(bdaddr[i:i+2] for i in range(0, len(bdaddr), 2))}"
-    )
-
-    # This is a contact detection service packet
-    ephid = packet[25:41]
-    (rssi,) = unpack_byte(packet[-1])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Received packet from {format_bdaddr(sender_bdaddr(packet))}")
 
     if rssi > CLOSE_CONTACT_RSSI:
         orange_led_set(True)
@@ -96,6 +88,10 @@ def process_packet(socket):
 
     logger.info(f"Got ephid {ephid.hex()} RSSI {rssi}")
 
+    # The day normally advances at midnight in the main loop; this handles
+    # packets received before the main loop got to advance it
+    now = datetime.now()
+    advance_day_if_due(now)
     receiver.add_observation(ephid, now, rssi)
 
     if rssi > CLOSE_CONTACT_RSSI:
@@ -104,6 +100,71 @@ def process_packet(socket):
         green_led_set(False)
 
 
+def advance_day_if_due(now):
+    """Advance the receiver's day to that of the specified time, deleting
+    the observations past their retention period, if the day has ended."""
+    while receiver.seconds_to_next_day(now) == 0:
+        receiver.check_advance_day(now)
+
+
+def read_packets(socket):
+    """Process the packets that can be read from the specified
+    non-blocking socket without waiting, up to MAX_PACKETS_PER_WAKEUP."""
+    for _ in range(MAX_PACKETS_PER_WAKEUP):
+        try:
+            packet = socket.recv(255)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        process_packet(packet)
+
+
+async def flush_periodically(flush_interval):
+    """Store the buffered observations every flush_interval seconds."""
+    while True:
+        await asyncio.sleep(flush_interval)
+        receiver.flush_observations_if_due()
+
+
+async def advance_day_periodically(check_interval):
+    """Advance the receiver's day at each midnight.  Check the time at least
+    every check_interval seconds, so that clock adjustments (e.g. by NTP on
+    a device without a real-time clock) cannot delay the advance."""
+    while True:
+        await asyncio.sleep(
+            min(check_interval, receiver.seconds_to_next_day(datetime.now()))
+        )
+        advance_day_if_due(datetime.now())
+
+
+async def receive_packets(socket, flush_interval):
+    """Process the packets received from the specified socket in an
+    asyncio event loop, until a termination signal is received."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for s in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(s, stop.set)
+
+    socket.setblocking(False)
+    loop.add_reader(socket.fileno(), read_packets, socket)
+    tasks = [
+        asyncio.create_task(flush_periodically(flush_interval)),
+        asyncio.create_task(advance_day_periodically(flush_interval)),
+    ]
+    try:
+        await stop.wait()
+    finally:
+        loop.remove_reader(socket.fileno())
+        for task in tasks:
+            task.cancel()
+
+
+def terminate(signum, frame):
+    """Exit cleanly, storing the buffered observations, on termination."""
+    sys.exit(0)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Contact tracing beacon receiver")
     parser.add_argument(
@@ -115,6 +176,28 @@ def main():
         help="Specify the database location",
         default="/var/lib/epidose/client-database.db",
     )
+    parser.add_argument(
+        "-a",
+        "--asyncio",
+        help="Receive packets in an asyncio event loop",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-b",
+        "--buffer-size",
+        help="Number of distinct observations buffered before storing them "
+        f"(default: {OBSERVATION_BUFFER_SIZE}; 0 stores each one immediately)",
+        type=int,
+        default=OBSERVATION_BUFFER_SIZE,
+    )
+    parser.add_argument(
+        "-f",
+        "--flush-interval",
+        help="Maximum number of seconds observations stay buffered "
+        f"(default: {OBSERVATION_FLUSH_INTERVAL})",
+        type=int,
+        default=OBSERVATION_FLUSH_INTERVAL,
+    )
     parser.add_argument(
         "-i",
         "--iface",
@@ -122,6 +205,14 @@ def main():
         type=int,
         default=0,
     )
+    parser.add_argument(
+        "-P",
+        "--storage-profile",
+        help="Database storage profile, optionally followed by comma-separated "
+        "setting=value overrides (default: sdcard)",
+        type=storage_profile,
+        default="sdcard",
+    )
     parser.add_argument("-t", "--test", help="Test script", action="store_true")
     parser.add_argument(
         "-v", "--verbose", help="Set verbose logging", action="store_true"
@@ -139,14 +230,41 @@ def main():
 
     # Receive and process beacon packets
     global receiver
-    receiver = ContactTracer(None, args.database, transmitter=False)
+    receiver = ContactTracer(
+        None,
+        args.database,
+        transmitter=False,
+        observation_buffer_size=args.buffer_size,
+        observation_flush_interval=args.flush_interval,
+        storage_profile=args.storage_profile,
+    )
     if args.test:
         sys.exit(0)
+    # Imported here, so that the packet processing works without PyBluez
+    import bluetooth._bluetooth as bluez
+
     socket = bluez.hci_open_dev(args.iface)
     set_receive(socket)
     setup_leds()
-    while True:
-        process_packet(socket)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        if args.asyncio:
+            asyncio.run(receive_packets(socket, args.flush_interval))
+            return
+        while True:
+            # Wake up periodically to store buffered observations
+            # and at midnight to advance the day, even when no packets
+            # are received
+            timeout = min(
+                args.flush_interval, receiver.seconds_to_next_day(datetime.now())
+            )
+            (readable, _, _) = select([socket], [], [], timeout)
+            if readable:
+                process_packet(socket.recv(255))
+            receiver.flush_observations_if_due()
+            advance_day_if_due(datetime.now())
+    finally:
+        receiver.flush_observations()
 
 
 if __name__ == "__main__":
@@ -22,18 +22,28 @@ __license__ = "Apache 2.0"
 import argparse
 from epidose.common.daemon import Daemon
 from epidose.common.interruptible_sleep import InterruptibleSleep
-from dp3t.config import EPOCH_LENGTH
 from datetime import datetime
+from dp3t.protocols.storage_profile import storage_profile
+from dp3t.protocols.unlinkable import epoch_from_time, seconds_to_next_epoch
 from dp3t.protocols.unlinkable_db import ContactTracer
 from epidose.device.beacon_format import BLE_PACKET
+from epidose.device.hci import DryRunHci, HciSocket
 import signal
 import secrets
 from sys import exit
 
+# Seconds to wait before retrying a failed transmission setup
+RETRY_INTERVAL = 10
 
-def set_transmit(interface, ephid, rssi):
-    """Set the Bluetooth low energy beacon to transmit on the specified
-    interface the given 16-byte ephid with the given received signal
+# Maximum number of seconds between checks of the current epoch, so that
+# clock adjustments (e.g. by NTP on a device without a real-time clock)
+# cannot keep a stale ephid on the air
+CHECK_INTERVAL = 60
+
+
+def set_transmit(hci, ephid, rssi):
+    """Set the Bluetooth low energy beacon to transmit through the specified
+    HciDevice the given 16-byte ephid with the given received signal
     strength indication (rssi).
     The beacon uses the AltBeacon format.
     For now the beacon code starts with ED 05 01 01, followed by the ephid.
@@ -43,51 +53,51 @@ def set_transmit(interface, ephid, rssi):
     assert len(ephid) == 16
     assert rssi >= 0 and rssi < 255
 
-    cmd = [
-        "hcitool",
-        "-i",
-        interface,
-        "cmd",
-        "0x08",
-        "0x0008",  # HCI_LE_Set_Advertising_Data command (7.8.7, p. 1062)
-    ]
-
-    # Add BLE command
-    ble = BLE_PACKET.hex()
-    for p in range(0, len(BLE_PACKET) * 2, 2):
-        cmd.append(ble[p : p + 2])
-
-    # Add ephid
-    ephid = ephid.hex()
-    for p in range(0, 32, 2):
-        cmd.append(ephid[p : p + 2])
-
-    cmd.append(format(rssi, "x"))  # Reference RSSI
-    cmd.append("01")  # Manufacturer reserved
-    daemon.run_command(cmd)
+    # Reference RSSI, followed by a manufacturer reserved byte
+    hci.set_advertising_data(BLE_PACKET + ephid + bytes([rssi, 0x01]))
 
 
 def generate_random_bdaddr():
-    """Generate a 6-byte hexadecimal number that will act
-    as the new Bluetooth Device (MAC) Address (bdaddr),
-    then return it in a MAC address-like format.
+    """Generate and return a random 6-byte Bluetooth Device (MAC)
+    Address (bdaddr).
     """
 
-    # 5d30c4a19c1e
-    bdaddr = secrets.token_hex(6)
-    # (5, d, 3, 0, c, 4, a, 1, 9, c, 1, e)
-    bdaddr = list(bdaddr)
+    bdaddr = bytearray(secrets.token_bytes(6))
 
     # The values below denote that the bdaddr is locally administered
-    locally_administered_elements = ["2", "6", "a", "e"]
+    locally_administered_values = [0x2, 0x6, 0xA, 0xE]
 
-    bdaddr[1] = secrets.choice(locally_administered_elements)
-    # (5, 2, 3, 0, c, 4, a, 1, 9, c, 1, e) -> 5230c4a19c1e
-    bdaddr = "".join(bdaddr)
-    # 52 0x30 0xc4 0xa1 0x9c 0x1e
-    bdaddr = " 0x".join(bdaddr[i : i + 2] for i in range(0, len(bdaddr), 2))
-    # 0x52 0x30 0xc4 0xa1 0x9c 0x1e
-    return "0x" + bdaddr
+    bdaddr[0] = (bdaddr[0] & 0xF0) | secrets.choice(locally_administered_values)
+    return bytes(bdaddr)
+
+
+class EphidSchedule:
+    """The EphIDs the transmitter broadcasts during the current day.
+    These are obtained from the database once a day, so that looking up
+    the EphID of each epoch requires no database access."""
+
+    def __init__(self, transmitter):
+        """Construct a schedule for the specified ContactTracer."""
+        self.transmitter = transmitter
+        self.day = None
+        self.ephids = {}
+
+    def get_ephid_for_time(self, time):
+        """Return the EphID corresponding to the specified time, advancing
+        the transmitter's day if needed.
+
+        Raises:
+            ValueError: If the requested ephid is unavailable
+        """
+        self.transmitter.check_advance_day(time)
+        if self.day != self.transmitter.today:
+            self.ephids = self.transmitter.get_ephids_for_today()
+            self.day = self.transmitter.today
+        ephid = self.ephids.get(epoch_from_time(time))
+        if ephid is None:
+            # Not part of the current day's schedule
+            return self.transmitter.get_ephid_for_time(time)
+        return ephid
 
 
 def main():
@@ -111,9 +121,17 @@ def main():
     parser.add_argument(
         "-n",
         "--dry-run",
-        help="Do not execute the required command(s)",
+        help="Do not issue the required Bluetooth command(s)",
         action="store_true",
     )
+    parser.add_argument(
+        "-P",
+        "--storage-profile",
+        help="Database storage profile, optionally followed by comma-separated "
+        "setting=value overrides (default: sdcard)",
+        type=storage_profile,
+        default="sdcard",
+    )
     parser.add_argument(
         "-r",
         "--rssi",
@@ -138,64 +156,54 @@ def main():
     global logger
     logger = daemon.get_logger()
 
-    global dry_run
-    dry_run = args.dry_run
-
-    interface = f"hci{args.iface}"
+    if args.dry_run:
+        hci = DryRunHci(args.iface, logger)
+    else:
+        hci = HciSocket(args.iface, logger)
 
     # Transmit and store beacon packets
     current_ephid = None
-    transmitter = ContactTracer(None, args.database, receiver=False)
+    transmitter = ContactTracer(
+        None, args.database, receiver=False, storage_profile=args.storage_profile
+    )
+    schedule = EphidSchedule(transmitter)
     sleeper = InterruptibleSleep([signal.SIGTERM, signal.SIGINT])
     while True:
         now = datetime.now()
-        transmitter.check_advance_day(now)
-        ephid = transmitter.get_ephid_for_time(now)
+        ephid = schedule.get_ephid_for_time(now)
         if ephid != current_ephid:
 
-            # Generate random bdaddr
-            bdaddr = generate_random_bdaddr()
-            bdaddr = bdaddr.split()
-
-            # Change local device bdaddr
-            daemon.run_command(
-                [
-                    "hcitool",
-                    "-i",
-                    interface,
-                    "cmd",
-                    "0x3f",
-                    "0x001",
-                    bdaddr[5],
-                    bdaddr[4],
-                    bdaddr[3],
-                    bdaddr[2],
-                    bdaddr[1],
-                    bdaddr[0],
-                ]
-            )
-
-            # Enable the bluetooth interface
-            daemon.run_command(["hciconfig", interface, "up"])
-
-            # Enable LE advertising
-            daemon.run_command(
-                ["hcitool", "-i", interface, "cmd", "0x08", "0x000a", "01"]
-            )
-
-            set_transmit(interface, ephid, args.rssi)
-            current_ephid = ephid
-            logger.debug(f"Change ephid to {ephid.hex()}")
+            try:
+                # Change local device bdaddr to a random one
+                hci.set_bdaddr(generate_random_bdaddr())
+
+                # Enable the bluetooth interface
+                hci.device_up()
+
+                # Enable LE advertising
+                hci.set_advertise_enable(True)
+
+                set_transmit(hci, ephid, args.rssi)
+            except OSError as e:
+                # Retry after RETRY_INTERVAL
+                logger.error(f"Unable to set up transmission: {e}")
+            else:
+                current_ephid = ephid
+                logger.debug(f"Change ephid to {ephid.hex()}")
+
+        if args.test:
+            break
 
         # Wait for the current epoch (e.g. 15 minutes) to pass
-        # The API can't tell us TTL, so sample every minute
-        sleeper.sleep(EPOCH_LENGTH / 60)
+        delay = min(CHECK_INTERVAL, seconds_to_next_epoch(datetime.now()))
+        if ephid != current_ephid:
+            delay = min(RETRY_INTERVAL, delay)
+        sleeper.sleep(delay)
         if sleeper.signaled:
             # Stop advertising
-            daemon.run_command(["hciconfig", interface, "noleadv"])
+            hci.set_advertise_enable(False)
+            hci.close()
             exit(0)
-        if args.test:
-            break
 
 
 if __name__ == "__main__":
@@ -20,12 +20,52 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 import argparse
-from dp3t.protocols.unlinkable_db import TracingDataBatch, ContactTracer
+from dp3t.protocols.storage_profile import storage_profile
+from dp3t.protocols.unlinkable_db import ContactTracer
 from epidose.common.daemon import Daemon
+from epidose.common.filter_delta import (
+    generation_path,
+    read_generation,
+    stored_changes,
+)
+from epidose.common.filter_file import read_filter
+from epidose.common.filter_shards import read_manifest, shard_path
 from epidose.device.device_io import cleanup, red_led_set, setup_leds
-import struct
+import os
 import sys
 
+
+def read_filter_file(filter_path):
+    """Return the filter stored in the specified file, set up for
+    incremental matching if its generation is known."""
+    # Plain filters are mapped; compressed ones are decompressed as read
+    with open(filter_path, "rb") as f:
+        cuckoo_filter = read_filter(f, mapped=True)
+
+    # Allow incremental matching if the filter's generation is known
+    try:
+        cuckoo_filter.generation = read_generation(generation_path(filter_path))
+    except (OSError, ValueError):
+        logger.debug("Filter generation not known")
+    else:
+        for (generation, byte_ranges) in stored_changes(filter_path):
+            cuckoo_filter.add_changes(generation, byte_ranges)
+    return cuckoo_filter
+
+
+def read_shards(shards_dir):
+    """Return a dictionary mapping the days of the filter shards listed in
+    the manifest of the specified directory to the corresponding filters."""
+    shards = {}
+    for day in read_manifest(shards_dir):
+        try:
+            with open(shard_path(shards_dir, day), "rb") as f:
+                shards[day] = read_filter(f, mapped=True)
+        except FileNotFoundError:
+            logger.warning(f"Filter shard {day} is missing")
+    return shards
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Read Cuckoo filter and check against contacts"
@@ -40,10 +80,20 @@ def main():
         default="/var/lib/epidose/client-database.db",
     )
     parser.add_argument("-o", "--observation", help="Observation hash to check")
+    parser.add_argument(
+        "-P",
+        "--storage-profile",
+        help="Database storage profile, optionally followed by comma-separated "
+        "setting=value overrides (default: sdcard)",
+        type=storage_profile,
+        default="sdcard",
+    )
     parser.add_argument(
         "-v", "--verbose", help="Set verbose logging", action="store_true"
     )
-    parser.add_argument("filter", help="Cuckoo filter file")
+    parser.add_argument(
+        "filter", help="Cuckoo filter file, or directory of per-day filter shards"
+    )
     args = parser.parse_args()
 
     # Setup logging
@@ -51,23 +101,33 @@ def main():
     global logger
     logger = daemon.get_logger()
 
-    with open(args.filter, "rb") as f:
-        (capacity,) = struct.unpack(">Q", f.read(8))
-        cuckoo_filter = TracingDataBatch(fh=f, capacity=capacity)
+    if os.path.isdir(args.filter):
+        shards = read_shards(args.filter)
+        filters = list(shards.values())
+    else:
+        cuckoo_filter = read_filter_file(args.filter)
+        filters = [cuckoo_filter]
 
     if args.observation:
-        if (
-            bytes(bytearray.fromhex(args.observation))
-            in cuckoo_filter.infected_observations
-        ):
+        observation = bytes(bytearray.fromhex(args.observation))
+        if any(observation in f.infected_observations for f in filters):
             print("Found")
             sys.exit(0)
         else:
             print("Not found")
             sys.exit(1)
     else:
-        ct = ContactTracer(None, args.database, transmitter=False, receiver=False)
-        matches = ct.matches_with_batch(cuckoo_filter)
+        ct = ContactTracer(
+            None,
+            args.database,
+            transmitter=False,
+            receiver=False,
+            storage_profile=args.storage_profile,
+        )
+        if os.path.isdir(args.filter):
+            matches = ct.matches_with_shards(shards)
+        else:
+            matches = ct.matches_with_batch(cuckoo_filter)
         logger.info(f"{'Contact match' if matches else 'No contact match'}")
         setup_leds()
         if matches:
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+""" Bluetooth host controller interface (HCI) commands issued in-process """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from abc import ABC, abstractmethod
+import errno
+import fcntl
+
+# Command groups and commands (Bluetooth Core Specification V4.0, Vol. 2,
+# Part E, Section 7.8)
+OGF_LE_CTL = 0x08
+OCF_LE_SET_ADVERTISING_DATA = 0x0008
+OCF_LE_SET_ADVERTISE_ENABLE = 0x000A
+
+# Vendor-specific (Broadcom) command setting the device address
+OGF_VENDOR_CMD = 0x3F
+OCF_BCM_WRITE_BD_ADDR = 0x0001
+
+# Length of the LE advertising data command parameter: the number of
+# significant advertising data octets followed by 31 data octets
+ADVERTISING_DATA_LENGTH = 32
+
+# Length of a Bluetooth device address
+BDADDR_LENGTH = 6
+
+# ioctl bringing up an HCI device: _IOW('H', 201, int)
+HCIDEVUP = 0x400448C9
+
+
+def format_bdaddr(bdaddr):
+    """Return the specified 6-byte device address in the usual
+    colon-separated format."""
+    return ":".join(f"{b:02X}" for b in bdaddr)
+
+
+class HciDevice(ABC):
+    """The commands epidose issues to a Bluetooth controller.
+
+    Subclasses provide the means to send a command and to bring up the
+    device.
+    """
+
+    def __init__(self, dev_id, logger):
+        """Construct an object for issuing commands to the Bluetooth device
+        with the specified number (e.g. 0 for hci0)."""
+        self.dev_id = dev_id
+        self.logger = logger
+
+    @abstractmethod
+    def send_command(self, ogf, ocf, params):
+        """Send the command with the specified group, code, and
+        parameter bytes."""
+
+    @abstractmethod
+    def device_up(self):
+        """Bring the device up, if it is not already up."""
+
+    def close(self):
+        """Release the resources associated with the device."""
+
+    def set_bdaddr(self, bdaddr):
+        """Set the device's address to the specified 6 bytes, given in
+        their usual (most significant first) order."""
+        if len(bdaddr) != BDADDR_LENGTH:
+            raise ValueError("Device address must be 6 bytes")
+        self.logger.debug(f"Set device address to {format_bdaddr(bdaddr)}")
+        # The address is transmitted least significant byte first
+        self.send_command(OGF_VENDOR_CMD, OCF_BCM_WRITE_BD_ADDR, bytes(bdaddr[::-1]))
+
+    def set_advertising_data(self, data):
+        """Set the data broadcast in LE advertisements.  As in BLE_PACKET,
+        the data start with the number of their significant octets."""
+        if len(data) > ADVERTISING_DATA_LENGTH:
+            raise ValueError("Advertising data exceed 32 bytes")
+        self.logger.debug(f"Set advertising data to {data.hex()}")
+        params = bytes(data).ljust(ADVERTISING_DATA_LENGTH, b"\0")
+        self.send_command(OGF_LE_CTL, OCF_LE_SET_ADVERTISING_DATA, params)
+
+    def set_advertise_enable(self, enable):
+        """Start or stop LE advertising."""
+        self.logger.debug(f"{'Enable' if enable else 'Disable'} LE advertising")
+        self.send_command(
+            OGF_LE_CTL, OCF_LE_SET_ADVERTISE_ENABLE, bytes([1 if enable else 0])
+        )
+
+
+class HciSocket(HciDevice):
+    """Issue commands through a raw HCI socket."""
+
+    def __init__(self, dev_id, logger):
+        """Open a raw HCI socket to the specified device."""
+        super().__init__(dev_id, logger)
+        # Imported here, so that dry runs work without PyBluez
+        import bluetooth._bluetooth as bluez
+
+        self.bluez = bluez
+        self.socket = bluez.hci_open_dev(dev_id)
+
+    def send_command(self, ogf, ocf, params):
+        """Send the command with the specified group, code, and
+        parameter bytes.  If this fails, send it again through a newly
+        opened socket."""
+        try:
+            self.bluez.hci_send_cmd(self.socket, ogf, ocf, params)
+        except OSError as e:
+            # The socket stops working when the adapter is reset
+            self.logger.warning(f"hci{self.dev_id} command failed: {e}; reopening")
+            self.reopen()
+            self.bluez.hci_send_cmd(self.socket, ogf, ocf, params)
+
+    def reopen(self):
+        """Replace the HCI socket with a newly opened one."""
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        self.socket = self.bluez.hci_open_dev(self.dev_id)
+
+    def device_up(self):
+        """Bring the device up, if it is not already up."""
+        try:
+            fcntl.ioctl(self.socket.fileno(), HCIDEVUP, self.dev_id)
+        except OSError as e:
+            if e.errno != errno.EALREADY:
+                raise
+
+    def close(self):
+        """Close the HCI socket."""
+        self.socket.close()
+
+
+class DryRunHci(HciDevice):
+    """Log and record commands without issuing them."""
+
+    def __init__(self, dev_id, logger):
+        """Construct an object recording the commands for the specified
+        device in its commands list."""
+        super().__init__(dev_id, logger)
+        self.commands = []
+        self.up = False
+
+    def send_command(self, ogf, ocf, params):
+        """Record the command with the specified group, code, and
+        parameter bytes."""
+        self.logger.debug(f"hci{self.dev_id} cmd {ogf:#04x} {ocf:#06x} {params.hex()}")
+        self.commands.append((ogf, ocf, params))
+
+    def device_up(self):
+        """Record that the device was brought up."""
+        self.logger.debug(f"hci{self.dev_id} up")
+        self.up = True
@@ -70,5 +70,9 @@ while : ; do
       sleep "$WIFI_RETRY_TIME"
     fi
   done
-  run_python check_infection_risk "$FILTER" || :
+  if [ -d "$FILTER_SHARDS" ] ; then
+    run_python check_infection_risk "$FILTER_SHARDS" || :
+  else
+    run_python check_infection_risk "$FILTER" || :
+  fi
 done
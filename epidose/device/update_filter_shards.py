@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+""" Bring the per-day Cuckoo filter shards up to date with the server """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import argparse
+from epidose.common.daemon import Daemon
+from epidose.common.filter_shards import (
+    file_digest,
+    parse_manifest,
+    read_manifest,
+    shard_days,
+    shard_path,
+    write_manifest,
+)
+import os
+import requests
+import sys
+
+# Exit code signifying that the server does not publish sharded filters
+EXIT_NOT_PUBLISHED = 2
+
+# Seconds to wait for the server to accept a connection and to send data,
+# so that a stalled connection cannot hang the update
+TIMEOUT = (10, 60)
+
+
+def fetch_shard(session, url, params, path, entry):
+    """Atomically store in path the shard obtained from the specified URL
+    and query parameters, verifying it against its manifest entry.
+    Raise ValueError if the obtained shard does not match the entry."""
+    res = session.get(url, params=params, stream=True, timeout=TIMEOUT)
+    res.raise_for_status()
+    with open(path + ".new", "wb") as f:
+        for block in res.iter_content(64 * 1024):
+            f.write(block)
+    if file_digest(path + ".new") != entry["sha256"]:
+        os.unlink(path + ".new")
+        raise ValueError(f"Shard obtained from {url} does not match its manifest")
+    os.rename(path + ".new", path)
+
+
+def update_shards(session, server, params, shards_dir):
+    """Bring the shards in shards_dir up to date with those published
+    by the server, downloading only new and changed shards, and removing
+    those no longer published.  Return the number of downloaded shards,
+    or None if the server does not publish sharded filters."""
+    res = session.get(f"{server}/filter/shards", params=params, timeout=TIMEOUT)
+    if res.status_code == 404:
+        return None
+    res.raise_for_status()
+    published = parse_manifest(res.text)
+
+    os.makedirs(shards_dir, exist_ok=True)
+    try:
+        local = read_manifest(shards_dir)
+    except ValueError:
+        local = {}
+    existing = shard_days(shards_dir)
+
+    fetched = 0
+    for (day, entry) in sorted(published.items()):
+        if day in existing and local.get(day) == entry:
+            continue
+        logger.debug(f"Obtaining shard {day}")
+        fetch_shard(
+            session,
+            f"{server}/filter/shards/{day}",
+            params,
+            shard_path(shards_dir, day),
+            entry,
+        )
+        fetched += 1
+
+    # Record the shards only after they have been obtained; this also
+    # marks them as fresh
+    write_manifest(shards_dir, published)
+    for day in existing - set(published):
+        logger.debug(f"Removing expired shard {day}")
+        os.unlink(shard_path(shards_dir, day))
+    return fetched
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bring the per-day Cuckoo filter shards up to date"
+    )
+    parser.add_argument(
+        "-d", "--debug", help="Run in debug mode logging to stderr", action="store_true"
+    )
+    parser.add_argument("-m", "--mac", help="Device MAC address sent to the server")
+    parser.add_argument("-s", "--server", help="Server URL", required=True)
+    parser.add_argument(
+        "-v", "--verbose", help="Set verbose logging", action="store_true"
+    )
+    parser.add_argument("shards", help="Directory holding the filter shards")
+    args = parser.parse_args()
+
+    # Setup logging
+    daemon = Daemon("update_filter_shards", args)
+    global logger
+    logger = daemon.get_logger()
+
+    params = {"mac": args.mac} if args.mac else {}
+    try:
+        with requests.Session() as session:
+            fetched = update_shards(session, args.server, params, args.shards)
+    except (OSError, ValueError, requests.RequestException) as e:
+        logger.error(f"Unable to update filter shards: {e}")
+        sys.exit(1)
+    if fetched is None:
+        logger.info("The server does not publish filter shards")
+        sys.exit(EXIT_NOT_PUBLISHED)
+    logger.info(f"Filter shards updated: {fetched} obtained")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,9 +20,11 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 import argparse
+from dp3t.protocols.storage_profile import storage_profile
 from dp3t.protocols.unlinkable_db import ContactTracer
 from datetime import datetime
 from epidose.common.daemon import Daemon
+from epidose.common.seed_upload import AUTHORIZATION_HEADER, SEEDS_MIMETYPE, pack_seeds
 import requests
 from sys import exit
 
@@ -36,6 +38,12 @@ def main():
     parser.add_argument(
         "-a", "--authorization", help="Upload authorization code", default=":NONE:"
     )
+    parser.add_argument(
+        "-b",
+        "--binary",
+        help="Upload the seeds in the compact binary format rather than as JSON",
+        action="store_true",
+    )
     parser.add_argument(
         "-d", "--debug", help="Run in debug mode logging to stderr", action="store_true"
     )
@@ -45,6 +53,14 @@ def main():
         help="Specify the database location",
         default="/var/lib/epidose/client-database.db",
     )
+    parser.add_argument(
+        "-P",
+        "--storage-profile",
+        help="Database storage profile, optionally followed by comma-separated "
+        "setting=value overrides (default: sdcard)",
+        type=storage_profile,
+        default="sdcard",
+    )
     parser.add_argument("-t", "--test", help="Test script", action="store_true")
     parser.add_argument("-s", "--server", help="Server URL", default=SERVER_URL)
     parser.add_argument(
@@ -68,22 +84,38 @@ def main():
     logger = daemon.get_logger()
 
     # Obtain the specified seeds
-    ct = ContactTracer(None, args.database, transmitter=False, receiver=False)
+    ct = ContactTracer(
+        None,
+        args.database,
+        transmitter=False,
+        receiver=False,
+        storage_profile=args.storage_profile,
+    )
     (epochs, seeds) = ct.get_tracing_information(
         datetime.fromisoformat(args.start_time), datetime.fromisoformat(args.end_time)
     )
 
-    # Create dictionary for JSON
     logger.debug("Creating request")
-    post = {"authorization": args.authorization, "data": []}
-    i = 0
-    for e in epochs:
-        post["data"].append({"epoch": e, "seed": seeds[i].hex()})
-        i += 1
+    if args.binary:
+        request = {
+            "data": pack_seeds(epochs, seeds),
+            "headers": {
+                "Content-Type": SEEDS_MIMETYPE,
+                AUTHORIZATION_HEADER: args.authorization,
+            },
+        }
+    else:
+        # Create dictionary for JSON
+        post = {"authorization": args.authorization, "data": []}
+        i = 0
+        for e in epochs:
+            post["data"].append({"epoch": e, "seed": seeds[i].hex()})
+            i += 1
+        request = {"json": post}
 
     # Send request and check response
     logger.debug("Sending request")
-    res = requests.post(f"{args.server}/add_contagious", json=post)
+    res = requests.post(f"{args.server}/add_contagious", **request)
     logger.debug("Request sent")
     if res.ok:
         exit(0)
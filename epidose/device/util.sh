@@ -24,6 +24,16 @@ export WIFI_RETRY_TIME=$((15 * 60))
 # Location of the Cuckoo filter
 FILTER=/var/lib/epidose/client-filter.bin
 
+# Location of the Cuckoo filter's generation, used for obtaining deltas
+FILTER_GENERATION="$FILTER.gen"
+
+# Location of the Cuckoo filter's entity tag, used for conditional downloads
+FILTER_ETAG="$FILTER.etag"
+
+# Location of the per-day Cuckoo filter shards, used when the server
+# publishes them instead of the complete filter
+FILTER_SHARDS="$FILTER.shards"
+
 # Location of the update script
 UPDATE=/var/lib/epidose/update.sh
 
@@ -151,8 +161,13 @@ run_python()
 # If 0 is returned, the Cuckoo filter is stale.
 get_filter_validity_age()
 {
-  if [ -r "$FILTER" ] ; then
-    filter_mtime=$(stat -c '%Y' "$FILTER")
+  if [ -r "$FILTER_SHARDS/manifest.json" ] ; then
+    filter_file="$FILTER_SHARDS/manifest.json"
+  else
+    filter_file="$FILTER"
+  fi
+  if [ -r "$filter_file" ] ; then
+    filter_mtime=$(stat -c '%Y' "$filter_file")
     time_now=$(date +%s)
     filter_age=$((time_now - filter_mtime))
     if [ $filter_age -lt $MAX_FILTER_AGE ] ; then
@@ -170,7 +185,154 @@ get_filter_validity_age()
   fi
 }
 
+# Output the value of the last instance of the specified HTTP header,
+# given as a case-insensitive sed regular expression that ends with the
+# name's separator, in the specified file of dumped headers
+# Internal function
+_http_header_value()
+{
+  tr -d '\r' <"$2" 2>/dev/null | sed -n "s|$1 *||Ip" | tail -n 1
+}
+
+# Bring the Cuckoo filter up to date by obtaining and applying
+# the changes made to it since its generation
+# preconditions: WiFi should be turned on
+# Internal function
+# Returns 0 if the filter was brought up to date.
+_get_filter_delta()
+{
+  if ! [ -r "$FILTER" ] || ! [ -r "$FILTER_GENERATION" ] ; then
+    return 1
+  fi
+  generation=$(cat "$FILTER_GENERATION")
+  if ! status=$(curl --silent --show-error --fail --output "$FILTER.delta" \
+    --write-out '%{http_code}' \
+    "$SERVER_URL/filter/delta/$generation?mac=$MAC_ADDRESS" 2>&1) ; then
+    log "Unable to get filter delta: $status"
+    rm -f "$FILTER.delta"
+    return 1
+  fi
+  if [ "$status" = 204 ] ; then
+    log "Filter generation $generation is current"
+    # Mark the filter as fresh
+    touch "$FILTER"
+  elif ! run_python apply_filter_delta "$FILTER" "$FILTER.delta" ; then
+    rm -f "$FILTER.delta"
+    return 1
+  else
+    # The patched filter no longer matches the downloaded one
+    rm -f "$FILTER_ETAG"
+    log "Filter delta applied: $(stat -c %s "$FILTER.delta") bytes"
+  fi
+  rm -f "$FILTER.delta"
+  return 0
+}
+
+# Bring the per-day Cuckoo filter shards up to date
+# preconditions: WiFi should be turned on
+# Internal function
+# Returns 0 if the shards were brought up to date, and 2 if the server
+# does not publish them.
+_get_filter_shards()
+{
+  if run_python update_filter_shards -s "$SERVER_URL" -m "$MAC_ADDRESS" \
+    "$FILTER_SHARDS" ; then
+    # The complete filter is no longer needed
+    rm -rf "$FILTER" "$FILTER_GENERATION" "$FILTER_ETAG" "$FILTER.deltas"
+    return 0
+  else
+    exit_code=$?
+    if [ $exit_code -eq 2 ] ; then
+      # The server publishes the complete filter
+      rm -rf "$FILTER_SHARDS"
+    fi
+    return $exit_code
+  fi
+}
+
+# Download the complete Cuckoo filter from the specified server resource
+# preconditions: WiFi should be turned on
+# Internal function
+# Returns 0 if the filter was obtained, setting http_status to the
+# status code of the server's response.
+_get_complete_filter()
+{
+  resource="$1"
+  set -- --dump-header "$FILTER.headers"
+  # Skip the download if the filter has not changed
+  if [ -r "$FILTER" ] && [ -s "$FILTER_ETAG" ] ; then
+    set -- "$@" --header "If-None-Match: $(cat "$FILTER_ETAG")"
+  fi
+  # Resume an interrupted download, if the filter has not changed since
+  if [ -s "$FILTER.new" ] && [ -s "$FILTER.new.etag" ] ; then
+    set -- "$@" --range "$(stat -c %s "$FILTER.new")-" \
+      --header "If-Range: $(cat "$FILTER.new.etag")"
+  else
+    rm -f "$FILTER.new" "$FILTER.new.etag"
+  fi
+  rm -f "$FILTER.headers" "$FILTER.part"
+  if err=$(curl --silent --show-error --fail --output "$FILTER.part" "$@" \
+    "$SERVER_URL/$resource?mac=$MAC_ADDRESS" 2>&1) ; then
+    exit_code=0
+  else
+    exit_code=$?
+  fi
+
+  # Keep the data obtained, even from an interrupted transfer
+  http_status=$(_http_header_value '^HTTP/[0-9.]*' "$FILTER.headers")
+  http_status=${http_status%% *}
+  case "$http_status" in
+    200)
+      mv "$FILTER.part" "$FILTER.new"
+      _http_header_value ETag: "$FILTER.headers" >"$FILTER.new.etag"
+      ;;
+    206)
+      cat "$FILTER.part" >>"$FILTER.new"
+      ;;
+    416)
+      # The interrupted download cannot be resumed, e.g. because it had
+      # already been completed; discard it and obtain the filter afresh
+      log "Unable to resume the filter download; restarting it"
+      rm -f "$FILTER.headers" "$FILTER.part" "$FILTER.new" "$FILTER.new.etag"
+      _get_complete_filter "$resource"
+      return $?
+      ;;
+    304)
+      log "Filter is unchanged"
+      # Mark the filter as fresh
+      touch "$FILTER"
+      rm -f "$FILTER.headers" "$FILTER.part" "$FILTER.new" "$FILTER.new.etag"
+      return 0
+      ;;
+  esac
+  rm -f "$FILTER.part"
+
+  if [ $exit_code -eq 0 ] && [ -r "$FILTER.new" ] ; then
+    # Atomically replace existing filter with new one
+    rm -rf "$FILTER_GENERATION" "$FILTER_ETAG" "$FILTER.deltas"
+    mv "$FILTER.new" "$FILTER"
+    mv "$FILTER.new.etag" "$FILTER_ETAG"
+    # Record the filter's generation for obtaining subsequent deltas
+    generation=$(sed -n 's/^X-Filter-Generation: *\([0-9]*\).*/\1/Ip' \
+      "$FILTER.headers")
+    if [ -n "$generation" ] ; then
+      echo "$generation" >"$FILTER_GENERATION"
+    fi
+    rm -f "$FILTER.headers"
+    log "New filter obtained: $(stat -c %s "$FILTER") bytes"
+    return 0
+  else
+    [ $exit_code -ne 0 ] || exit_code=1
+    log "Unable to get filter: $err"
+    return "$exit_code"
+  fi
+}
+
 # Obtain a (new) version of the Cuckoo filter
+# The filter's new and changed per-day shards are obtained, if the server
+# publishes them.  Otherwise, the filter is patched with the changes since
+# its generation, if these are available, or downloaded in full,
+# preferably compressed.
 # preconditions: WiFi should be turned on
 # Returns an exit code that defines
 # whether a request to the ha-sever, to fetch a new cuckoo filter,
@@ -178,15 +340,19 @@ get_filter_validity_age()
 # If 1 is returned, then cuckoo filter was not obtained.
 get_new_filter()
 {
-  if err=$(curl --silent --show-error --fail --output "$FILTER.new" \
-    "$SERVER_URL/filter?mac=$MAC_ADDRESS" 2>&1) ; then
-    # Atomically replace existing filter with new one
-    mv "$FILTER.new" "$FILTER"
-    log "New filter obtained: $(stat -c %s "$FILTER") bytes"
+  _get_filter_shards && return 0
+  # Continue only if the server does not publish shards
+  [ $? -eq 2 ] || return 1
+  if _get_filter_delta ; then
     return 0
+  fi
+  log "Obtaining complete filter"
+  _get_complete_filter filter/compressed && return 0
+  exit_code=$?
+  if [ "$http_status" = 404 ] ; then
+    log "No compressed filter is published; obtaining the plain one"
+    _get_complete_filter filter
   else
-    exit_code=$?
-    log "Unable to get filter: $err"
     return "$exit_code"
   fi
 }
@@ -22,9 +22,11 @@ setuptools.setup(
     ],
     python_requires=">=3.6",
     install_requires=[
-        "flask",
+        "bitarray>=2.3",
+        "flask>=2.0",
         "flask_restful",
         "gunicorn",
+        "mmh3",
         "pybluez",
         "pycryptodomex",
         "peewee",
@@ -0,0 +1,47 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from epidose.device.beacon_format import BLE_PACKET, parse_packet, sender_bdaddr
+
+EPHID = bytes.fromhex("66687aadf862bd776c8fc18b8e9f8e20")
+BDADDR = bytes.fromhex("5230c4a19c1e")
+
+# HCI LE advertising report event, followed by the sender's address,
+# the advertising data, and the RSSI
+PACKET = (
+    bytes([0x04, 0x3E, 40, 0x02, 0x01, 0x03, 0x01])
+    + BDADDR[::-1]
+    + BLE_PACKET
+    + EPHID
+    + bytes([0xC0, 0xC4])
+)
+
+
+def test_parse_packet():
+    assert len(PACKET) == 43
+    assert parse_packet(PACKET) == (EPHID, -60)
+    assert parse_packet(bytearray(PACKET)) == (EPHID, -60)
+    assert sender_bdaddr(PACKET) == BDADDR
+
+
+def test_parse_foreign_packet():
+    # Other length
+    assert parse_packet(PACKET[:2] + bytes([39]) + PACKET[3:-1]) is None
+    # Other advertisement
+    assert parse_packet(PACKET[:14] + b"\0" + PACKET[15:]) is None
+    # Other event
+    assert parse_packet(bytes([0x04, 0x0E, 4, 0x01, 0x0C, 0x20, 0x00])) is None
@@ -0,0 +1,98 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import asyncio
+from dp3t.protocols.unlinkable_db import ContactTracer
+from epidose.device import beacon_rx_unlinkable_d as beacon_rx
+import logging
+import os
+import pytest
+import signal
+import socket
+from tests.test_beacon_format import PACKET
+
+
+@pytest.fixture(scope="function")
+def receiver(monkeypatch):
+    r = ContactTracer(None, ":memory:", transmitter=False, observation_buffer_size=10)
+    monkeypatch.setattr(beacon_rx, "receiver", r, raising=False)
+    monkeypatch.setattr(
+        beacon_rx, "logger", logging.getLogger("beacon_rx"), raising=False
+    )
+    monkeypatch.setattr(beacon_rx, "orange_led_set", lambda on: None)
+    monkeypatch.setattr(beacon_rx, "green_led_set", lambda on: None)
+    yield r
+    r.db.close()
+
+
+@pytest.fixture(scope="function")
+def sockets():
+    """Return a connected pair of non-blocking packet sockets standing in
+    for the HCI socket and the controller sending it packets."""
+    (hci, controller) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    hci.setblocking(False)
+    yield (hci, controller)
+    hci.close()
+    controller.close()
+
+
+def test_read_packets(receiver, sockets, monkeypatch):
+    (hci, controller) = sockets
+    packets = []
+    monkeypatch.setattr(beacon_rx, "process_packet", packets.append)
+    for i in range(beacon_rx.MAX_PACKETS_PER_WAKEUP + 1):
+        controller.send(bytes([i]))
+
+    # Packets are read in bounded batches, until none is waiting
+    beacon_rx.read_packets(hci)
+    assert len(packets) == beacon_rx.MAX_PACKETS_PER_WAKEUP
+    beacon_rx.read_packets(hci)
+    assert len(packets) == beacon_rx.MAX_PACKETS_PER_WAKEUP + 1
+    beacon_rx.read_packets(hci)
+    assert packets == [bytes([i]) for i in range(len(packets))]
+
+
+def test_receive_packets(receiver, sockets):
+    (hci, controller) = sockets
+    for _ in range(3):
+        controller.send(PACKET)
+    # Other packets are ignored
+    controller.send(bytes.fromhex("040e04010c2000"))
+
+    async def receive_until_terminated():
+        asyncio.get_running_loop().call_later(
+            0.2, os.kill, os.getpid(), signal.SIGTERM
+        )
+        await beacon_rx.receive_packets(hci, 1)
+
+    asyncio.run(receive_until_terminated())
+    receiver.flush_observations()
+    assert len(list(receiver.db.get_observations())) == 1
+
+
+def test_advance_day_periodically(receiver, monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(beacon_rx.asyncio, "sleep", sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(beacon_rx.advance_day_periodically(30))
+    # The time is checked long before the next midnight
+    assert delays[0] <= 30
@@ -0,0 +1,42 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from datetime import datetime, timedelta, timezone
+from dp3t.protocols.unlinkable_db import ContactTracer
+from epidose.device.beacon_tx_unlinkable_d import EphidSchedule
+
+START_TIME = datetime(2020, 4, 25, tzinfo=timezone.utc)
+
+
+def test_ephid_schedule():
+    transmitter = ContactTracer(start_time=START_TIME, receiver=False)
+    schedule = EphidSchedule(transmitter)
+    for minutes in (10, 20, 23 * 60 + 50):
+        time = START_TIME + timedelta(minutes=minutes)
+        assert schedule.get_ephid_for_time(time) == transmitter.get_ephid_for_time(
+            time
+        )
+    assert schedule.get_ephid_for_time(START_TIME) != schedule.get_ephid_for_time(
+        START_TIME + timedelta(minutes=20)
+    )
+
+    # Advance to the next day
+    time = START_TIME + timedelta(days=1, minutes=10)
+    ephid = schedule.get_ephid_for_time(time)
+    assert transmitter.today == time.date()
+    assert ephid == transmitter.get_ephid_for_time(time)
+    transmitter.db.close()
@@ -15,7 +15,11 @@ __copyright__ = """
 """
 __license__ = "Apache 2.0"
 
-from dp3t.protocols.client_database import ClientDatabase, EPOCH_START
+from dp3t.protocols.client_database import (
+    ClientDatabase,
+    EPOCH_START,
+    ObservationBuffer,
+)
 import pytest
 from time import time
 
@@ -70,6 +74,13 @@ def test_get_epoch_ephid(db_connection):
     assert not db_connection.get_epoch_ephid(42)
 
 
+def test_get_epoch_ephids(db_connection):
+    for i in range(1, 10):
+        db_connection.add_epoch_ids(i, f"S{i}", f"E{i}")
+    assert db_connection.get_epoch_ephids(5, 7) == {5: b"E5", 6: b"E6"}
+    assert db_connection.get_epoch_ephids(42, 45) == {}
+
+
 def test_delete_past_epochs(db_connection):
     for i in range(1, 10):
         db_connection.add_epoch_ids(i, f"S{i}", f"E{i}")
@@ -114,3 +125,54 @@ def test_delete_past_observations(db_connection):
     observations = list(db_connection.get_observations())
     assert b"H5" in observations
     assert b"H4" not in observations
+
+
+def test_observations_to_check(db_connection):
+    for i in range(1, 5):
+        db_connection.add_observation(i, f"H{i}", i)
+    to_check, last_row = db_connection.get_observations_to_check(1)
+    assert to_check == {0: [b"H1", b"H2", b"H3", b"H4"]}
+    db_connection.set_observations_matched([b"H2"], True)
+    db_connection.add_observation(5, "H5", 5)
+    db_connection.set_observations_checked(1, last_row)
+    assert db_connection.count_matched_observations() == 1
+
+    to_check, last_row = db_connection.get_observations_to_check(2)
+    assert to_check == {1: [b"H1", b"H2", b"H3", b"H4"], 0: [b"H5"]}
+    db_connection.set_observations_matched([b"H2"], False)
+    db_connection.set_observations_checked(2, last_row)
+    assert db_connection.count_matched_observations() == 0
+    assert db_connection.get_observations_to_check(2)[0] == {}
+
+
+def test_observation_buffer(db_connection):
+    buffer = ObservationBuffer(db_connection, max_size=3, flush_interval=3600)
+    db_connection.add_observation(1, "H1", -10)
+    buffer.add_observation(1, "H1", -20)
+    buffer.add_observation(1, "H1", -30)
+    buffer.add_observation(1, "H2", -40)
+    assert len(buffer) == 2
+    assert list(db_connection.get_observations()) == [b"H1"]
+
+    # Reaching the size threshold flushes the buffer
+    buffer.add_observation(2, "H2", -50)
+    assert len(buffer) == 0
+    assert db_connection.get_observation_details("H1") == (3, -20)
+    assert sorted(db_connection.get_observations()) == [b"H1", b"H2", b"H2"]
+
+    buffer.add_observation(2, "H3", -60)
+    buffer.flush_if_due()
+    assert len(buffer) == 1
+    buffer.flush_interval = 0
+    buffer.flush_if_due()
+    assert len(buffer) == 0
+    assert db_connection.get_observation_details("H3") == (1, -60)
+
+
+def test_add_observations_bulk(db_connection, monkeypatch):
+    monkeypatch.setattr("dp3t.protocols.client_database.INSERT_CHUNK_SIZE", 3)
+    db_connection.add_observation(1, "H1", -10)
+    db_connection.add_observations({(1, f"H{i}"): (i, -i) for i in range(1, 8)})
+    assert len(list(db_connection.get_observations())) == 7
+    assert db_connection.get_observation_details("H1") == (2, -5.5)
+    assert db_connection.get_observation_details("H7") == (7, -1)
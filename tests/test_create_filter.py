@@ -0,0 +1,132 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from datetime import datetime, timedelta
+from dp3t.config import RETENTION_PERIOD
+from dp3t.protocols.server_database import ServerDatabase
+from dp3t.protocols.unlinkable import (
+    day_from_epoch,
+    epoch_from_time,
+    generate_new_seed,
+    hashed_observation_from_seed,
+)
+from epidose.back_end import create_filter
+from epidose.common.filter_shards import read_manifest, shard_path
+import logging
+import pytest
+
+
+##########################
+### TEST FILTER UPDATE ###
+##########################
+
+
+@pytest.fixture(scope="function")
+def db(monkeypatch):
+    monkeypatch.setattr(
+        create_filter, "logger", logging.getLogger("create_filter"), raising=False
+    )
+    d = ServerDatabase(":memory:")
+    yield d
+    d.close(drop_tables=True)
+
+
+def add_seed(db, days_ago):
+    """Add to the database a seed of an epoch the specified number of
+    days ago, and return its hashed observation."""
+    epoch = epoch_from_time(datetime.now() - timedelta(days=days_ago))
+    seed = generate_new_seed()
+    db.add_epoch_seed(epoch, seed)
+    return hashed_observation_from_seed(seed, epoch)
+
+
+def update(db, filter_path, retention_days=RETENTION_PERIOD, crash=None):
+    """Update the filter stored in filter_path, as create_filter -i does,
+    and return it together with its state.
+    Stop before saving the filter if crash is "before_save", or before
+    deleting the expired records if it is "before_delete"."""
+    last_retained_day = datetime.now() - timedelta(days=retention_days)
+    state = create_filter.read_state(filter_path)
+    (cuckoo_filter, state) = create_filter.update_filter(
+        db, filter_path, state, last_retained_day
+    )
+    if crash == "before_save":
+        return (cuckoo_filter, state)
+    create_filter.write_filter(cuckoo_filter, filter_path)
+    create_filter.write_state(filter_path, state)
+    if crash == "before_delete":
+        return (cuckoo_filter, state)
+    db.delete_expired_data(last_retained_day)
+    return (cuckoo_filter, state)
+
+
+def test_update_filter_after_expired_last_record(db, tmp_path):
+    filter_path = str(tmp_path / "filter")
+    a = add_seed(db, 1)
+    update(db, filter_path)
+    add_seed(db, 30)
+    update(db, filter_path)
+    c = add_seed(db, 1)
+    (cuckoo_filter, state) = update(db, filter_path)
+    assert list(cuckoo_filter.contains_many([a, c])) == [True, True]
+    assert state["items"] == 2
+
+
+def test_update_filter_skips_expired(db, tmp_path):
+    filter_path = str(tmp_path / "filter")
+    a = add_seed(db, 1)
+    update(db, filter_path)
+    b = add_seed(db, 30)
+    c = add_seed(db, 1)
+    (cuckoo_filter, state) = update(db, filter_path)
+    assert list(cuckoo_filter.contains_many([a, b, c])) == [True, False, True]
+    assert state["items"] == 2
+
+    # Nothing is left to delete from the filter
+    (cuckoo_filter, state) = update(db, filter_path)
+    assert list(cuckoo_filter.contains_many([a, b, c])) == [True, False, True]
+    assert state["items"] == 2
+
+
+def test_update_shards_after_expired_last_record(db, tmp_path):
+    shards_dir = str(tmp_path / "filter.shards")
+    a = add_seed(db, 1)
+    create_filter.update_shards(db, shards_dir, False)
+    add_seed(db, 30)
+    create_filter.update_shards(db, shards_dir, False)
+    c = add_seed(db, 1)
+    create_filter.update_shards(db, shards_dir, False)
+
+    day = day_from_epoch(epoch_from_time(datetime.now() - timedelta(days=1)))
+    assert list(read_manifest(shards_dir)) == [day]
+    shard = create_filter.read_filter(shard_path(shards_dir, day))
+    assert list(shard.contains_many([a, c])) == [True, True]
+
+
+@pytest.mark.parametrize("crash", ["before_save", "before_delete"])
+def test_update_filter_after_crash(db, tmp_path, crash):
+    filter_path = str(tmp_path / "filter")
+    a = add_seed(db, 1)
+    b = add_seed(db, 5)
+    update(db, filter_path)
+
+    # The record of b expires, but the update is interrupted
+    update(db, filter_path, retention_days=3, crash=crash)
+    (cuckoo_filter, state) = update(db, filter_path, retention_days=3)
+    assert list(cuckoo_filter.contains_many([a, b])) == [True, False]
+    assert state["items"] == 1
+    assert len(db.get_epoch_seeds_tuple()[0]) == 1
@@ -0,0 +1,143 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from dp3t.protocols.unlinkable import generate_new_seed, hashed_observation_from_seed
+from dp3t.protocols.unlinkable_db import TracingDataBatch
+from epidose.common.filter_delta import (
+    FILTER_HEADER_SIZE,
+    apply_deltas,
+    compute_delta,
+    delta_path,
+    prune_deltas,
+    stored_changes,
+    write_delta,
+)
+from io import BytesIO
+import os
+import pytest
+
+
+##################################
+### TEST FILTER DELTA HANDLING ###
+##################################
+
+SEEDS = [generate_new_seed() for _ in range(30)]
+EPOCHS = list(range(1000, 1030))
+
+
+def filter_file(batch):
+    """Return a file object containing the specified filter."""
+    f = BytesIO()
+    f.write(batch.capacity.to_bytes(8, byteorder="big", signed=False))
+    batch.tofile(f)
+    return f
+
+
+def test_apply_delta_chain():
+    old = TracingDataBatch([(EPOCHS[:20], SEEDS[:20])])
+    f = filter_file(old)
+
+    middle = TracingDataBatch(fh=BytesIO(f.getvalue()[8:]), capacity=old.capacity)
+    middle.insert_seeds([(EPOCHS[20:25], SEEDS[20:25])])
+    new = TracingDataBatch(fh=BytesIO(f.getvalue()[8:]), capacity=old.capacity)
+    new.insert_seeds([(EPOCHS[20:25], SEEDS[20:25])])
+    new.delete_hashed_observations(
+        [hashed_observation_from_seed(s, e) for (e, s) in zip(EPOCHS[:5], SEEDS[:5])]
+    )
+
+    deltas = BytesIO()
+    for (generation, (a, b)) in enumerate([(old, middle), (middle, new)], 1):
+        records = compute_delta(
+            a.infected_observations.buckets, b.infected_observations.buckets
+        )
+        assert records
+        write_delta(deltas, generation, generation + 1, old.capacity, records)
+
+    deltas.seek(0)
+    assert apply_deltas(f, deltas, 1) == 3
+    assert f.getvalue() == filter_file(new).getvalue()
+
+    # Reapplying the chain to the patched filter has no effect
+    deltas.seek(0)
+    assert apply_deltas(f, deltas, 1) == 3
+    assert f.getvalue() == filter_file(new).getvalue()
+
+
+def test_apply_delta_broken_chain():
+    old = TracingDataBatch([(EPOCHS[:20], SEEDS[:20])])
+    f = filter_file(old)
+    deltas = BytesIO()
+    write_delta(deltas, 5, 6, old.capacity, [])
+    deltas.seek(0)
+    with pytest.raises(ValueError):
+        apply_deltas(f, deltas, 4)
+
+
+@pytest.mark.parametrize(
+    "broken",
+    [
+        # A gap in the chain
+        (3, 4, [(FILTER_HEADER_SIZE, b"ab")]),
+        # A record outside the filter
+        (2, 3, [(1 << 40, b"ab")]),
+    ],
+)
+def test_apply_delta_chain_broken_later(broken):
+    old = TracingDataBatch([(EPOCHS[:20], SEEDS[:20])])
+    f = filter_file(old)
+    deltas = BytesIO()
+    write_delta(deltas, 1, 2, old.capacity, [(FILTER_HEADER_SIZE, b"xy")])
+    (from_generation, to_generation, records) = broken
+    write_delta(deltas, from_generation, to_generation, old.capacity, records)
+    deltas.seek(0)
+    with pytest.raises(ValueError):
+        apply_deltas(f, deltas, 1)
+    # The filter is left unmodified
+    assert f.getvalue() == filter_file(old).getvalue()
+
+
+def test_apply_delta_wrong_capacity():
+    old = TracingDataBatch([(EPOCHS[:20], SEEDS[:20])])
+    f = filter_file(old)
+    deltas = BytesIO()
+    write_delta(deltas, 1, 2, old.capacity + 8, [])
+    deltas.seek(0)
+    with pytest.raises(ValueError):
+        apply_deltas(f, deltas, 1)
+
+
+def test_apply_delta_truncated():
+    old = TracingDataBatch([(EPOCHS[:20], SEEDS[:20])])
+    f = filter_file(old)
+    deltas = BytesIO()
+    write_delta(deltas, 1, 2, old.capacity, [(8, b"1234")])
+    deltas = BytesIO(deltas.getvalue()[:-1])
+    with pytest.raises(ValueError):
+        apply_deltas(f, deltas, 1)
+
+
+def test_stored_changes(tmp_path):
+    filter_path = str(tmp_path / "filter.bin")
+    assert list(stored_changes(filter_path)) == []
+    os.makedirs(filter_path + ".deltas")
+    for generation in range(1, 5):
+        with open(delta_path(filter_path, generation), "wb") as f:
+            write_delta(
+                f, generation - 1, generation, 8, [(FILTER_HEADER_SIZE + 2, b"ab")]
+            )
+    prune_deltas(filter_path, 4, 2)
+    assert sorted(stored_changes(filter_path)) == [(3, [(2, 2)]), (4, [(2, 2)])]
@@ -0,0 +1,125 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from dp3t.protocols.unlinkable import generate_new_seed, hashed_observation_from_seed
+from dp3t.protocols.unlinkable_db import TracingDataBatch, buckets_size
+from epidose.common.filter_file import (
+    COMPRESSED_FILTER_MAGIC,
+    decompress_filter,
+    read_filter,
+    read_filter_header,
+    write_compressed_filter,
+)
+from io import BytesIO
+import pytest
+import zlib
+
+
+############################################
+### TEST PLAIN AND COMPRESSED FILTER FILES ###
+############################################
+
+SEEDS = [generate_new_seed() for _ in range(30)]
+EPOCHS = list(range(1000, 1030))
+
+
+def plain_file(batch):
+    """Return a file object containing the specified plain filter."""
+    f = BytesIO()
+    f.write(batch.capacity.to_bytes(8, byteorder="big", signed=False))
+    batch.tofile(f)
+    f.seek(0)
+    return f
+
+
+def compressed_file(batch):
+    """Return a file object containing the specified compressed filter."""
+    f = BytesIO()
+    write_compressed_filter(f, batch)
+    f.seek(0)
+    return f
+
+
+def test_read_filter_header():
+    batch = TracingDataBatch([(EPOCHS, SEEDS)])
+    assert read_filter_header(plain_file(batch)) == (batch.capacity, False)
+    assert read_filter_header(compressed_file(batch)) == (batch.capacity, True)
+    with pytest.raises(ValueError):
+        read_filter_header(BytesIO(COMPRESSED_FILTER_MAGIC + b"\0"))
+
+
+def test_read_compressed_filter():
+    batch = TracingDataBatch([(EPOCHS, SEEDS)])
+    f = compressed_file(batch)
+    assert len(f.getvalue()) < len(plain_file(batch).getvalue())
+
+    loaded = read_filter(f)
+    assert loaded.capacity == batch.capacity
+    assert (
+        loaded.infected_observations.buckets == batch.infected_observations.buckets
+    )
+    ho = hashed_observation_from_seed(SEEDS[0], EPOCHS[0])
+    assert ho in loaded.infected_observations
+
+
+def test_read_compressed_filter_truncated():
+    batch = TracingDataBatch([(EPOCHS, SEEDS)])
+    data = compressed_file(batch).getvalue()
+    with pytest.raises(ValueError):
+        read_filter(BytesIO(data[:-4]))
+
+
+def test_read_compressed_filter_wrong_capacity():
+    batch = TracingDataBatch([(EPOCHS, SEEDS)])
+    f = compressed_file(batch)
+    read_filter_header(f)
+    with pytest.raises(ValueError):
+        TracingDataBatch(fh=f, capacity=batch.capacity * 2, compressed=True)
+
+
+def test_read_compressed_filter_corrupt():
+    batch = TracingDataBatch([(EPOCHS, SEEDS)])
+    data = bytearray(compressed_file(batch).getvalue())
+    data[len(COMPRESSED_FILTER_MAGIC) + 8] ^= 0xFF
+    with pytest.raises(ValueError):
+        read_filter(BytesIO(data))
+
+
+def test_decompress_filter():
+    batch = TracingDataBatch([(EPOCHS, SEEDS)])
+    plain = BytesIO()
+    decompress_filter(compressed_file(batch), plain)
+    assert plain.getvalue() == plain_file(batch).getvalue()
+    assert len(plain.getvalue()) == 8 + buckets_size(batch.capacity)
+
+    with pytest.raises(ValueError):
+        decompress_filter(plain_file(batch), BytesIO())
+
+
+@pytest.mark.parametrize("factor", [0.5, 2])
+def test_decompress_filter_wrong_capacity(factor):
+    batch = TracingDataBatch([(EPOCHS, SEEDS)])
+    f = BytesIO()
+    f.write(COMPRESSED_FILTER_MAGIC)
+    f.write(int(batch.capacity * factor).to_bytes(8, byteorder="big", signed=False))
+    f.write(zlib.compress(batch.infected_observations.buckets.tobytes()))
+    f.seek(0)
+    plain = BytesIO()
+    with pytest.raises(ValueError):
+        decompress_filter(f, plain)
+    # No more than the header's capacity is decompressed
+    assert len(plain.getvalue()) <= 8 + buckets_size(int(batch.capacity * factor))
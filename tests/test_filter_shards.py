@@ -0,0 +1,84 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from epidose.common.filter_shards import (
+    manifest_path,
+    parse_manifest,
+    read_manifest,
+    shard_days,
+    shard_entry,
+    shard_path,
+    write_manifest,
+)
+from epidose.device import update_filter_shards
+import hashlib
+import pytest
+import requests
+
+
+###################################
+### TEST FILTERS SHARDED BY DAY ###
+###################################
+
+
+def test_manifest(tmp_path):
+    shards_dir = str(tmp_path)
+    assert read_manifest(shards_dir) == {}
+    assert shard_days(shards_dir) == set()
+
+    for day in (18377, 18378):
+        with open(shard_path(shards_dir, day), "wb") as f:
+            f.write(b"shard")
+    assert shard_days(shards_dir) == {18377, 18378}
+
+    entry = shard_entry(shard_path(shards_dir, 18377))
+    assert entry == {"sha256": hashlib.sha256(b"shard").hexdigest(), "size": 5}
+    write_manifest(shards_dir, {18377: entry})
+    assert read_manifest(shards_dir) == {18377: entry}
+    # The manifest is not taken for a shard
+    assert shard_days(shards_dir) == {18377, 18378}
+
+
+@pytest.mark.parametrize(
+    "data", ["", "[]", '{"days": {}}', '{"shards": {"x": {}}}', '{"shards": []}']
+)
+def test_invalid_manifest(tmp_path, data):
+    with pytest.raises(ValueError):
+        parse_manifest(data)
+    with open(manifest_path(str(tmp_path)), "w") as f:
+        f.write(data)
+    with pytest.raises(ValueError):
+        read_manifest(str(tmp_path))
+
+
+class StalledSession(requests.Session):
+    """A session whose requests time out."""
+
+    def get(self, url, **kwargs):
+        assert kwargs["timeout"] == update_filter_shards.TIMEOUT
+        raise requests.Timeout(f"Read timed out: {url}")
+
+
+def test_update_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(update_filter_shards.requests, "Session", StalledSession)
+    monkeypatch.setattr(
+        "sys.argv",
+        ["update_filter_shards", "-d", "-s", "http://server", str(tmp_path)],
+    )
+    with pytest.raises(SystemExit) as e:
+        update_filter_shards.main()
+    assert e.value.code == 1
@@ -16,7 +16,20 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 from epidose.back_end import ha_server
+from epidose.common.filter_delta import delta_path, state_path
+from epidose.common.filter_file import compressed_path
+from epidose.common.filter_shards import (
+    parse_manifest,
+    read_manifest,
+    shard_entry,
+    shard_path,
+    shards_path,
+    write_manifest,
+)
+from epidose.common.seed_upload import AUTHORIZATION_HEADER, SEEDS_MIMETYPE, pack_seeds
 from flask import json
+import hashlib
+import os
 import pytest
 import types
 
@@ -57,8 +70,8 @@ def test_add_contagious(client):
         json={
             "authorization": "xyzzy",
             "data": [
-                {"epoch": 42, "seed": "deadbeef"},
-                {"epoch": 43, "seed": "baadf00d"},
+                {"epoch": 42, "seed": "deadbeef" * 8},
+                {"epoch": 43, "seed": "baadf00d" * 8},
             ],
         },
     )
@@ -69,5 +82,213 @@ def test_add_contagious(client):
         seeds[epoch] = seed
         count += 1
     assert count == 2
-    assert seeds[42] == bytes.fromhex("deadbeef")
-    assert seeds[43] == bytes.fromhex("baadf00d")
+    assert seeds[42] == bytes.fromhex("deadbeef" * 8)
+    assert seeds[43] == bytes.fromhex("baadf00d" * 8)
+
+
+@pytest.fixture
+def filter_generations(tmp_path, monkeypatch):
+    """Publish a filter of generation 3 with deltas for generations 2 and 3."""
+    filter_path = str(tmp_path / "filter.bin")
+    monkeypatch.setattr(ha_server, "FILTER_LOCATION", filter_path)
+    with open(filter_path, "wb") as f:
+        f.write(b"filter")
+    with open(state_path(filter_path), "w") as f:
+        json.dump({"generation": 3}, f)
+    for generation in (2, 3):
+        path = delta_path(filter_path, generation)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(f"delta{generation}".encode("ascii"))
+
+
+def test_filter_generation(client, filter_generations):
+    rv = client.get("/filter")
+    assert rv.status_code == 200
+    assert rv.headers["X-Filter-Generation"] == "3"
+    assert rv.get_data() == b"filter"
+
+
+def test_filter_conditional(client, filter_generations):
+    etag = client.get("/filter").headers["ETag"]
+    assert etag == '"' + hashlib.sha256(b"filter").hexdigest() + '"'
+    rv = client.get("/filter", headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+
+    with open(ha_server.FILTER_LOCATION, "wb") as f:
+        f.write(b"new filter")
+    rv = client.get("/filter", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+    assert rv.get_data() == b"new filter"
+
+
+def test_filter_range(client, filter_generations):
+    etag = client.get("/filter").headers["ETag"]
+    rv = client.get("/filter", headers={"Range": "bytes=2-", "If-Range": etag})
+    assert rv.status_code == 206
+    assert rv.get_data() == b"lter"
+
+    # A changed filter is sent in full
+    rv = client.get("/filter", headers={"Range": "bytes=2-", "If-Range": '"old"'})
+    assert rv.status_code == 200
+    assert rv.get_data() == b"filter"
+
+
+def test_filter_compressed(client, filter_generations):
+    assert client.get("/filter/compressed").status_code == 404
+
+    with open(compressed_path(ha_server.FILTER_LOCATION), "wb") as f:
+        f.write(b"compressed")
+    rv = client.get("/filter/compressed")
+    assert rv.status_code == 200
+    assert rv.headers["X-Filter-Generation"] == "3"
+    assert rv.headers["ETag"] != client.get("/filter").headers["ETag"]
+    assert rv.get_data() == b"compressed"
+
+
+def test_filter_shards(client, tmp_path, monkeypatch):
+    filter_path = str(tmp_path / "filter.bin")
+    monkeypatch.setattr(ha_server, "FILTER_LOCATION", filter_path)
+    assert client.get("/filter/shards").status_code == 404
+
+    shards_dir = shards_path(filter_path)
+    os.mkdir(shards_dir)
+    with open(shard_path(shards_dir, 18377), "wb") as f:
+        f.write(b"shard")
+    write_manifest(shards_dir, {18377: shard_entry(shard_path(shards_dir, 18377))})
+
+    rv = client.get("/filter/shards")
+    assert rv.status_code == 200
+    assert parse_manifest(rv.get_data(as_text=True)) == read_manifest(shards_dir)
+
+    rv = client.get("/filter/shards/18377")
+    assert rv.status_code == 200
+    assert rv.get_data() == b"shard"
+    etag = rv.headers["ETag"]
+    rv = client.get("/filter/shards/18377", headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+    assert client.get("/filter/shards/18378").status_code == 404
+
+
+def test_filter_delta(client, filter_generations):
+    rv = client.get("/filter/delta/1")
+    assert rv.status_code == 200
+    assert rv.headers["X-Filter-Generation"] == "3"
+    assert rv.get_data() == b"delta2delta3"
+
+
+def test_filter_delta_current(client, filter_generations):
+    rv = client.get("/filter/delta/3")
+    assert rv.status_code == 204
+
+
+def test_filter_delta_unavailable(client, filter_generations):
+    assert client.get("/filter/delta/0").status_code == 404
+    assert client.get("/filter/delta/4").status_code == 404
+
+
+def test_add_contagious_binary(client):
+    seeds = [bytes([i]) * 32 for i in range(3)]
+    rv = client.post(
+        "/add_contagious",
+        data=pack_seeds([42, 43, 44], seeds),
+        headers={"Content-Type": SEEDS_MIMETYPE, AUTHORIZATION_HEADER: "xyzzy"},
+    )
+    assert rv.status_code == 200
+    assert ha_server.db.get_epoch_seeds_tuple() == ([42, 43, 44], seeds)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"authorization": "xyzzy"},
+        {"authorization": "", "data": [{"epoch": 42, "seed": "00" * 32}]},
+        {"authorization": "xyzzy", "data": [{"epoch": 42, "seed": "xyzzy"}]},
+        {"authorization": "xyzzy", "data": [{"epoch": "42", "seed": "00" * 32}]},
+        {"authorization": "xyzzy", "data": [{"epoch": True, "seed": "00" * 32}]},
+        {"authorization": "xyzzy", "data": [{"epoch": -1, "seed": "00" * 32}]},
+        {"authorization": "xyzzy", "data": [{"epoch": 2 ** 32, "seed": "00" * 32}]},
+        {"authorization": "xyzzy", "data": [{"epoch": 42, "seed": "deadbeef"}]},
+        {"authorization": "xyzzy", "data": [{"seed": "00" * 32}]},
+        {
+            "authorization": "xyzzy",
+            "data": [{"epoch": 42, "seed": "00" * 32}, {"epoch": 43, "seed": "z"}],
+        },
+    ],
+)
+def test_add_contagious_invalid(client, data):
+    rv = client.post(
+        "/add_contagious",
+        json={"authorization": "xyzzy", "data": [{"epoch": 41, "seed": "be" * 32}]},
+    )
+    assert rv.status_code == 200
+    rv = client.post("/add_contagious", json=data)
+    assert rv.status_code == 400
+    # Nothing from an invalid upload is stored
+    assert ha_server.db.get_epoch_seeds_tuple() == ([41], [bytes.fromhex("be" * 32)])
+
+
+def test_add_contagious_truncated(client):
+    rv = client.post(
+        "/add_contagious",
+        data=pack_seeds([42], [bytes(32)])[:-1],
+        headers={"Content-Type": SEEDS_MIMETYPE, AUTHORIZATION_HEADER: "xyzzy"},
+    )
+    assert rv.status_code == 400
+
+
+@pytest.mark.parametrize("headers", [{}, {AUTHORIZATION_HEADER: ""}])
+def test_add_contagious_binary_unauthorized(client, headers):
+    rv = client.post(
+        "/add_contagious",
+        data=pack_seeds([42], [bytes(32)]),
+        headers={"Content-Type": SEEDS_MIMETYPE, **headers},
+    )
+    assert rv.status_code == 400
+    assert ha_server.db.get_epoch_seeds_tuple() == ([], [])
+
+
+def test_add_contagious_spooled(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(ha_server, "SPOOL_LOCATION", str(tmp_path / "spool"))
+    monkeypatch.setattr(ha_server, "spool", None)
+    rv = client.post(
+        "/add_contagious",
+        json={"authorization": "xyzzy", "data": [{"epoch": 42, "seed": "00" * 32}]},
+    )
+    assert rv.status_code == 202
+    assert ha_server.db.get_epoch_seeds_tuple() == ([], [])
+    assert to_json(client.get("/ingest/status"))["seeds"] == 1
+
+    ha_server.spool.commit(ha_server.db, 100)
+    assert ha_server.db.get_epoch_seeds_tuple() == ([42], [bytes(32)])
+    assert to_json(client.get("/ingest/status")) == {
+        "uploads": 0,
+        "seeds": 0,
+        "bytes": 0,
+    }
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        {"epoch": 2 ** 32, "seed": "00" * 32},
+        {"epoch": 42, "seed": "00" * 31},
+        {"epoch": 42, "seed": "00" * 33},
+    ],
+)
+def test_add_contagious_spooled_invalid(client, tmp_path, monkeypatch, record):
+    monkeypatch.setattr(ha_server, "SPOOL_LOCATION", str(tmp_path / "spool"))
+    monkeypatch.setattr(ha_server, "spool", None)
+    rv = client.post(
+        "/add_contagious",
+        json={
+            "authorization": "xyzzy",
+            "data": [{"epoch": 41, "seed": "00" * 32}, record],
+        },
+    )
+    assert rv.status_code == 400
+    assert to_json(client.get("/ingest/status"))["seeds"] == 0
+
+
+def test_ingest_status_without_spool(client):
+    assert client.get("/ingest/status").status_code == 404
@@ -0,0 +1,132 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from epidose.device.beacon_format import BLE_PACKET
+from epidose.device.beacon_tx_unlinkable_d import generate_random_bdaddr, set_transmit
+from epidose.device.hci import (
+    DryRunHci,
+    HciDevice,
+    HciSocket,
+    OCF_BCM_WRITE_BD_ADDR,
+    OCF_LE_SET_ADVERTISE_ENABLE,
+    OCF_LE_SET_ADVERTISING_DATA,
+    OGF_LE_CTL,
+    OGF_VENDOR_CMD,
+    format_bdaddr,
+)
+import logging
+import pytest
+import sys
+import types
+
+EPHID = bytes.fromhex("66687aadf862bd776c8fc18b8e9f8e20")
+
+logger = logging.getLogger("test_hci")
+
+
+#########################
+### TEST HCI COMMANDS ###
+#########################
+
+
+def test_abstract_device():
+    with pytest.raises(TypeError):
+        HciDevice(0, logger)
+
+
+def test_set_bdaddr():
+    hci = DryRunHci(0, logger)
+    bdaddr = bytes.fromhex("5230c4a19c1e")
+    assert format_bdaddr(bdaddr) == "52:30:C4:A1:9C:1E"
+    hci.set_bdaddr(bdaddr)
+    assert hci.commands == [
+        (OGF_VENDOR_CMD, OCF_BCM_WRITE_BD_ADDR, bytes.fromhex("1e9ca1c43052"))
+    ]
+    with pytest.raises(ValueError):
+        hci.set_bdaddr(bdaddr[1:])
+
+
+def test_advertising():
+    hci = DryRunHci(0, logger)
+    hci.device_up()
+    assert hci.up
+    hci.set_advertise_enable(True)
+    hci.set_advertise_enable(False)
+    assert hci.commands == [
+        (OGF_LE_CTL, OCF_LE_SET_ADVERTISE_ENABLE, b"\x01"),
+        (OGF_LE_CTL, OCF_LE_SET_ADVERTISE_ENABLE, b"\x00"),
+    ]
+    with pytest.raises(ValueError):
+        hci.set_advertising_data(bytes(33))
+
+
+def test_set_transmit():
+    hci = DryRunHci(0, logger)
+    set_transmit(hci, EPHID, 0xC0)
+    [(ogf, ocf, params)] = hci.commands
+    assert (ogf, ocf) == (OGF_LE_CTL, OCF_LE_SET_ADVERTISING_DATA)
+    assert len(params) == 32
+    assert params.startswith(BLE_PACKET + EPHID + b"\xc0\x01")
+    assert params.endswith(b"\0\0")
+
+
+def test_generate_random_bdaddr():
+    for _ in range(20):
+        bdaddr = generate_random_bdaddr()
+        assert len(bdaddr) == 6
+        # Locally administered unicast address
+        assert bdaddr[0] & 0x03 == 0x02
+
+
+class FakeBluezSocket:
+    """An HCI socket that stops working after the adapter is reset."""
+
+    def __init__(self, dead):
+        self.dead = dead
+        self.closed = False
+        self.commands = []
+
+    def close(self):
+        self.closed = True
+
+
+def test_socket_reopened(monkeypatch):
+    sockets = []
+
+    def hci_open_dev(dev_id):
+        sockets.append(FakeBluezSocket(dead=not sockets))
+        return sockets[-1]
+
+    def hci_send_cmd(socket, ogf, ocf, params):
+        if socket.dead:
+            raise OSError("Network is down")
+        socket.commands.append((ogf, ocf, params))
+
+    # PyBluez may not be installed; HciSocket only needs these functions
+    bluez = types.ModuleType("bluetooth._bluetooth")
+    bluez.hci_open_dev = hci_open_dev
+    bluez.hci_send_cmd = hci_send_cmd
+    bluetooth = types.ModuleType("bluetooth")
+    bluetooth._bluetooth = bluez
+    monkeypatch.setitem(sys.modules, "bluetooth", bluetooth)
+    monkeypatch.setitem(sys.modules, "bluetooth._bluetooth", bluez)
+
+    hci = HciSocket(0, logger)
+    hci.set_advertise_enable(True)
+    assert len(sockets) == 2
+    assert sockets[0].closed
+    assert sockets[1].commands == [(OGF_LE_CTL, OCF_LE_SET_ADVERTISE_ENABLE, b"\1")]
@@ -0,0 +1,126 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from dp3t.protocols.server_database import ServerDatabase
+from epidose.back_end.ingest_spool import IngestSpool, SPOOL_HEADER, UPLOAD_HEADER
+from epidose.common.seed_upload import SEED_RECORD
+import os
+import pytest
+
+
+#########################
+### TEST INGEST SPOOL ###
+#########################
+
+
+def seeds(first, count):
+    """Return count epochs starting from first and their seeds."""
+    epochs = list(range(first, first + count))
+    return (epochs, [bytes([e % 256]) * 32 for e in epochs])
+
+
+@pytest.fixture
+def db():
+    d = ServerDatabase(":memory:")
+    yield d
+    d.close(drop_tables=True)
+
+
+@pytest.fixture
+def spool_path(tmp_path):
+    return str(tmp_path / "spool")
+
+
+def test_commit_in_batches(db, spool_path):
+    spool = IngestSpool(spool_path)
+    for first in (0, 10, 20):
+        spool.append(*seeds(first, 10))
+    assert spool.depth(db) == (3, 30, os.path.getsize(spool_path) - SPOOL_HEADER.size)
+
+    assert spool.commit(db, 25) == 20
+    assert spool.depth(db)[:2] == (1, 10)
+    assert spool.commit(db, 25) == 10
+    assert spool.depth(db) == (0, 0, 0)
+    assert db.get_epoch_seeds_tuple() == seeds(0, 30)
+
+    # A fully committed spool is emptied
+    assert spool.commit(db, 25) == 0
+    assert os.path.getsize(spool_path) == SPOOL_HEADER.size
+    spool.append(*seeds(30, 5))
+    assert spool.commit(db, 25) == 5
+    assert db.get_epoch_seeds_tuple() == seeds(0, 35)
+
+
+def test_shared_spool(db, spool_path):
+    writer = IngestSpool(spool_path)
+    committer = IngestSpool(spool_path)
+    writer.append(*seeds(0, 3))
+    assert committer.commit(db, 100) == 3
+    assert committer.commit(db, 100) == 0
+    writer.append(*seeds(3, 3))
+    assert committer.commit(db, 100) == 3
+    assert db.get_epoch_seeds_tuple() == seeds(0, 6)
+
+
+def test_crash_recovery(db, spool_path):
+    spool = IngestSpool(spool_path)
+    spool.append(*seeds(0, 4))
+    spool.append(*seeds(4, 4))
+    size = os.path.getsize(spool_path)
+    spool.close()
+
+    # Simulate a crash while appending an upload
+    with open(spool_path, "ab") as f:
+        f.write(b"\0\0\0\x05partial")
+
+    spool = IngestSpool(spool_path)
+    assert spool.recover(spool.committed_offset(db)) == 11
+    assert os.path.getsize(spool_path) == size
+    with open(spool.unreadable_path(), "rb") as f:
+        assert f.read() == b"\0\0\0\x05partial"
+    spool.append(*seeds(8, 4))
+    assert spool.commit(db, 100) == 12
+
+    # A committer restarted after a crash does not commit uploads again
+    spool = IngestSpool(spool_path)
+    spool.recover(spool.committed_offset(db))
+    assert spool.commit(db, 100) == 0
+    assert db.get_epoch_seeds_tuple() == seeds(0, 12)
+
+
+def test_corrupt_upload_recovery(db, spool_path):
+    spool = IngestSpool(spool_path)
+    for first in (0, 4, 8):
+        spool.append(*seeds(first, 4))
+    spool.close()
+    with open(spool_path, "rb") as f:
+        data = f.read()
+
+    # Corrupt the second upload
+    second = SPOOL_HEADER.size + UPLOAD_HEADER.size + 4 * SEED_RECORD.size
+    corrupt = bytearray(data)
+    corrupt[second + UPLOAD_HEADER.size] ^= 0xFF
+    with open(spool_path, "wb") as f:
+        f.write(corrupt)
+
+    # The uploads following the corrupt one are kept aside
+    spool = IngestSpool(spool_path)
+    assert spool.recover(spool.committed_offset(db)) == len(data) - second
+    with open(spool.unreadable_path(), "rb") as f:
+        assert f.read() == corrupt[second:]
+    assert spool.commit(db, 100) == 4
+    assert db.get_epoch_seeds_tuple() == seeds(0, 4)
@@ -23,6 +23,8 @@ from dp3t.protocols.lowcost import (
     day_start_from_time,
     next_day_key,
     generate_ephids_for_day,
+    generate_packed_ephids_for_day,
+    matching_ephids_for_day,
     batch_start_from_time,
     ContactTracer,
     TracingDataBatch,
@@ -90,6 +92,12 @@ def test_generate_ephids_for_day():
         assert ephid in ephids
 
 
+def test_matching_ephids_for_day():
+    ephids = generate_ephids_for_day(KEY1, shuffle=False)
+    assert generate_packed_ephids_for_day(KEY1) == b"".join(ephids)
+    assert matching_ephids_for_day(KEY1) == frozenset(ephids)
+
+
 ##########################
 ### TEST TRACING BATCH ###
 ##########################
@@ -189,3 +197,47 @@ def test_observation_granularity_after_update():
     # All observations should now be at day granularity
     for time in ct.observations:
         assert time % config.SECONDS_PER_DAY == 0
+
+
+def test_matches_with_key():
+    ct = ContactTracer(start_time=START_TIME)
+    ct.add_observation(EPHIDS_KEY1[0], START_TIME + timedelta(minutes=20))
+    ct.add_observation(EPHIDS_KEY1[0], START_TIME + timedelta(minutes=25))
+    ct.add_observation(EPHID1, START_TIME + timedelta(minutes=30))
+    ct.add_observation(EPHIDS_KEY1[1], START_TIME + timedelta(hours=4))
+
+    day_start = day_start_from_time(START_TIME)
+    release_time = batch_start_from_time(START_TIME + timedelta(hours=4))
+    assert ct.matches_with_key(KEY1, day_start, release_time) == 1
+    assert ct.matches_with_key(KEY2, day_start, release_time) == 0
+
+    release_time += SECONDS_PER_BATCH
+    assert ct.matches_with_key(KEY1, day_start, release_time) == 2
+
+
+def test_observations_merged_after_batch():
+    ct = ContactTracer(start_time=START_TIME)
+    ct.add_observation(EPHID1, START_TIME + timedelta(minutes=20))
+    ct.add_observation(EPHID1, START_TIME + timedelta(minutes=25))
+    ct.add_observation(EPHID2, START_TIME + timedelta(hours=3))
+    assert sum(len(observations) for observations in ct.observations.values()) == 2
+
+    release_time = batch_start_from_time(START_TIME + timedelta(hours=6))
+    ct.housekeeping_after_batch(TracingDataBatch([], release_time=release_time))
+    assert ct.observations == {day_start_from_time(START_TIME): {EPHID1, EPHID2}}
+
+
+def test_parallel_matches_with_batch():
+    keys = [next_day_key(bytes([i]) * 32) for i in range(5)]
+    ct = ContactTracer(start_time=START_TIME)
+    for (n, key) in enumerate(keys[:3]):
+        for ephid in generate_ephids_for_day(key, shuffle=False)[: n + 1]:
+            ct.add_observation(ephid, START_TIME)
+
+    day_start = day_start_from_time(START_TIME)
+    release_time = batch_start_from_time(START_TIME + timedelta(hours=6))
+    batch = TracingDataBatch(
+        [(day_start, key) for key in keys], release_time=release_time
+    )
+    assert ct.matches_with_batch(batch) == 6
+    assert ct.matches_with_batch(batch, jobs=2) == 6
@@ -15,10 +15,11 @@ __copyright__ = """
 """
 __license__ = "Apache 2.0"
 
-from dp3t.protocols.server_database import ServerDatabase
-from dp3t.protocols.unlinkable import epoch_from_time
+from dp3t.protocols.server_database import ContagiousIds, ServerDatabase
+from dp3t.protocols.unlinkable import epoch_from_time, hashed_observation_from_seed
 import pytest
 from datetime import datetime, timezone
+import sqlite3
 
 
 ############################
@@ -78,3 +79,112 @@ def test_delete_epoch_seeds(db_connection):
     for (epoch, seed) in all_records:
         assert epoch == epoch_from_time(time_in)
         assert seed == b"in"
+
+
+def test_get_new_hashed_observations(db_connection):
+    assert db_connection.get_last_id() == 0
+    for i in range(0, 10):
+        db_connection.add_epoch_seed(i, f"S{i}")
+    last_id = db_connection.get_last_id()
+    assert last_id == 10
+
+    assert db_connection.get_new_hashed_observations(7, last_id) == [
+        hashed_observation_from_seed(f"S{i}".encode(), i) for i in range(7, 10)
+    ]
+    assert db_connection.get_new_hashed_observations(last_id, last_id) == []
+
+
+def test_get_expired_hashed_observations(db_connection):
+    time_out = datetime(2020, 4, 25, 20, 59, tzinfo=timezone.utc)
+    time_in = datetime(2020, 4, 25, 21, 1, tzinfo=timezone.utc)
+    db_connection.add_epoch_seed(epoch_from_time(time_out), "out")
+    db_connection.add_epoch_seed(epoch_from_time(time_in), "in")
+    last_id = db_connection.get_last_id()
+    db_connection.add_epoch_seed(epoch_from_time(time_out), "new")
+
+    assert db_connection.get_expired_hashed_observations(
+        datetime(2020, 4, 25, 21, 00, tzinfo=timezone.utc), last_id
+    ) == [hashed_observation_from_seed(b"out", epoch_from_time(time_out))]
+
+
+def test_get_days(db_connection):
+    db_connection.add_epoch_seeds([95, 96, 200, 1000], [b"a", b"b", b"c", b"d"])
+    last_id = db_connection.get_last_id()
+    assert db_connection.get_new_days(0, last_id) == {0, 1, 2, 10}
+    assert db_connection.get_new_days(2, last_id) == {2, 10}
+    assert db_connection.get_new_days(2, 3) == {2}
+    assert db_connection.get_day_hashed_observations(1) == [
+        hashed_observation_from_seed(b"b", 96)
+    ]
+    assert db_connection.get_day_hashed_observations(3) == []
+
+    last_retained_day = datetime.fromtimestamp(150 * 15 * 60, timezone.utc)
+    assert db_connection.get_expired_days(last_retained_day) == {0, 1}
+
+
+def test_hashed_observations(db_connection):
+    db_connection.add_epoch_seeds([95, 96, 200], [b"a", b"b", b"c"])
+    db_connection.add_epoch_seed(1000, "d")
+    last_id = db_connection.get_last_id()
+    expected = [
+        hashed_observation_from_seed(seed, epoch)
+        for (epoch, seed) in [(95, b"a"), (96, b"b"), (200, b"c"), (1000, b"d")]
+    ]
+    assert db_connection.get_new_hashed_observations(0, last_id) == expected
+    assert db_connection.get_new_hashed_observations(2, last_id) == expected[2:]
+    assert db_connection.get_day_hashed_observations(1) == expected[1:2]
+
+    last_retained_day = datetime.fromtimestamp(150 * 15 * 60, timezone.utc)
+    assert (
+        db_connection.get_expired_hashed_observations(last_retained_day, last_id)
+        == expected[:2]
+    )
+    assert (
+        db_connection.get_new_hashed_observations(0, last_id, last_retained_day)
+        == expected[2:]
+    )
+
+    # Records added by earlier versions lack the hashed observation
+    ContagiousIds.update(hashed_observation=None).execute()
+    assert db_connection.get_new_hashed_observations(0, last_id) == expected
+
+
+def test_ids_not_reused(db_connection):
+    db_connection.add_epoch_seeds([95, 96], [b"a", b"b"])
+    last_retained_day = datetime.fromtimestamp(150 * 15 * 60, timezone.utc)
+    db_connection.delete_expired_data(last_retained_day)
+    assert db_connection.get_last_id() == 2
+
+    db_connection.add_epoch_seed(1000, b"c")
+    assert db_connection.get_last_id() == 3
+    assert db_connection.get_new_hashed_observations(2, 3) == [
+        hashed_observation_from_seed(b"c", 1000)
+    ]
+
+
+def test_add_missing_fields(tmp_path):
+    path = str(tmp_path / "server.db")
+    d = ServerDatabase(path)
+    d.close(drop_tables=True)
+    sqlite = sqlite3.connect(path)
+    sqlite.execute(
+        "CREATE TABLE contagiousids (id INTEGER PRIMARY KEY, "
+        "epoch INTEGER NOT NULL, seed BLOB NOT NULL)"
+    )
+    sqlite.execute("INSERT INTO contagiousids (epoch, seed) VALUES (42, x'00')")
+    sqlite.commit()
+    sqlite.close()
+
+    d = ServerDatabase(path)
+    assert d.get_new_hashed_observations(0, 1) == [
+        hashed_observation_from_seed(b"\0", 42)
+    ]
+    d.add_epoch_seed(43, b"\1")
+    assert d.get_epoch_seeds_tuple() == ([42, 43], [b"\0", b"\1"])
+
+    # The migrated table does not reuse the identifiers of deleted records
+    assert d.get_last_id() == 2
+    ContagiousIds.delete().where(ContagiousIds.epoch == 43).execute()
+    d.add_epoch_seed(44, b"\2")
+    assert d.get_last_id() == 3
+    d.close(drop_tables=True)
@@ -0,0 +1,53 @@
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+from dp3t.protocols.client_database import ClientDatabase, db
+from dp3t.protocols.storage_profile import storage_pragmas
+import pytest
+
+
+############################
+### TEST STORAGE PROFILE ###
+############################
+
+
+def test_default_profile():
+    assert storage_pragmas(None) == []
+    assert storage_pragmas("default") == []
+
+
+def test_profile_overrides():
+    pragmas = dict(storage_pragmas("sdcard,synchronous=full,cache_size=-4096"))
+    assert pragmas["journal_mode"] == "wal"
+    assert pragmas["synchronous"] == "full"
+    assert pragmas["cache_size"] == -4096
+
+
+@pytest.mark.parametrize(
+    "spec", ["ssd", "sdcard,synchronous", "sdcard,page_size=4096", "server,mmap_size="]
+)
+def test_invalid_profile(spec):
+    with pytest.raises(ValueError):
+        storage_pragmas(spec)
+
+
+def test_database_profile(tmp_path):
+    d = ClientDatabase(str(tmp_path / "client.db"), "sdcard,busy_timeout=1234")
+    assert db.execute_sql("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert db.execute_sql("PRAGMA synchronous").fetchone() == (1,)
+    assert db.execute_sql("PRAGMA busy_timeout").fetchone() == (1234,)
+    d.close()
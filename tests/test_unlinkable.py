@@ -15,13 +15,21 @@ __copyright__ = """
 """
 __license__ = "Apache 2.0"
 
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+
+import pytest
 
 from dp3t.protocols.unlinkable import (
     ephid_from_seed,
+    ephids_from_seeds,
     epoch_from_time,
+    generate_new_seeds,
     hashed_observation_from_ephid,
     hashed_observation_from_seed,
+    hashed_observations_from_ephids,
+    hashed_observations_from_seeds,
+    seconds_to_next_epoch,
+    split_batch,
 )
 
 
@@ -61,6 +69,13 @@ def test_epoch_from_time():
     assert epoch1 == EPOCH1
 
 
+def test_seconds_to_next_epoch():
+    assert seconds_to_next_epoch(TIME0) == 15 * 60
+    assert seconds_to_next_epoch(TIME1) == 13 * 60
+    next_epoch_time = TIME1 + timedelta(seconds=seconds_to_next_epoch(TIME1))
+    assert epoch_from_time(next_epoch_time) == EPOCH1 + 1
+
+
 ##########################################
 ### TEST BASIC CRYPTOGRAPHIC FUNCTIONS ###
 ##########################################
@@ -88,3 +103,50 @@ def test_hashed_observation_from_seed():
 
     hashed_observation1 = hashed_observation_from_seed(SEED1, EPOCH1)
     assert hashed_observation1 == HASHED_OBSERVATION_EPHID1_TIME1
+
+
+def test_ephids_from_seeds():
+    assert ephids_from_seeds(SEED0 + SEED1) == EPHID0 + EPHID1
+    assert ephids_from_seeds(b"") == b""
+
+    seeds = generate_new_seeds(10)
+    assert len(seeds) == 10 * 32
+    assert split_batch(ephids_from_seeds(seeds), 16) == [
+        ephid_from_seed(seed) for seed in split_batch(seeds, 32)
+    ]
+
+    with pytest.raises(ValueError):
+        ephids_from_seeds(SEED0[1:])
+
+
+def test_hashed_observations_from_ephids():
+    hashed_observations = hashed_observations_from_ephids(
+        EPHID1 + EPHID1, [EPOCH0, EPOCH1]
+    )
+    assert (
+        hashed_observations
+        == HASHED_OBSERVATION_EPHID1_TIME0 + HASHED_OBSERVATION_EPHID1_TIME1
+    )
+
+    with pytest.raises(ValueError):
+        hashed_observations_from_ephids(EPHID1, [EPOCH0, EPOCH1])
+
+
+def test_hashed_observations_from_seeds():
+    hashed_observations = hashed_observations_from_seeds(
+        bytearray(SEED1 + SEED1), [EPOCH0, EPOCH1]
+    )
+    assert (
+        hashed_observations
+        == HASHED_OBSERVATION_EPHID1_TIME0 + HASHED_OBSERVATION_EPHID1_TIME1
+    )
+
+    seeds = generate_new_seeds(10)
+    epochs = list(range(EPOCH0, EPOCH0 + 10))
+    assert split_batch(hashed_observations_from_seeds(seeds, epochs), 32) == [
+        hashed_observation_from_seed(seed, epoch)
+        for (seed, epoch) in zip(split_batch(seeds, 32), epochs)
+    ]
+
+    with pytest.raises(ValueError):
+        hashed_observations_from_seeds(SEED1, [EPOCH0, EPOCH1])
@@ -16,11 +16,25 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 from datetime import datetime, timedelta, timezone
+from io import BytesIO
 import pytest
 from testfixtures import Replace, test_datetime
 
-from dp3t.protocols.unlinkable_db import ContactTracer
-from dp3t.protocols.unlinkable import epoch_from_time
+from dp3t.config import NUM_EPOCHS_PER_DAY
+
+from dp3t.protocols.unlinkable_db import (
+    ContactTracer,
+    TracingDataBatch,
+    day_timestamp,
+    observation_shard_days,
+)
+from dp3t.protocols.unlinkable import (
+    day_from_epoch,
+    epoch_from_time,
+    generate_new_seed,
+    hashed_observation_from_seed,
+)
+from epidose.common.filter_delta import FILTER_HEADER_SIZE, compute_delta
 
 from tests.test_protocols_generic import EPHID
 
@@ -67,6 +81,14 @@ def test_seeds_initialized(contact_tracer):
     assert len(seeds) == 1
 
 
+def test_ephids_for_today(contact_tracer):
+    ephids = contact_tracer.get_ephids_for_today()
+    assert len(ephids) == NUM_EPOCHS_PER_DAY
+    assert ephids[epoch_from_time(START_TIME)] == contact_tracer.get_ephid_for_time(
+        START_TIME
+    )
+
+
 def test_check_next_day_empty(contact_tracer):
     epoch = epoch_from_time(START_TIME + timedelta(days=1))
     seeds = contact_tracer.db.get_epoch_seeds(epoch, epoch + 1)
@@ -93,6 +115,16 @@ def test_check_advance_day_firing(contact_tracer):
     assert len(seeds) == 1
 
 
+def test_seconds_to_next_day(contact_tracer):
+    assert contact_tracer.seconds_to_next_day(START_TIME) == 110 * 60
+    assert contact_tracer.seconds_to_next_day(datetime(**START_TIME_ENDING)) == 5 * 60
+    assert contact_tracer.seconds_to_next_day(datetime(**START_TIME_TOMORROW)) == 0
+
+    contact_tracer.check_advance_day(datetime(**START_TIME_TOMORROW))
+    tomorrow = datetime(**START_TIME_TOMORROW)
+    assert contact_tracer.seconds_to_next_day(tomorrow) == 24 * 60 * 60 - 1
+
+
 def test_check_add_observation_midnight_race(contact_tracer):
     with Replace(
         "dp3t.protocols.unlinkable_db.datetime", test_datetime(**START_TIME_ENDING)
@@ -102,3 +134,166 @@ def test_check_add_observation_midnight_race(contact_tracer):
         "dp3t.protocols.unlinkable_db.datetime", test_datetime(**START_TIME_TOMORROW)
     ):
         contact_tracer.add_observation(EPHID, datetime(**START_TIME_TOMORROW))
+
+
+def test_parallel_filter_build(monkeypatch):
+    monkeypatch.setattr("dp3t.protocols.unlinkable_db.BUILD_CHUNK_SIZE", 16)
+    seeds = [generate_new_seed() for _ in range(200)]
+    epochs = list(range(1000, 1200))
+    serial_filter = BytesIO()
+    TracingDataBatch([(epochs, seeds)]).tofile(serial_filter)
+    parallel_filter = BytesIO()
+    TracingDataBatch([(epochs, seeds)], jobs=3).tofile(parallel_filter)
+    assert serial_filter.getvalue() == parallel_filter.getvalue()
+
+
+def test_filter_insert_delete():
+    seeds = [generate_new_seed() for _ in range(20)]
+    epochs = list(range(1000, 1020))
+    hashed_observations = [
+        hashed_observation_from_seed(seed, epoch)
+        for (epoch, seed) in zip(epochs, seeds)
+    ]
+    batch = TracingDataBatch([(epochs[:10], seeds[:10])])
+    batch.insert_seeds([(epochs[10:], seeds[10:])])
+    assert hashed_observations[15] in batch.infected_observations
+
+    assert batch.delete_hashed_observations(hashed_observations[:5]) == 0
+    assert hashed_observations[0] not in batch.infected_observations
+    assert hashed_observations[5] in batch.infected_observations
+    assert batch.delete_hashed_observations(hashed_observations[:1]) == 1
+
+
+def test_filter_from_hashed_observations():
+    seeds = [generate_new_seed() for _ in range(20)]
+    epochs = list(range(1000, 1020))
+    hashed_observations = [
+        hashed_observation_from_seed(seed, epoch)
+        for (epoch, seed) in zip(epochs, seeds)
+    ]
+    batch = TracingDataBatch(hashed_observations=hashed_observations)
+    # The filter is the same as the one built by hashing the seeds
+    seeds_batch = TracingDataBatch([(epochs, seeds)])
+    assert batch.capacity == seeds_batch.capacity
+    assert (
+        batch.infected_observations.buckets
+        == seeds_batch.infected_observations.buckets
+    )
+    assert batch.delete_hashed_observations(hashed_observations[:5]) == 0
+    assert hashed_observations[0] not in batch.infected_observations
+    with pytest.raises(ValueError):
+        TracingDataBatch([(epochs, seeds)], hashed_observations=hashed_observations)
+
+
+def test_mapped_filter(tmp_path):
+    seeds = [generate_new_seed() for _ in range(20)]
+    epochs = list(range(1000, 1020))
+    batch = TracingDataBatch([(epochs, seeds)])
+    path = tmp_path / "filter.bin"
+    with open(path, "wb") as f:
+        f.write(b"header")
+        batch.tofile(f)
+
+    with open(path, "rb") as f:
+        f.read(6)
+        mapped = TracingDataBatch(fh=f, capacity=batch.capacity, mapped=True)
+    assert mapped.infected_observations.buckets == batch.infected_observations.buckets
+    found = hashed_observation_from_seed(seeds[3], 1003)
+    assert found in mapped.infected_observations
+    not_found = hashed_observation_from_seed(seeds[3], 1004)
+    assert not_found not in mapped.infected_observations
+
+
+def test_contains_many():
+    seeds = [generate_new_seed() for _ in range(200)]
+    epochs = list(range(1000, 1200))
+    batch = TracingDataBatch([(epochs[:100], seeds[:100])])
+    hashed_observations = [
+        hashed_observation_from_seed(seed, epoch)
+        for (epoch, seed) in zip(epochs, seeds)
+    ]
+    hits = batch.contains_many(hashed_observations)
+    assert len(hits) == 200
+    assert hits.count() == 100
+    assert hits[:100].all()
+    for (hit, ho) in zip(hits, hashed_observations):
+        assert hit == (ho in batch.infected_observations)
+
+
+def test_incremental_matching(contact_tracer):
+    seeds = [generate_new_seed() for _ in range(40)]
+    epochs = list(range(1000, 1040))
+    hashed_observations = [
+        hashed_observation_from_seed(seed, epoch)
+        for (epoch, seed) in zip(epochs, seeds)
+    ]
+    for ho in hashed_observations:
+        contact_tracer.db.add_observation(1, ho, -60)
+
+    batch = TracingDataBatch([(epochs[:10], seeds[:10])])
+    batch.generation = 1
+    assert contact_tracer.matches_with_batch(batch) == 10
+
+    # Create generation 2 by adding and removing seeds
+    old_buckets = batch.infected_observations.buckets.copy()
+    batch.insert_seeds([(epochs[10:20], seeds[10:20])])
+    batch.delete_hashed_observations(hashed_observations[:5])
+    batch.generation = 2
+    batch.add_changes(
+        2,
+        [
+            (offset - FILTER_HEADER_SIZE, len(data))
+            for (offset, data) in compute_delta(
+                old_buckets, batch.infected_observations.buckets
+            )
+        ],
+    )
+    assert batch.buckets_changed_since(1) is not None
+    assert contact_tracer.matches_with_batch(batch) == 15
+    assert contact_tracer.matches_with_batch(batch) == 15
+
+    # Without the changes all observations are checked again
+    batch.insert_seeds([(epochs[20:], seeds[20:])])
+    batch.generation = 3
+    assert batch.buckets_changed_since(2) is None
+    assert contact_tracer.matches_with_batch(batch) == 35
+
+
+def test_observation_shard_days():
+    day = day_timestamp(START_TIME.date())
+    days = observation_shard_days(day)
+    assert 1 <= len(days) <= 2
+    # The recorded day's start and end belong to the returned days
+    start = datetime.fromtimestamp(day)
+    for time in (start, start + timedelta(days=1) - timedelta(seconds=1)):
+        assert day_from_epoch(epoch_from_time(time)) in days
+
+
+def test_matches_with_shards(contact_tracer):
+    seeds = [generate_new_seed() for _ in range(20)]
+    day = day_timestamp(START_TIME.date())
+    first_epoch = epoch_from_time(datetime.fromtimestamp(day))
+    epochs = list(range(first_epoch, first_epoch + 20))
+    for (epoch, seed) in zip(epochs, seeds):
+        contact_tracer.db.add_observation(
+            day, hashed_observation_from_seed(seed, epoch), -60
+        )
+
+    shard_day = day_from_epoch(first_epoch)
+    shards = {shard_day: TracingDataBatch([(epochs[:5], seeds[:5])])}
+    assert contact_tracer.matches_with_shards(shards) == 5
+
+    # Shards of other days are not probed
+    other_shards = {shard_day + 5: TracingDataBatch([(epochs, seeds)])}
+    assert contact_tracer.matches_with_shards(other_shards) == 0
+
+
+def test_buffered_observations():
+    ct = ContactTracer(start_time=START_TIME, observation_buffer_size=10)
+    ct.add_observation(EPHID, START_TIME, -60)
+    ct.add_observation(EPHID, START_TIME, -40)
+    assert list(ct.db.get_observations()) == []
+    ct.flush_observations()
+    (ephid_hash,) = list(ct.db.get_observations())
+    assert ct.db.get_observation_details(ephid_hash) == (2, -50)
+    ct.db.close()
@@ -54,7 +54,8 @@ def test_context():
     # Add seeds to the client database
     for i in range(0, 10):
         e = epoch_from_time(START_TIME + timedelta(minutes=i * EPOCH_LENGTH))
-        client_db.add_epoch_ids(e, bytes.fromhex(f"deadbeef0{i}"), f"E{i}")
+        seed = bytes.fromhex(f"deadbeef0{i}" * 6 + "00" * 2)
+        client_db.add_epoch_ids(e, seed, f"E{i}")
     close(client_db_handle)
     # subprocess.call(["/home/dds/src/epidose/utils/client-db-report.sh", client_db_path])
 
@@ -127,4 +128,4 @@ def test_upload_seeds(test_context):
         epoch_from_time(START_TIME + timedelta(minutes=8 * EPOCH_LENGTH)) + 1
         not in epochs
     )
-    assert bytes.fromhex("deadbeef06") in seeds
+    assert bytes.fromhex("deadbeef06" * 6 + "00" * 2) in seeds
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+""" Measure the performance of the protocol and storage hot paths """
+
+__copyright__ = """
+    Copyright 2020 Diomidis Spinellis
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+from statistics import median
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import types
+
+from dp3t.config import NUM_EPOCHS_PER_DAY
+from dp3t.protocols import lowcost, unlinkable, unlinkable_db
+from dp3t.protocols.client_database import ClientDatabase
+from dp3t.protocols.unlinkable import (
+    epoch_from_time,
+    generate_new_seed,
+    generate_new_seeds,
+    hashed_observation_from_seed,
+    hashed_observations_from_seeds,
+)
+from epidose.common.filter_file import read_filter, write_compressed_filter
+from epidose.common.seed_upload import AUTHORIZATION_HEADER, SEEDS_MIMETYPE, pack_seeds
+
+# Day whose epochs are used for the generated seeds and observations
+START_TIME = datetime(2020, 4, 25, tzinfo=timezone.utc)
+
+# Benchmark sizes for each run scale
+FILTER_SIZES = {"quick": [1000, 10000], "full": [1000, 10000, 100000]}
+OBSERVATION_COUNTS = {"quick": [1000], "full": [1000, 10000]}
+INFECTED_ITEMS = {"quick": 2000, "full": 20000}
+INFECTED_KEYS = {"quick": 2, "full": 20}
+INSERT_COUNTS = {"quick": [500], "full": [500, 5000]}
+UPLOAD_RECORDS = {"quick": [96], "full": [96, 1344]}
+
+
+def measure(function, number=1, repeat=5):
+    """Return a dictionary with the times of repeat runs of number calls
+    to the specified function."""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            function()
+        times.append((perf_counter() - start) / number)
+    return {
+        "repeat": repeat,
+        "number": number,
+        "times": times,
+        "best": min(times),
+        "median": median(times),
+    }
+
+
+def tracing_seeds(count):
+    """Return (epochs, seeds) tuples covering count epochs of infected
+    users, each reporting a full day."""
+    first_epoch = epoch_from_time(START_TIME)
+    result = []
+    for start in range(0, count, NUM_EPOCHS_PER_DAY):
+        n = min(NUM_EPOCHS_PER_DAY, count - start)
+        result.append(
+            (
+                list(range(first_epoch, first_epoch + n)),
+                [generate_new_seed() for _ in range(n)],
+            )
+        )
+    return result
+
+
+def hashed_observations(seeds, count):
+    """Return count hashed observations, half of them corresponding to the
+    specified tracing seeds."""
+    infected = [
+        hashed_observation_from_seed(seed, epoch)
+        for (epochs, seeds) in seeds
+        for (epoch, seed) in zip(epochs, seeds)
+    ][: count // 2]
+    others = [os.urandom(32) for _ in range(count - len(infected))]
+    return infected + others
+
+
+def bench_generate_ephids_for_day(scale, work_dir):
+    """Low-cost design: derive a day's EphIDs from its key."""
+    key = lowcost.generate_new_day_key()
+    for shuffle in (False, True):
+        yield (
+            {"shuffle": shuffle},
+            NUM_EPOCHS_PER_DAY,
+            measure(lambda: lowcost.generate_ephids_for_day(key, shuffle), 10),
+        )
+
+
+def bench_hashed_observation_from_seed(scale, work_dir):
+    """Unlinkable design: hash a (seed, epoch) pair into an observation."""
+    seeds = [generate_new_seed() for _ in range(1000)]
+
+    def run():
+        for (epoch, seed) in enumerate(seeds):
+            hashed_observation_from_seed(seed, epoch)
+
+    yield ({}, len(seeds), measure(run))
+
+    packed_seeds = generate_new_seeds(len(seeds))
+    epochs = list(range(len(seeds)))
+    yield (
+        {"batch": True},
+        len(seeds),
+        measure(lambda: hashed_observations_from_seeds(packed_seeds, epochs)),
+    )
+
+
+def bench_filter_build(scale, work_dir):
+    """Unlinkable design: build the Cuckoo filter from seeds."""
+    for size in FILTER_SIZES[scale]:
+        seeds = tracing_seeds(size)
+        yield (
+            {"items": size},
+            size,
+            measure(lambda: unlinkable_db.TracingDataBatch(seeds), repeat=3),
+        )
+        hashed_observations = [
+            hashed_observation_from_seed(seed, epoch)
+            for (epochs, user_seeds) in seeds
+            for (epoch, seed) in zip(epochs, user_seeds)
+        ]
+        yield (
+            {"items": size, "precomputed": True},
+            size,
+            measure(
+                lambda: unlinkable_db.TracingDataBatch(
+                    hashed_observations=hashed_observations
+                ),
+                repeat=3,
+            ),
+        )
+
+
+def bench_filter_load(scale, work_dir):
+    """Unlinkable design: load a stored Cuckoo filter."""
+    for size in FILTER_SIZES[scale]:
+        batch = unlinkable_db.TracingDataBatch(tracing_seeds(size))
+        path = os.path.join(work_dir, f"filter-{size}.bin")
+        with open(path, "wb") as f:
+            batch.tofile(f)
+        for mapped in (False, True):
+
+            def run():
+                with open(path, "rb") as f:
+                    unlinkable_db.TracingDataBatch(
+                        fh=f, capacity=batch.capacity, mapped=mapped
+                    )
+
+            yield ({"items": size, "mapped": mapped}, size, measure(run, 10))
+
+        compressed_path = path + ".z"
+        with open(compressed_path, "wb") as f:
+            write_compressed_filter(f, batch)
+
+        def run_compressed():
+            with open(compressed_path, "rb") as f:
+                read_filter(f)
+
+        yield ({"items": size, "compressed": True}, size, measure(run_compressed, 10))
+
+
+def bench_match_lowcost(scale, work_dir):
+    """Low-cost design: match the stored observations with a key batch."""
+    batch_start = lowcost.batch_start_from_time(START_TIME)
+    release_time = batch_start + lowcost.SECONDS_PER_DAY
+    day_start = lowcost.day_start_from_time(START_TIME)
+    keys = [lowcost.generate_new_day_key() for _ in range(INFECTED_KEYS[scale])]
+    batch = lowcost.TracingDataBatch(
+        [(day_start, key) for key in keys], release_time=release_time
+    )
+    for count in OBSERVATION_COUNTS[scale]:
+        tracer = lowcost.ContactTracer(START_TIME)
+        infected = lowcost.generate_ephids_for_day(keys[0], shuffle=False)
+        tracer.observations = {
+            batch_start: set(infected[: count // 2])
+            | {os.urandom(16) for _ in range(count - count // 2)}
+        }
+
+        def run():
+            lowcost.matching_ephids_for_day.cache_clear()
+            tracer.matches_with_batch(batch)
+
+        params = {"observations": count, "keys": len(keys)}
+        yield (params, count, measure(run, repeat=3))
+        yield (
+            {**params, "cached": True},
+            count,
+            measure(lambda: tracer.matches_with_batch(batch), repeat=3),
+        )
+        yield (
+            {**params, "jobs": 2},
+            count,
+            measure(lambda: tracer.matches_with_batch(batch, jobs=2), repeat=3),
+        )
+
+
+def bench_match_unlinkable(scale, work_dir):
+    """Unlinkable design: match the stored observations with a filter."""
+    seeds = tracing_seeds(INFECTED_ITEMS[scale])
+    batch = unlinkable.TracingDataBatch(seeds)
+    for count in OBSERVATION_COUNTS[scale]:
+        tracer = unlinkable.ContactTracer(START_TIME)
+        tracer.observations_per_day = {tracer.today: hashed_observations(seeds, count)}
+        yield (
+            {"observations": count, "filter_items": INFECTED_ITEMS[scale]},
+            count,
+            measure(lambda: tracer.matches_with_batch(batch)),
+        )
+
+
+def bench_match_unlinkable_db(scale, work_dir):
+    """Database-backed unlinkable design: match the stored observations
+    with a filter."""
+    seeds = tracing_seeds(INFECTED_ITEMS[scale])
+    batch = unlinkable_db.TracingDataBatch(seeds)
+    for count in OBSERVATION_COUNTS[scale]:
+        tracer = unlinkable_db.ContactTracer(
+            START_TIME, os.path.join(work_dir, f"match-{count}.db"), transmitter=False
+        )
+        day = unlinkable_db.day_timestamp(tracer.today)
+        tracer.db.add_observations(
+            {(day, ho): (1, -60) for ho in hashed_observations(seeds, count)}
+        )
+        yield (
+            {"observations": count, "filter_items": INFECTED_ITEMS[scale]},
+            count,
+            measure(lambda: tracer.matches_with_batch(batch)),
+        )
+        tracer.db.close()
+
+
+def bench_add_observation(scale, work_dir):
+    """Client database: store received observations."""
+    for count in INSERT_COUNTS[scale]:
+        for profile in ("default", "sdcard"):
+            for bulk in (False, True):
+                path = os.path.join(work_dir, f"observations-{profile}-{bulk}.db")
+                db = ClientDatabase(path, profile)
+                hashes = [os.urandom(32) for _ in range(count)]
+
+                def run():
+                    if bulk:
+                        db.add_observations({(0, h): (1, -60) for h in hashes})
+                    else:
+                        for h in hashes:
+                            db.add_observation(0, h, -60)
+
+                yield (
+                    {"observations": count, "profile": profile, "bulk": bulk},
+                    count,
+                    measure(run, repeat=3),
+                )
+                db.close()
+
+
+def bench_add_contagious(scale, work_dir):
+    """Health authority server: ingest uploaded seeds."""
+    from epidose.back_end import ha_server
+
+    args = types.SimpleNamespace(
+        database=os.path.join(work_dir, "server.db"), debug=False, verbose=False
+    )
+    ha_server.app.config["TESTING"] = True
+    with ha_server.app.test_client() as client:
+        with ha_server.app.app_context():
+            ha_server.initialize(args)
+        for count in UPLOAD_RECORDS[scale]:
+            epochs = list(range(count))
+            seeds = [generate_new_seed() for _ in epochs]
+            uploads = {
+                "json": {
+                    "json": {
+                        "authorization": "bench",
+                        "data": [
+                            {"epoch": epoch, "seed": seed.hex()}
+                            for (epoch, seed) in zip(epochs, seeds)
+                        ],
+                    }
+                },
+                "binary": {
+                    "data": pack_seeds(epochs, seeds),
+                    "headers": {
+                        "Content-Type": SEEDS_MIMETYPE,
+                        AUTHORIZATION_HEADER: "bench",
+                    },
+                },
+            }
+            for (upload_format, request) in uploads.items():
+
+                def run():
+                    response = client.post("/add_contagious", **request)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"Upload failed: {response.status}")
+
+                yield (
+                    {"records": count, "format": upload_format},
+                    count,
+                    measure(run, repeat=3),
+                )
+    ha_server.db.close(drop_tables=True)
+
+
+# Available benchmarks
+BENCHMARKS = {
+    "generate_ephids_for_day": bench_generate_ephids_for_day,
+    "hashed_observation_from_seed": bench_hashed_observation_from_seed,
+    "filter_build": bench_filter_build,
+    "filter_load": bench_filter_load,
+    "match_lowcost": bench_match_lowcost,
+    "match_unlinkable": bench_match_unlinkable,
+    "match_unlinkable_db": bench_match_unlinkable_db,
+    "add_observation": bench_add_observation,
+    "add_contagious": bench_add_contagious,
+}
+
+
+def run_benchmarks(names, scale):
+    """Run the specified benchmarks and return a list of their results.
+    Failing benchmarks are reported with their error."""
+    results = []
+    with TemporaryDirectory() as work_dir:
+        for name in names:
+            print(f"{name}", end="", file=sys.stderr, flush=True)
+            try:
+                for (params, items, timing) in BENCHMARKS[name](scale, work_dir):
+                    timing["items_per_second"] = items / timing["median"]
+                    results.append({"name": name, "params": params, **timing})
+                    print(".", end="", file=sys.stderr, flush=True)
+            except Exception as e:
+                results.append({"name": name, "error": f"{type(e).__name__}: {e}"})
+                print(" failed", end="", file=sys.stderr)
+            print(file=sys.stderr)
+    return results
+
+
+def git_revision():
+    """Return the revision of the measured source code, if known."""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def compare(results, previous):
+    """Print the ratio of the median time of each result to that of
+    the corresponding previous one."""
+    previous_medians = {
+        (r["name"], json.dumps(r["params"], sort_keys=True)): r["median"]
+        for r in previous["results"]
+        if "median" in r
+    }
+    for r in results:
+        key = (r["name"], json.dumps(r.get("params"), sort_keys=True))
+        if "median" not in r or key not in previous_medians:
+            continue
+        ratio = r["median"] / previous_medians[key]
+        print(f"{ratio:6.2f} {r['name']} {key[1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the performance of the protocol and storage hot paths"
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        help="Run only the specified benchmark (may be repeated)",
+        action="append",
+        choices=BENCHMARKS.keys(),
+    )
+    parser.add_argument(
+        "-c",
+        "--compare",
+        help="Compare the results with those stored in the specified file",
+        type=argparse.FileType("r"),
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="File where the results are stored as JSON (default: stdout)",
+        type=argparse.FileType("w"),
+        default=sys.stdout,
+    )
+    parser.add_argument(
+        "-q", "--quick", help="Run only the smaller sizes", action="store_true"
+    )
+    args = parser.parse_args()
+
+    scale = "quick" if args.quick else "full"
+    results = run_benchmarks(args.benchmark or BENCHMARKS.keys(), scale)
+    report = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "scale": scale,
+        "results": results,
+    }
+    json.dump(report, args.output, indent=2)
+    args.output.write("\n")
+
+    if args.compare:
+        compare(results, json.load(args.compare))
+
+
+if __name__ == "__main__":
+    main()
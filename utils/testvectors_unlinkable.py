@@ -22,9 +22,11 @@ __license__ = "Apache 2.0"
 from datetime import datetime, timezone
 
 from dp3t.protocols.unlinkable import (
+    LENGTH_HASHED_OBSERVATION,
     ephid_from_seed,
     epoch_from_time,
-    hashed_observation_from_ephid,
+    hashed_observations_from_ephids,
+    split_batch,
 )
 
 
@@ -55,14 +57,17 @@ def main():
 
     print("\n## Test vector hashed observed EphIDs ##")
     ephid = ephid_from_seed(bytes.fromhex(SEED1))
-    for time in [TIME0, TIME1, TIME2]:
-        epoch = epoch_from_time(time)
+    times = [TIME0, TIME1, TIME2]
+    epochs = [epoch_from_time(time) for time in times]
+    hashed_observations = split_batch(
+        hashed_observations_from_ephids(ephid * len(epochs), epochs),
+        LENGTH_HASHED_OBSERVATION,
+    )
+    for (time, epoch, hashed_observation) in zip(times, epochs, hashed_observations):
         print(" - EphID:", ephid.hex())
         print(" - Time:", time.isoformat(" "))
         print(" - Epoch:", epoch)
-        print(
-            " - Hashed observation:", hashed_observation_from_ephid(ephid, epoch).hex()
-        )
+        print(" - Hashed observation:", hashed_observation.hex())
         print()
 
 